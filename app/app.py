@@ -14,19 +14,62 @@ from aiogram.fsm.storage.memory import MemoryStorage
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 import asyncio
+import html
+import tempfile
+import time
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.enums import ChatAction # <-- Импорт для статуса "Отправка документа..."
 
 # Импорты из ваших модулей
 try:
-    from service import notify_admins_about_new_payment, start_scheduler
+    from service import (
+        enqueue_new_payment_notification,
+        wake_outbox_sender,
+        start_outbox_sender,
+        start_reminder_sender,
+        start_scheduler,
+        check_subscriptions,
+        forecast_notifications,
+        resolve_timezone,
+        REMINDER_WINDOW_START,
+        REMINDER_WINDOW_END
+    )
     from database import (
-        init_db as init_database_module,
         save_payment as save_payment_db,
         get_distinct_tw_usernames_with_users,
         get_payments_for_tw_account,
-        get_user_language
+        search_tw_accounts,
+        get_revenue_by_plan,
+        get_revenue_by_day,
+        get_latest_subscription_snapshot,
+        get_user_language,
+        get_user_timezone,
+        set_user_timezone,
+        checkpoint_wal,
+        create_broadcast,
+        start_broadcast,
+        cancel_broadcast,
+        get_recent_broadcasts,
+        connect_db
+    )
+    from migrations import init_db as init_database_module, run_data_migrations
+    from db_profiler import get_query_stats, SLOW_QUERY_MS
+    from tx_index import tx_hash_index
+    from expiry_index import expiry_index
+    from blocked_users import blocked_users
+    from tron_verifier import TronVerifier, TRON_VERIFY_ENABLED
+    from export import export_payments_csv
+    from importer import import_payments_csv, write_import_report
+    from broadcast import variant_from_message, wake_broadcast_sender, start_broadcast_sender
+    from archive import start_archiver, get_auto_vacuum_status, convert_to_incremental_auto_vacuum
+    from backup import start_backup_scheduler, backup_metrics
+    from send_queue import send_queue, GLOBAL_RATE, CHAT_RATE
+    from middlewares import (
+        UserLockMiddleware, IdempotentCallbackMiddleware, AdmissionControlMiddleware, ThrottlingMiddleware,
     )
+    from leader import leader_lease
+    from update_recorder import UpdateRecorder, RECORD_UPDATES_FILE
+    from log_setup import setup_logging
 except ImportError as e:
     logging.error(f"Ошибка импорта: {e}. Убедитесь, что файлы database.py и service.py существуют и содержат нужные функции.")
     exit()
@@ -56,9 +99,91 @@ except ValueError:
 
 # --- Инициализация Aiogram ---
 bot = Bot(token=TOKEN)
+# Ответ Forbidden на любой запрос в личный чат отмечает пользователя, заблокировавшего бота
+bot.session.middleware(blocked_users.request_middleware)
+# Все исходящие запросы к Bot API проходят через очередь с приоритетами и лимитами (send_queue.py)
+bot.session.middleware(send_queue)
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 
+# --- Фоновая проверка транзакций в сети TRON ---
+tron_verifier = TronVerifier(TRC20_WALLET)
+
+# --- Отслеживание активности ---
+# Фоновые задачи обслуживания БД (архивация, VACUUM) работают только в простое
+IDLE_SECONDS = 120
+last_update_at = time.monotonic()
+
+# Апдейты, обработка которых еще идет (их дожидается остановка бота)
+inflight_updates = 0
+no_inflight_updates = asyncio.Event()
+no_inflight_updates.set()
+
+@dp.update.outer_middleware()
+async def track_activity(handler, event, data):
+    global last_update_at, inflight_updates
+    last_update_at = time.monotonic()
+    inflight_updates += 1
+    no_inflight_updates.clear()
+    try:
+        return await handler(event, data)
+    finally:
+        inflight_updates -= 1
+        if not inflight_updates:
+            no_inflight_updates.set()
+
+# Запись входящих апдейтов (с псевдонимами вместо личных данных) для воспроизведения replay.py
+update_recorder = None
+if RECORD_UPDATES_FILE:
+    update_recorder = UpdateRecorder(
+        RECORD_UPDATES_FILE, ADMIN_IDS,
+        keep_text=lambda text: any(text in lang_texts["main_menu"] for lang_texts in TEXTS.values()))
+    dp.update.outer_middleware(update_recorder)
+
+# Апдейт от пользователя, заблокировавшего бота, снимает отметку о блокировке
+dp.update.outer_middleware(blocked_users.update_middleware)
+
+def throttle_kind(event) -> str:
+    """Вид обработчика для лимитов анти-флуда (THROTTLE_LIMITS)."""
+    if isinstance(event, types.CallbackQuery):
+        return "callback"
+    text = event.text or ""
+    if text == "/start" or text.startswith(("/start ", "/start@")):
+        return "start"
+    for lang_texts in TEXTS.values():
+        if text == lang_texts["main_menu"][0]:
+            return "instruction"
+        if text in lang_texts["main_menu"]:
+            return "menu"
+    return "message"
+
+# Анти-флуд: апдейты сверх лимитов пользователя отбрасываются раньше всех остальных middleware
+throttling = ThrottlingMiddleware(
+    throttle_kind, lambda user_id: get_text("throttled", user_languages.get(user_id, "en")),
+    exempt=lambda user_id: user_id in ADMIN_IDS)
+dp.message.outer_middleware(throttling)
+dp.callback_query.outer_middleware(throttling)
+
+# Апдейты одного пользователя обрабатываются по очереди, повторные нажатия кнопок оплаты отвечаются из памяти
+user_lock_middleware = UserLockMiddleware()
+dp.message.outer_middleware(user_lock_middleware)
+dp.callback_query.outer_middleware(user_lock_middleware)
+dp.callback_query.outer_middleware(IdempotentCallbackMiddleware())
+
+def is_priority_update(user_id: int, state) -> bool:
+    """При перегрузке вперед пропускаются админы и пользователи посреди оплаты, а не новые /start."""
+    return user_id in ADMIN_IDS or (state or "").startswith("PaymentState:")
+
+# Ограничение числа одновременно выполняемых обработчиков; при перегрузке - короткий ответ вместо обработки
+admission_control = AdmissionControlMiddleware(
+    is_priority_update, lambda user_id: get_text("overloaded", user_languages.get(user_id, "en")))
+dp.message.outer_middleware(admission_control)
+dp.callback_query.outer_middleware(admission_control)
+
+def bot_is_idle() -> bool:
+    """True, если входящих апдейтов не было последние IDLE_SECONDS секунд."""
+    return time.monotonic() - last_update_at > IDLE_SECONDS
+
 # --- Кеш для file_id инструкций ---
 instruction_file_ids = {}
 
@@ -89,6 +214,10 @@ def save_cache():
 # Храним выбранный язык пользователя в памяти (для быстрого доступа)
 user_languages = {}
 
+# Последний поисковый запрос каждого админа (для пагинации результатов /search)
+admin_search_queries = {}
+SEARCH_PAGE_SIZE = 10
+
 # --- Тарифные планы ---
 PLANS = {
     "1mo": {"price": 58, "days": 30, "name_en": "1 Month", "name_ru": "1 Месяц", "name_es": "1 Mes"},
@@ -122,6 +251,9 @@ TEXTS = {
         "subscription_warning_for": "⚠️ Your subscription for TradingView account **{tw_username}** will expire in {days} days on {date}.",
         "generic_subscription_expired": "Your subscription has expired.",
         "generic_subscription_warning": "Your subscription will expire in {days} days on {date}.",
+        "timezone_current": "🕒 Your time zone: `{timezone}`\nReminders are delivered between {start}:00 and {end}:00 your local time.\n\nTo change it, send `/timezone Area/City` (for example `/timezone Europe/Berlin`) or `/timezone auto`.",
+        "timezone_set": "✅ Time zone set: `{timezone}`",
+        "timezone_invalid": "⚠️ Unknown time zone. Use the Area/City format, for example `Europe/Berlin`.",
         "support": f"For assistance, please contact @{ADMIN_USERNAME}",
         "paid_button": "✅ Paid",
         "help_button": "🆘 Help",
@@ -134,11 +266,14 @@ TEXTS = {
         "confirm_yes": "✅ All correct",
         "confirm_no": "✏️ Edit",
         "error_occurred": "An error occurred. Please try again later or contact support.",
+        "overloaded": "⏳ The bot is busy right now. Please try again in a minute.",
+        "throttled": "🐢 Too many requests. Please wait a minute before trying again.",
         "duplicate_hash": "This transaction hash has already been used. If you believe this is an error, please contact support.",
         "admin_panel_title": "Welcome to the Admin Panel!",
         "admin_list_tw_accounts": "📋 List of TradingView Accounts",
         "admin_client_info_title": "👤 Account Info: {tw_username}",
         "admin_no_payments": "⚠️ No payments found for this TradingView account.",
+        "admin_button_outdated": "This button is outdated. Please open the account list again.",
         "admin_associated_tg": "👤 Associated Telegram User",
         "admin_active_subscription": "✅ Active Subscription Until",
         "admin_no_active_subscription": "❌ No Active Subscription",
@@ -148,12 +283,67 @@ TEXTS = {
         "admin_payment_amount": "💰 Amount",
         "admin_payment_date": "📅 Date",
         "admin_payment_sub_end": "⏳ Subscription End (this payment)",
+        "admin_verification_status": "🔎 On-chain check",
+        "admin_export_usage": "Usage: /export [from YYYY-MM-DD] [to YYYY-MM-DD] [active] [gz]\nExample: /export 2025-01-01 2025-03-31 gz",
+        "admin_export_in_progress": "⏳ Preparing export...",
+        "admin_export_empty": "No payments match the filter.",
+        "admin_export_caption": "📤 Payments export: {rows} rows",
+        "admin_search_usage": "Usage: /search <part of TradingView or Telegram username>",
+        "admin_search_results": "🔎 Results for \"{query}\" (page {page}):",
+        "admin_search_empty": "Nothing found for \"{query}\".",
+        "admin_stats_title": "📊 Statistics",
+        "admin_stats_subscriptions": "👥 Subscriptions on {day}: active *{active}*, expired *{expired}*",
+        "admin_stats_no_snapshot": "👥 No subscription snapshot yet (made by the daily check).",
+        "admin_stats_month": "💰 This month by plan:",
+        "admin_stats_days": "📅 Last {days} days:",
+        "admin_stats_line": "  {name}: {revenue:.2f} USDT ({count})",
+        "admin_stats_no_data": "  no payments",
+        "admin_vacuum_status": "🧹 Database file: {size:.0f} MB, auto_vacuum: {mode}.",
+        "admin_vacuum_enabled": "Free space is reclaimed in small slices while the bot is idle.",
+        "admin_vacuum_convert_hint": "Switching to INCREMENTAL needs a one-time full VACUUM: database writes are blocked for ~{estimate:.0f} s (users may see errors). Run /vacuum now at a quiet time.",
+        "admin_vacuum_started": "🧹 Full VACUUM started, expected ~{estimate:.0f} s...",
+        "admin_vacuum_done": "✅ auto_vacuum=INCREMENTAL enabled in {elapsed:.1f} s.",
+        "admin_vacuum_failed": "❌ VACUUM failed: {error}",
+        "admin_import_usage": "Send a CSV file with the caption /import.\nColumns: user_id, tw_username and subscription_end (YYYY-MM-DD) or days (extend by N days); optional: tg_username, language, amount, purchase_date, tx_hash, plan_id. An /export file can be imported as is.",
+        "admin_import_in_progress": "⏳ Importing...",
+        "admin_import_done": "✅ Import finished: {imported} rows imported, {errors} errors.",
+        "admin_import_report_caption": "⚠️ Rows that were not imported",
+        "broadcast_manual_caption": "📘 The instruction manual has been updated - here is the new version.",
+        "admin_broadcast_usage": "Broadcast to users:\n/broadcast [ru|en|es] [active] - in reply to the message to send (text, photo, document, video)\n/broadcast manual [ru|en|es] [active] - the instruction manual in each user's language\nru|en|es - only users with this language, active - only users with an active subscription\n/broadcast status - recent broadcasts\n/broadcast cancel <id> - stop a broadcast",
+        "admin_broadcast_confirm": "📣 Broadcast #{id}: {total} recipients ({audience}). Start?",
+        "admin_broadcast_button_start": "▶️ Start",
+        "admin_broadcast_button_cancel": "✖️ Cancel",
+        "admin_broadcast_audience_all": "all users",
+        "admin_broadcast_audience_language": "language {language}",
+        "admin_broadcast_audience_active": "active subscription",
+        "admin_broadcast_started": "📣 Broadcast #{id} started: {total} recipients.",
+        "admin_broadcast_progress": "📣 Broadcast #{id}: {done}/{total}\n✅ {sent} ❌ {failed} 🚫 {blocked}\n⚡ {rate:.1f} msg/s, ~{eta:.0f} min left",
+        "admin_broadcast_done": "✅ Broadcast #{id} finished: {done}/{total}\n✅ {sent} ❌ {failed} 🚫 {blocked}",
+        "admin_broadcast_cancelled": "✖️ Broadcast #{id} cancelled: {done}/{total}\n✅ {sent} ❌ {failed} 🚫 {blocked}",
+        "admin_broadcast_failed": "⛔️ Broadcast #{id} stopped: messages are not being delivered ({failed} errors). Check the message and send it again.",
+        "admin_broadcast_cancel_ok": "✖️ Broadcast #{id} cancelled.",
+        "admin_broadcast_not_found": "Broadcast #{id} not found or already finished.",
+        "admin_broadcast_status_empty": "No broadcasts yet.",
+        "admin_broadcast_status_line": "#{id} {created_at} [{status}] {audience}: {done}/{total} (✅ {sent} ❌ {failed} 🚫 {blocked})",
+        "admin_forecast_usage": "Usage: /forecast [days 1-{max_days}] - reminder forecast\n/forecast dry - dry run of today's check",
+        "admin_forecast_title": "📈 Reminder forecast for {days} days (if nobody renews):",
+        "admin_forecast_limits": "Limits: {rate:g} msg/s total, {chat_rate:g} msg/s per chat, delivery window {start}:00-{end}:00",
+        "admin_forecast_line": "  {day}: ⚠️ {warnings} ❌ {expired} 👮 {admin} → ~{minutes:.1f} min",
+        "admin_forecast_over_window": " ⏰ longer than the window",
+        "admin_forecast_dry_run": "🧪 Dry run of today's check: warnings *{warning}*, expired *{expired}*, active subscriptions *{active}*. Nothing was sent or saved.",
         "admin_show_history": "📜 Show Payment History",
         "admin_back_to_list": "⬅️ Back to List",
         "admin_back_to_main": "⬅️ Back to Main Menu",
         "admin_history_title": "📜 Payment History for {tw_username}",
         "admin_payment_entry": "➡️ Payment #{i}\n📅 Date: {date}\n💰 Amount: {amount} USDT\n🔗 Hash: `{hash}`\n⏳ End Date: {end_date}\n👤 Paid by: @{tg_username} (ID: `{user_id}`)\n",
          "admin_back_to_account": "⬅️ Back to Account Info",
+        "admin_db_stats": "🐢 DB Query Stats",
+        "admin_db_stats_title": "🐢 Top DB queries by total time (slow threshold: {threshold} ms)",
+        "admin_db_stats_empty": "No queries recorded yet.",
+        "admin_db_stats_entry": "#{i} total {total:.0f} ms | {count}x | avg {avg:.1f} | p95 {p95:.1f} | max {max:.1f} | slow {slow}{scan}\n{sql}\n",
+        "admin_last_backup": "💾 Last backup {started_at}: {status}",
+        "admin_handler_load": "⚙️ Handlers: {running}/{limit} running, {waiting} waiting ({waiting_priority} payments), {admitted} processed, {queued} queued, {shed} shed, max wait {max_wait:.1f} s",
+        "admin_throttle_stats": "🚦 Anti-flood: {dropped} updates dropped, {tracked} counters in memory",
 
     },
     "ru": {
@@ -171,6 +361,9 @@ TEXTS = {
         "subscription_warning_for": "⚠️ Ваша подписка для аккаунта TradingView **{tw_username}** истечет через {days} дня(ей) {date}.",
         "generic_subscription_expired": "Ваша подписка истекла.",
         "generic_subscription_warning": "Ваша подписка истечет через {days} дня(ей) {date}.",
+        "timezone_current": "🕒 Ваш часовой пояс: `{timezone}`\nНапоминания приходят с {start}:00 до {end}:00 по вашему времени.\n\nЧтобы изменить, отправьте `/timezone Регион/Город` (например `/timezone Europe/Moscow`) или `/timezone auto`.",
+        "timezone_set": "✅ Часовой пояс установлен: `{timezone}`",
+        "timezone_invalid": "⚠️ Неизвестный часовой пояс. Используйте формат Регион/Город, например `Europe/Moscow`.",
         "support": f"Для получения помощи, пожалуйста, обратитесь к @{ADMIN_USERNAME}",
         "paid_button": "✅ Оплатил",
         "help_button": "🆘 Помощь",
@@ -183,11 +376,14 @@ TEXTS = {
         "confirm_yes": "✅ Все верно",
         "confirm_no": "✏️ Изменить",
         "error_occurred": "Произошла ошибка. Пожалуйста, попробуйте позже или обратитесь в поддержку.",
+        "overloaded": "⏳ Бот сейчас перегружен. Пожалуйста, повторите через минуту.",
+        "throttled": "🐢 Слишком много запросов. Пожалуйста, подождите минуту.",
         "duplicate_hash": "Этот хэш транзакции уже был использован. Если вы считаете, что это ошибка, обратитесь в поддержку.",
         "admin_panel_title": "Добро пожаловать в админ-панель!",
         "admin_list_tw_accounts": "📋 Список аккаунтов TradingView",
         "admin_client_info_title": "👤 Инфо об аккаунте: {tw_username}",
         "admin_no_payments": "⚠️ Платежи для этого аккаунта TradingView не найдены.",
+        "admin_button_outdated": "Кнопка устарела. Откройте список аккаунтов заново.",
         "admin_associated_tg": "👤 Связанный пользователь Telegram",
         "admin_active_subscription": "✅ Активная подписка до",
         "admin_no_active_subscription": "❌ Нет активной подписки",
@@ -197,12 +393,67 @@ TEXTS = {
         "admin_payment_amount": "💰 Сумма",
         "admin_payment_date": "📅 Дата",
         "admin_payment_sub_end": "⏳ Окончание подписки (этот платеж)",
+        "admin_verification_status": "🔎 Проверка в сети",
+        "admin_export_usage": "Использование: /export [с YYYY-MM-DD] [по YYYY-MM-DD] [active] [gz]\nПример: /export 2025-01-01 2025-03-31 gz",
+        "admin_export_in_progress": "⏳ Готовлю выгрузку...",
+        "admin_export_empty": "Нет платежей, подходящих под фильтр.",
+        "admin_export_caption": "📤 Выгрузка платежей: {rows} строк",
+        "admin_search_usage": "Использование: /search <часть ника TradingView или Telegram>",
+        "admin_search_results": "🔎 Результаты по \"{query}\" (страница {page}):",
+        "admin_search_empty": "По запросу \"{query}\" ничего не найдено.",
+        "admin_stats_title": "📊 Статистика",
+        "admin_stats_subscriptions": "👥 Подписки на {day}: активных *{active}*, истекших *{expired}*",
+        "admin_stats_no_snapshot": "👥 Снимка подписок пока нет (делается ежедневной проверкой).",
+        "admin_stats_month": "💰 Текущий месяц по планам:",
+        "admin_stats_days": "📅 Последние {days} дней:",
+        "admin_stats_line": "  {name}: {revenue:.2f} USDT ({count})",
+        "admin_stats_no_data": "  платежей нет",
+        "admin_vacuum_status": "🧹 Файл БД: {size:.0f} МБ, auto_vacuum: {mode}.",
+        "admin_vacuum_enabled": "Свободное место освобождается небольшими порциями в простое бота.",
+        "admin_vacuum_convert_hint": "Перевод в INCREMENTAL требует разового полного VACUUM: запись в БД будет заблокирована примерно на {estimate:.0f} сек (пользователи могут получать ошибки). Запустите /vacuum now в спокойное время.",
+        "admin_vacuum_started": "🧹 Полный VACUUM запущен, ожидается ~{estimate:.0f} сек...",
+        "admin_vacuum_done": "✅ Режим auto_vacuum=INCREMENTAL включен за {elapsed:.1f} сек.",
+        "admin_vacuum_failed": "❌ Ошибка VACUUM: {error}",
+        "admin_import_usage": "Отправьте CSV-файл с подписью /import.\nКолонки: user_id, tw_username и subscription_end (YYYY-MM-DD) или days (продлить на N дней); необязательные: tg_username, language, amount, purchase_date, tx_hash, plan_id. Файл из /export импортируется как есть.",
+        "admin_import_in_progress": "⏳ Импортирую...",
+        "admin_import_done": "✅ Импорт завершен: импортировано {imported} строк, ошибок {errors}.",
+        "admin_import_report_caption": "⚠️ Строки, которые не удалось импортировать",
+        "broadcast_manual_caption": "📘 Инструкция обновилась - вот новая версия.",
+        "admin_broadcast_usage": "Рассылка пользователям:\n/broadcast [ru|en|es] [active] - ответом на сообщение, которое нужно разослать (текст, фото, документ, видео)\n/broadcast manual [ru|en|es] [active] - инструкция на языке каждого пользователя\nru|en|es - только пользователям с этим языком, active - только с действующей подпиской\n/broadcast status - последние рассылки\n/broadcast cancel <id> - остановить рассылку",
+        "admin_broadcast_confirm": "📣 Рассылка #{id}: {total} получателей ({audience}). Начать?",
+        "admin_broadcast_button_start": "▶️ Начать",
+        "admin_broadcast_button_cancel": "✖️ Отменить",
+        "admin_broadcast_audience_all": "все пользователи",
+        "admin_broadcast_audience_language": "язык {language}",
+        "admin_broadcast_audience_active": "с действующей подпиской",
+        "admin_broadcast_started": "📣 Рассылка #{id} запущена: {total} получателей.",
+        "admin_broadcast_progress": "📣 Рассылка #{id}: {done}/{total}\n✅ {sent} ❌ {failed} 🚫 {blocked}\n⚡ {rate:.1f} сообщ./сек, осталось ~{eta:.0f} мин.",
+        "admin_broadcast_done": "✅ Рассылка #{id} завершена: {done}/{total}\n✅ {sent} ❌ {failed} 🚫 {blocked}",
+        "admin_broadcast_cancelled": "✖️ Рассылка #{id} отменена: {done}/{total}\n✅ {sent} ❌ {failed} 🚫 {blocked}",
+        "admin_broadcast_failed": "⛔️ Рассылка #{id} остановлена: сообщения не доставляются ({failed} ошибок). Проверьте сообщение и создайте рассылку заново.",
+        "admin_broadcast_cancel_ok": "✖️ Рассылка #{id} отменена.",
+        "admin_broadcast_not_found": "Рассылка #{id} не найдена или уже завершена.",
+        "admin_broadcast_status_empty": "Рассылок пока не было.",
+        "admin_broadcast_status_line": "#{id} {created_at} [{status}] {audience}: {done}/{total} (✅ {sent} ❌ {failed} 🚫 {blocked})",
+        "admin_forecast_usage": "Использование: /forecast [дней 1-{max_days}] - прогноз напоминаний\n/forecast dry - пробный прогон сегодняшней проверки",
+        "admin_forecast_title": "📈 Прогноз напоминаний на {days} дн. (если никто не продлит):",
+        "admin_forecast_limits": "Лимиты: {rate:g} сообщ./сек всего, {chat_rate:g} сообщ./сек на чат, окно доставки {start}:00-{end}:00",
+        "admin_forecast_line": "  {day}: ⚠️ {warnings} ❌ {expired} 👮 {admin} → ~{minutes:.1f} мин",
+        "admin_forecast_over_window": " ⏰ дольше окна",
+        "admin_forecast_dry_run": "🧪 Пробный прогон сегодняшней проверки: предупреждений *{warning}*, истекших *{expired}*, активных подписок *{active}*. Ничего не отправлено и не сохранено.",
         "admin_show_history": "📜 Показать историю платежей",
         "admin_back_to_list": "⬅️ Назад к списку",
         "admin_back_to_main": "⬅️ Назад в главное меню",
         "admin_history_title": "📜 История платежей для {tw_username}",
         "admin_payment_entry": "➡️ Платеж #{i}\n📅 Дата: {date}\n💰 Сумма: {amount} USDT\n🔗 Hash: `{hash}`\n⏳ Окончание: {end_date}\n👤 Оплатил: @{tg_username} (ID: `{user_id}`)\n",
         "admin_back_to_account": "⬅️ Назад к инфо об аккаунте",
+        "admin_db_stats": "🐢 Статистика запросов к БД",
+        "admin_db_stats_title": "🐢 Самые затратные запросы к БД (порог медленного: {threshold} мс)",
+        "admin_db_stats_empty": "Запросы еще не зафиксированы.",
+        "admin_db_stats_entry": "#{i} всего {total:.0f} мс | {count}x | сред. {avg:.1f} | p95 {p95:.1f} | макс. {max:.1f} | медл. {slow}{scan}\n{sql}\n",
+        "admin_last_backup": "💾 Последний бэкап {started_at}: {status}",
+        "admin_handler_load": "⚙️ Обработчики: выполняется {running}/{limit}, ожидают {waiting} (оплат {waiting_priority}), обработано {admitted}, ждали слота {queued}, отклонено {shed}, макс. ожидание {max_wait:.1f} с",
+        "admin_throttle_stats": "🚦 Анти-флуд: отброшено апдейтов {dropped}, счетчиков в памяти {tracked}",
     },
     "es": {
         "start": "🌎 Elige un idioma:",
@@ -219,6 +470,9 @@ TEXTS = {
         "subscription_warning_for": "⚠️ Tu suscripción para la cuenta de TradingView **{tw_username}** expirará en {days} días el {date}.",
         "generic_subscription_expired": "Su suscripción ha expirado.",
         "generic_subscription_warning": "Su suscripción expirará en {days} días el {date}.",
+        "timezone_current": "🕒 Tu zona horaria: `{timezone}`\nLos recordatorios llegan entre las {start}:00 y las {end}:00 de tu hora local.\n\nPara cambiarla, envía `/timezone Región/Ciudad` (por ejemplo `/timezone America/Bogota`) o `/timezone auto`.",
+        "timezone_set": "✅ Zona horaria establecida: `{timezone}`",
+        "timezone_invalid": "⚠️ Zona horaria desconocida. Usa el formato Región/Ciudad, por ejemplo `America/Bogota`.",
         "support": f"Para asistencia, por favor contacte a @{ADMIN_USERNAME}",
         "paid_button": "✅ Pagado",
         "help_button": "🆘 Soporte",
@@ -231,11 +485,14 @@ TEXTS = {
         "confirm_yes": "✅ Todo correcto",
         "confirm_no": "✏️ Editar",
         "error_occurred": "Ocurrió un error. Por favor, inténtelo de nuevo más tarde o contacte con soporte.",
+        "overloaded": "⏳ El bot está ocupado en este momento. Por favor, inténtelo de nuevo en un minuto.",
+        "throttled": "🐢 Demasiadas solicitudes. Por favor, espere un minuto.",
         "duplicate_hash": "Este hash de transacción ya ha sido utilizado. Si cree que esto es un error, por favor contacte con soporte.",
         "admin_panel_title": "¡Bienvenido al Panel de Administración!",
         "admin_list_tw_accounts": "📋 Lista de Cuentas de TradingView",
         "admin_client_info_title": "👤 Info de Cuenta: {tw_username}",
         "admin_no_payments": "⚠️ No se encontraron pagos para esta cuenta de TradingView.",
+        "admin_button_outdated": "Este botón está desactualizado. Abre la lista de cuentas de nuevo.",
         "admin_associated_tg": "👤 Usuario de Telegram Asociado",
         "admin_active_subscription": "✅ Suscripción Activa Hasta",
         "admin_no_active_subscription": "❌ Sin Suscripción Activa",
@@ -245,12 +502,67 @@ TEXTS = {
         "admin_payment_amount": "💰 Cantidad",
         "admin_payment_date": "📅 Fecha",
         "admin_payment_sub_end": "⏳ Fin de Suscripción (este pago)",
+        "admin_verification_status": "🔎 Verificación en red",
+        "admin_export_usage": "Uso: /export [desde YYYY-MM-DD] [hasta YYYY-MM-DD] [active] [gz]\nEjemplo: /export 2025-01-01 2025-03-31 gz",
+        "admin_export_in_progress": "⏳ Preparando la exportación...",
+        "admin_export_empty": "No hay pagos que coincidan con el filtro.",
+        "admin_export_caption": "📤 Exportación de pagos: {rows} filas",
+        "admin_search_usage": "Uso: /search <parte del usuario de TradingView o Telegram>",
+        "admin_search_results": "🔎 Resultados para \"{query}\" (página {page}):",
+        "admin_search_empty": "No se encontró nada para \"{query}\".",
+        "admin_stats_title": "📊 Estadísticas",
+        "admin_stats_subscriptions": "👥 Suscripciones al {day}: activas *{active}*, expiradas *{expired}*",
+        "admin_stats_no_snapshot": "👥 Aún no hay instantánea de suscripciones (la crea la revisión diaria).",
+        "admin_stats_month": "💰 Este mes por plan:",
+        "admin_stats_days": "📅 Últimos {days} días:",
+        "admin_stats_line": "  {name}: {revenue:.2f} USDT ({count})",
+        "admin_stats_no_data": "  sin pagos",
+        "admin_vacuum_status": "🧹 Archivo de BD: {size:.0f} MB, auto_vacuum: {mode}.",
+        "admin_vacuum_enabled": "El espacio libre se recupera en pequeñas porciones mientras el bot está inactivo.",
+        "admin_vacuum_convert_hint": "Pasar a INCREMENTAL requiere un VACUUM completo único: la escritura en la BD se bloqueará ~{estimate:.0f} s (los usuarios pueden ver errores). Ejecuta /vacuum now en un momento tranquilo.",
+        "admin_vacuum_started": "🧹 VACUUM completo iniciado, se espera ~{estimate:.0f} s...",
+        "admin_vacuum_done": "✅ auto_vacuum=INCREMENTAL activado en {elapsed:.1f} s.",
+        "admin_vacuum_failed": "❌ Error de VACUUM: {error}",
+        "admin_import_usage": "Envía un archivo CSV con el texto /import.\nColumnas: user_id, tw_username y subscription_end (YYYY-MM-DD) o days (extender N días); opcionales: tg_username, language, amount, purchase_date, tx_hash, plan_id. Un archivo de /export se importa tal cual.",
+        "admin_import_in_progress": "⏳ Importando...",
+        "admin_import_done": "✅ Importación terminada: {imported} filas importadas, {errors} errores.",
+        "admin_import_report_caption": "⚠️ Filas que no se importaron",
+        "broadcast_manual_caption": "📘 El manual de instrucciones se ha actualizado: aquí tienes la nueva versión.",
+        "admin_broadcast_usage": "Difusión a usuarios:\n/broadcast [ru|en|es] [active] - en respuesta al mensaje a enviar (texto, foto, documento, video)\n/broadcast manual [ru|en|es] [active] - el manual en el idioma de cada usuario\nru|en|es - solo usuarios con ese idioma, active - solo con suscripción activa\n/broadcast status - difusiones recientes\n/broadcast cancel <id> - detener una difusión",
+        "admin_broadcast_confirm": "📣 Difusión #{id}: {total} destinatarios ({audience}). ¿Empezar?",
+        "admin_broadcast_button_start": "▶️ Empezar",
+        "admin_broadcast_button_cancel": "✖️ Cancelar",
+        "admin_broadcast_audience_all": "todos los usuarios",
+        "admin_broadcast_audience_language": "idioma {language}",
+        "admin_broadcast_audience_active": "suscripción activa",
+        "admin_broadcast_started": "📣 Difusión #{id} iniciada: {total} destinatarios.",
+        "admin_broadcast_progress": "📣 Difusión #{id}: {done}/{total}\n✅ {sent} ❌ {failed} 🚫 {blocked}\n⚡ {rate:.1f} msj/s, quedan ~{eta:.0f} min",
+        "admin_broadcast_done": "✅ Difusión #{id} terminada: {done}/{total}\n✅ {sent} ❌ {failed} 🚫 {blocked}",
+        "admin_broadcast_cancelled": "✖️ Difusión #{id} cancelada: {done}/{total}\n✅ {sent} ❌ {failed} 🚫 {blocked}",
+        "admin_broadcast_failed": "⛔️ Difusión #{id} detenida: los mensajes no se entregan ({failed} errores). Revisa el mensaje y créala de nuevo.",
+        "admin_broadcast_cancel_ok": "✖️ Difusión #{id} cancelada.",
+        "admin_broadcast_not_found": "Difusión #{id} no encontrada o ya terminada.",
+        "admin_broadcast_status_empty": "Todavía no hay difusiones.",
+        "admin_broadcast_status_line": "#{id} {created_at} [{status}] {audience}: {done}/{total} (✅ {sent} ❌ {failed} 🚫 {blocked})",
+        "admin_forecast_usage": "Uso: /forecast [días 1-{max_days}] - pronóstico de recordatorios\n/forecast dry - prueba de la revisión de hoy",
+        "admin_forecast_title": "📈 Pronóstico de recordatorios para {days} días (si nadie renueva):",
+        "admin_forecast_limits": "Límites: {rate:g} msj/s en total, {chat_rate:g} msj/s por chat, ventana de entrega {start}:00-{end}:00",
+        "admin_forecast_line": "  {day}: ⚠️ {warnings} ❌ {expired} 👮 {admin} → ~{minutes:.1f} min",
+        "admin_forecast_over_window": " ⏰ más que la ventana",
+        "admin_forecast_dry_run": "🧪 Prueba de la revisión de hoy: avisos *{warning}*, expiradas *{expired}*, suscripciones activas *{active}*. No se envió ni guardó nada.",
         "admin_show_history": "📜 Mostrar Historial de Pagos",
         "admin_back_to_list": "⬅️ Volver a la Lista",
         "admin_back_to_main": "⬅️ Volver al Menú Principal",
         "admin_history_title": "📜 Historial de Pagos para {tw_username}",
         "admin_payment_entry": "➡️ Pago #{i}\n📅 Fecha: {date}\n💰 Cantidad: {amount} USDT\n🔗 Hash: `{hash}`\n⏳ Fin: {end_date}\n👤 Pagado por: @{tg_username} (ID: `{user_id}`)\n",
         "admin_back_to_account": "⬅️ Volver a Info de Cuenta",
+        "admin_db_stats": "🐢 Estadísticas de Consultas BD",
+        "admin_db_stats_title": "🐢 Consultas BD más costosas (umbral lento: {threshold} ms)",
+        "admin_db_stats_empty": "Aún no hay consultas registradas.",
+        "admin_db_stats_entry": "#{i} total {total:.0f} ms | {count}x | media {avg:.1f} | p95 {p95:.1f} | máx {max:.1f} | lentas {slow}{scan}\n{sql}\n",
+        "admin_last_backup": "💾 Última copia {started_at}: {status}",
+        "admin_handler_load": "⚙️ Manejadores: {running}/{limit} en ejecución, {waiting} en espera ({waiting_priority} pagos), {admitted} procesados, {queued} en cola, {shed} rechazados, espera máx. {max_wait:.1f} s",
+        "admin_throttle_stats": "🚦 Anti-flood: {dropped} actualizaciones descartadas, {tracked} contadores en memoria",
     }
 }
 
@@ -324,11 +636,19 @@ def plans_keyboard(lang):
         buttons.append([InlineKeyboardButton(text=button_text, callback_data=f"plan_{plan_id}")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+def admin_main_keyboard(lang):
+    """Главное меню админ-панели."""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=get_text("admin_list_tw_accounts", lang), callback_data="list_tw_accounts")],
+        [InlineKeyboardButton(text=get_text("admin_db_stats", lang), callback_data="admin_db_stats")]
+    ])
+
 # --- Сохранение пользователя и платежа ---
 # (save_user_and_payment - остается без изменений)
-async def save_user_and_payment(user_id, username, tw_username, tx_hash, amount, purchase_date, subscription_end, language):
+async def save_user_and_payment(user_id, username, tw_username, tx_hash, amount, purchase_date, subscription_end, language,
+                                plan_id=None):
     """Сохраняет пользователя и информацию о конкретном платеже."""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
+    async with connect_db() as db:
         # 1. Сохраняем/обновляем пользователя (включая язык)
         await db.execute('''
             INSERT INTO users (user_id, username, language)
@@ -339,11 +659,20 @@ async def save_user_and_payment(user_id, username, tw_username, tx_hash, amount,
         ''', (user_id, username, language))
 
         # 2. Сохраняем платеж
-        await save_payment_db(db, user_id, tw_username, tx_hash, amount, purchase_date, subscription_end)
+        await save_payment_db(db, user_id, tw_username, tx_hash, amount, purchase_date, subscription_end, plan_id)
+
+        # 3. Уведомление админам через outbox - в той же транзакции, что и платеж
+        await enqueue_new_payment_notification(
+            db, user_id, username, tw_username, tx_hash, amount, purchase_date, subscription_end
+        )
 
-        # 3. Коммитим транзакцию
+        # 4. Коммитим транзакцию
         await db.commit()
         logging.info(f"Платеж и пользователь user_id {user_id} для TW {tw_username} успешно сохранены.")
+    # 5. Обновляем индексы известных хешей и окончаний подписок (после коммита, чтобы не "запомнить" откатившийся платеж)
+    tx_hash_index.add(tx_hash)
+    expiry_index.update(user_id, tw_username, subscription_end)
+    wake_outbox_sender()
 
 # ========== ОБРАБОТЧИКИ КОМАНД ==========
 
@@ -355,7 +684,7 @@ async def start_cmd(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     username = message.from_user.username or f"id_{user_id}"
 
-    async with aiosqlite.connect(DATABASE_FILE) as db:
+    async with connect_db() as db:
         await db.execute('''
             INSERT INTO users (user_id, username, language) VALUES (?, ?, 'en')
             ON CONFLICT(user_id) DO UPDATE SET username=excluded.username
@@ -377,7 +706,7 @@ async def set_language(callback: types.CallbackQuery, state: FSMContext):
     user_languages[user_id] = lang
     await state.update_data(language=lang)
 
-    async with aiosqlite.connect(DATABASE_FILE) as db:
+    async with connect_db() as db:
         await db.execute('UPDATE users SET language = ? WHERE user_id = ?', (lang, user_id))
         await db.commit()
 
@@ -388,6 +717,29 @@ async def set_language(callback: types.CallbackQuery, state: FSMContext):
         logging.warning(f"Не удалось удалить сообщение выбора языка: {e}")
     await callback.answer()
 
+# --- Часовой пояс для напоминаний о подписке ---
+@dp.message(Command("timezone"))
+async def timezone_cmd(message: types.Message, state: FSMContext):
+    user_id = message.from_user.id
+    lang = await get_lang(user_id, state)
+    args = message.text.split(maxsplit=1)
+    if len(args) > 1:
+        timezone = args[1].strip()
+        if timezone.lower() == "auto":
+            timezone = None # Определять по языку
+        elif resolve_timezone(timezone, None).key != timezone:
+            await message.answer(get_text("timezone_invalid", lang), parse_mode="Markdown")
+            return
+        await set_user_timezone(user_id, timezone)
+        await message.answer(get_text("timezone_set", lang).format(timezone=resolve_timezone(timezone, lang).key),
+                             parse_mode="Markdown")
+        return
+    timezone = resolve_timezone(await get_user_timezone(user_id), lang).key
+    await message.answer(
+        get_text("timezone_current", lang).format(timezone=timezone, start=REMINDER_WINDOW_START, end=REMINDER_WINDOW_END),
+        parse_mode="Markdown"
+    )
+
 # --- Обработчик кнопки "Инструкция" (ИЗМЕНЕН с кешированием file_id) ---
 @dp.message(lambda message: message.text in [
     TEXTS["en"]["main_menu"][0], TEXTS["ru"]["main_menu"][0], TEXTS["es"]["main_menu"][0]
@@ -404,7 +756,8 @@ async def send_instruction(message: types.Message, state: FSMContext):
 
     if cached_file_id:
         # --- Используем кешированный file_id ---
-        logging.info(f"Используем кеш file_id для '{instruction_filename}' (user: {user_id})")
+        logging.info("Используем кеш file_id для '%s' (user: %s)", instruction_filename, user_id,
+                     extra={"sample": "instruction_cache_hit"})
         try:
             await bot.send_document(
                 chat_id=user_id,
@@ -600,6 +953,13 @@ async def process_hash(message: types.Message, state: FSMContext):
         await message.answer(get_text("enter_hash", lang))
         return
 
+    # Ранняя проверка на повтор хеша: в обычном случае отвечает Bloom-фильтр без обращения к диску
+    if await tx_hash_index.contains(tx_hash):
+        lang = await get_lang(user_id, state)
+        logging.warning(f"Повторный хеш '{tx_hash}' от user_id {user_id} отклонен до подтверждения.")
+        await message.answer(get_text("duplicate_hash", lang))
+        return # Остаемся в состоянии ожидания хеша
+
     await state.update_data(tx_hash=tx_hash)
     data = await state.get_data()
     tw_username = data.get("tw_username")
@@ -636,6 +996,7 @@ async def confirm_payment(callback: types.CallbackQuery, state: FSMContext):
     tx_hash = data.get("tx_hash")
     amount = data.get("amount")
     days = data.get("days")
+    plan_id = data.get("plan_id")
     lang = await get_lang(user_id, state)
 
     if not all([tw_username, tx_hash, amount, days]):
@@ -657,7 +1018,8 @@ async def confirm_payment(callback: types.CallbackQuery, state: FSMContext):
             amount=amount,
             purchase_date=purchase_date,
             subscription_end=subscription_end,
-            language=lang # Передаем язык для сохранения в профиле пользователя
+            language=lang, # Передаем язык для сохранения в профиле пользователя
+            plan_id=plan_id
         )
 
         await callback.message.edit_text(
@@ -665,16 +1027,14 @@ async def confirm_payment(callback: types.CallbackQuery, state: FSMContext):
              parse_mode="Markdown"
         )
 
-        # Уведомление админов
-        await notify_admins_about_new_payment(
-            bot, user_id, tw_username, tx_hash, amount, purchase_date, subscription_end
-        )
+        # Проверка транзакции в сети идет в фоне, пользователь ее не ждет
+        tron_verifier.wakeup()
 
     except aiosqlite.IntegrityError:
          logging.warning(f"Попытка дубликата платежа с хешем: {tx_hash} от user_id {user_id}")
          await callback.message.edit_text(get_text("duplicate_hash", lang))
     except Exception as e:
-        logging.exception(f"Ошибка при сохранении платежа или отправке уведомления для user_id {user_id}: {e}")
+        logging.exception(f"Ошибка при сохранении платежа для user_id {user_id}: {e}")
         await callback.message.edit_text(get_text("error_occurred", lang))
     finally:
         await state.clear() # Очищаем состояние в любом случае после попытки
@@ -709,11 +1069,7 @@ async def admin_panel(message: types.Message):
     user_id = message.from_user.id
     if user_id in ADMIN_IDS:
         lang = await get_lang(user_id) # Используем язык админа, если он выбирал
-        await message.answer(
-            get_text("admin_panel_title", lang),
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text=get_text("admin_list_tw_accounts", lang), callback_data="list_tw_accounts")]
-            ]))
+        await message.answer(get_text("admin_panel_title", lang), reply_markup=admin_main_keyboard(lang))
     else:
         lang = await get_lang(user_id)
         await message.answer(get_text("admin_access_denied", lang))
@@ -728,7 +1084,7 @@ async def list_tw_accounts(callback: types.CallbackQuery):
     lang = await get_lang(user_id)
 
     accounts = await get_distinct_tw_usernames_with_users()
-    # accounts: список кортежей [(tw_username, tg_user_id, tg_username)]
+    # accounts: список кортежей [(account_id, tw_username, tg_user_id, tg_username)]
 
     if not accounts:
         await callback.message.edit_text(get_text("no_tw_accounts", lang))
@@ -736,7 +1092,7 @@ async def list_tw_accounts(callback: types.CallbackQuery):
         return
 
     buttons = []
-    for tw_user, tg_id, tg_user in accounts:
+    for account_id, tw_user, tg_id, tg_user in accounts:
         btn_text = f"{tw_user}"
         if tg_user:
             btn_text += f" (@{tg_user})"
@@ -745,8 +1101,8 @@ async def list_tw_accounts(callback: types.CallbackQuery):
 
         buttons.append([InlineKeyboardButton(
             text=btn_text,
-            # В callback передаем только tw_username, т.к. он ключ для след. шага
-            callback_data=f"client_{tw_user}"
+            # В callback - только компактный id аккаунта: ник может не влезть в 64 байта callback_data
+            callback_data=f"client_{account_id}"
         )])
 
     buttons.append([InlineKeyboardButton(text=get_text("admin_back_to_main", lang), callback_data="admin_back_to_main")])
@@ -757,6 +1113,11 @@ async def list_tw_accounts(callback: types.CallbackQuery):
     )
     await callback.answer()
 
+def parse_account_id(data: str):
+    """id аккаунта из callback_data вида client_<id>/history_<id>. None - старая кнопка с ником вместо id."""
+    value = data.split("_", 1)[1]
+    return int(value) if value.isdigit() else None
+
 # Показ информации о конкретном аккаунте TradingView
 @dp.callback_query(lambda c: c.data.startswith("client_"))
 async def client_info(callback: types.CallbackQuery):
@@ -766,10 +1127,13 @@ async def client_info(callback: types.CallbackQuery):
         return
     lang = await get_lang(user_id)
 
-    tw_username = callback.data.split("_", 1)[1] # Получаем tw_username
+    account_id = parse_account_id(callback.data)
+    if account_id is None:
+        await callback.answer(get_text("admin_button_outdated", lang), show_alert=True)
+        return
     # Получаем все платежи для этого TW аккаунта, отсортированные по дате (новые первые)
-    payments = await get_payments_for_tw_account(tw_username)
-    # payments: список кортежей [(id, user_id, tw_username, tx_hash, amount, purchase_date, subscription_end, tg_username)]
+    payments = await get_payments_for_tw_account(account_id)
+    # payments: список кортежей [(id, user_id, tw_username, tx_hash, amount, purchase_date, subscription_end, tg_username, verification_status)]
 
     if not payments:
         await callback.message.edit_text(get_text("admin_no_payments", lang))
@@ -778,6 +1142,7 @@ async def client_info(callback: types.CallbackQuery):
 
     # Берем данные из самого последнего платежа для основной информации
     last_payment = payments[0]
+    tw_username = last_payment[2]
     tg_user_id = last_payment[1]
     tg_username_display = last_payment[7] if last_payment[7] else f"`{tg_user_id}`" # Отображаем ID если нет ника
 
@@ -802,13 +1167,14 @@ async def client_info(callback: types.CallbackQuery):
                    f"{get_text('admin_payment_hash', lang)}: `{last_payment[3]}`\n" \
                    f"{get_text('admin_payment_amount', lang)}: {last_payment[4]} USDT\n" \
                    f"{get_text('admin_payment_date', lang)}: {last_payment[5]}\n" \
-                   f"{get_text('admin_payment_sub_end', lang)}: {last_payment[6]}"
+                   f"{get_text('admin_payment_sub_end', lang)}: {last_payment[6]}\n" \
+                   f"{get_text('admin_verification_status', lang)}: {last_payment[8]}"
 
     # Кнопки
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(
             text=get_text("admin_show_history", lang),
-            callback_data=f"history_{tw_username}"
+            callback_data=f"history_{account_id}"
         )],
         [InlineKeyboardButton(text=get_text("admin_back_to_list", lang), callback_data="list_tw_accounts")]
     ])
@@ -825,8 +1191,11 @@ async def payment_history(callback: types.CallbackQuery):
         return
     lang = await get_lang(user_id)
 
-    tw_username = callback.data.split("_", 1)[1]
-    payments = await get_payments_for_tw_account(tw_username) # Запрос тот же
+    account_id = parse_account_id(callback.data)
+    if account_id is None:
+        await callback.answer(get_text("admin_button_outdated", lang), show_alert=True)
+        return
+    payments = await get_payments_for_tw_account(account_id) # Запрос тот же
 
     if not payments:
         # Это не должно произойти, если мы пришли с экрана client_info, но на всякий случай
@@ -834,6 +1203,7 @@ async def payment_history(callback: types.CallbackQuery):
         await callback.answer()
         return
 
+    tw_username = payments[0][2]
     message_text = f"{get_text('admin_history_title', lang).format(tw_username=tw_username)}\n\n"
 
     for i, p in enumerate(payments, 1):
@@ -851,7 +1221,7 @@ async def payment_history(callback: types.CallbackQuery):
 
     # Кнопка Назад к информации об аккаунте
     kb = InlineKeyboardMarkup(inline_keyboard=[
-         [InlineKeyboardButton(text=get_text("admin_back_to_account", lang), callback_data=f"client_{tw_username}")]
+         [InlineKeyboardButton(text=get_text("admin_back_to_account", lang), callback_data=f"client_{account_id}")]
     ])
 
     try:
@@ -871,6 +1241,365 @@ async def payment_history(callback: types.CallbackQuery):
 
     await callback.answer()
 
+# Поиск аккаунта по нику TradingView/Telegram: /search <запрос>
+async def build_search_page(query: str, page: int, lang: str):
+    """Текст и клавиатура страницы результатов поиска (кнопки ведут на client_info)."""
+    # Берем на одну запись больше, чтобы понять, есть ли следующая страница
+    results = await search_tw_accounts(query, SEARCH_PAGE_SIZE + 1, page * SEARCH_PAGE_SIZE)
+    if not results:
+        return get_text("admin_search_empty", lang).format(query=query), None
+
+    buttons = []
+    for account_id, tw_user, tg_user in results[:SEARCH_PAGE_SIZE]:
+        btn_text = f"{tw_user} (@{tg_user})" if tg_user else tw_user
+        buttons.append([InlineKeyboardButton(text=btn_text, callback_data=f"client_{account_id}")])
+
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="⬅️", callback_data=f"search_page_{page - 1}"))
+    if len(results) > SEARCH_PAGE_SIZE:
+        nav.append(InlineKeyboardButton(text="➡️", callback_data=f"search_page_{page + 1}"))
+    if nav:
+        buttons.append(nav)
+
+    text = get_text("admin_search_results", lang).format(query=query, page=page + 1)
+    return text, InlineKeyboardMarkup(inline_keyboard=buttons)
+
+@dp.message(Command("search"))
+async def search_accounts(message: types.Message):
+    user_id = message.from_user.id
+    lang = await get_lang(user_id)
+    if user_id not in ADMIN_IDS:
+        await message.answer(get_text("admin_access_denied", lang))
+        return
+
+    parts = message.text.split(maxsplit=1)
+    # "@" перед ником не часть запроса: "/search @" - тот же пустой запрос
+    query = parts[1].strip().lstrip("@").strip() if len(parts) > 1 else ""
+    if not query:
+        await message.answer(get_text("admin_search_usage", lang))
+        return
+
+    admin_search_queries[user_id] = query
+    text, kb = await build_search_page(query, 0, lang)
+    await message.answer(text, reply_markup=kb)
+
+@dp.callback_query(lambda c: c.data.startswith("search_page_"))
+async def search_accounts_page(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    if user_id not in ADMIN_IDS:
+        await callback.answer("Доступ запрещен.", show_alert=True)
+        return
+    lang = await get_lang(user_id)
+
+    query = admin_search_queries.get(user_id)
+    if not query:
+        # Запрос потерян (например, после перезапуска бота)
+        await callback.answer(get_text("admin_search_usage", lang), show_alert=True)
+        return
+    page = int(callback.data.rsplit("_", 1)[1])
+    text, kb = await build_search_page(query, page, lang)
+    await callback.message.edit_text(text, reply_markup=kb)
+    await callback.answer()
+
+# Сводная статистика: читает только сводные таблицы, стоимость O(дней), а не O(платежей)
+STATS_DAYS = 7
+
+@dp.message(Command("stats"))
+async def stats_cmd(message: types.Message):
+    user_id = message.from_user.id
+    lang = await get_lang(user_id)
+    if user_id not in ADMIN_IDS:
+        await message.answer(get_text("admin_access_denied", lang))
+        return
+
+    today = datetime.now().date()
+    today_str = today.strftime("%Y-%m-%d")
+    month_start = today.replace(day=1).strftime("%Y-%m-%d")
+    days_from = (today - timedelta(days=STATS_DAYS - 1)).strftime("%Y-%m-%d")
+
+    snapshot = await get_latest_subscription_snapshot()
+    by_plan = await get_revenue_by_plan(month_start, today_str)
+    by_day = await get_revenue_by_day(days_from, today_str)
+
+    lines = [f"*{get_text('admin_stats_title', lang)}*", ""]
+    if snapshot:
+        lines.append(get_text("admin_stats_subscriptions", lang).format(day=snapshot[0], active=snapshot[1], expired=snapshot[2]))
+    else:
+        lines.append(get_text("admin_stats_no_snapshot", lang))
+
+    lines += ["", get_text("admin_stats_month", lang)]
+    for plan_id, revenue, count in by_plan:
+        plan_name = PLANS.get(plan_id, {}).get(f"name_{lang}", plan_id)
+        lines.append(get_text("admin_stats_line", lang).format(name=plan_name, revenue=revenue, count=count))
+    if not by_plan:
+        lines.append(get_text("admin_stats_no_data", lang))
+
+    lines += ["", get_text("admin_stats_days", lang).format(days=STATS_DAYS)]
+    for day, revenue, count in by_day:
+        lines.append(get_text("admin_stats_line", lang).format(name=day, revenue=revenue, count=count))
+    if not by_day:
+        lines.append(get_text("admin_stats_no_data", lang))
+
+    await message.answer("\n".join(lines), parse_mode="Markdown")
+
+# Режим auto_vacuum: /vacuum - состояние и оценка, /vacuum now - разовый перевод в INCREMENTAL (archive.py)
+AUTO_VACUUM_MODES = {0: "NONE", 1: "FULL", 2: "INCREMENTAL"}
+
+@dp.message(Command("vacuum"))
+async def vacuum_cmd(message: types.Message):
+    user_id = message.from_user.id
+    lang = await get_lang(user_id)
+    if user_id not in ADMIN_IDS:
+        await message.answer(get_text("admin_access_denied", lang))
+        return
+
+    mode, size_mb, estimate = await get_auto_vacuum_status()
+    lines = [get_text("admin_vacuum_status", lang).format(size=size_mb, mode=AUTO_VACUUM_MODES.get(mode, mode))]
+    if mode == 2:
+        lines.append(get_text("admin_vacuum_enabled", lang))
+    elif message.text.split()[1:2] == ["now"]:
+        await message.answer(get_text("admin_vacuum_started", lang).format(estimate=estimate))
+        try:
+            elapsed = await convert_to_incremental_auto_vacuum()
+        except Exception as e:
+            logging.exception("Ошибка перевода БД в auto_vacuum=INCREMENTAL: %s", e)
+            await message.answer(get_text("admin_vacuum_failed", lang).format(error=e))
+            return
+        lines = [get_text("admin_vacuum_done", lang).format(elapsed=elapsed)]
+    else:
+        lines.append(get_text("admin_vacuum_convert_hint", lang).format(estimate=estimate))
+    await message.answer("\n".join(lines))
+
+# Прогноз нагрузки рассылки: /forecast [дней] или /forecast dry (пробный прогон проверки подписок)
+FORECAST_DEFAULT_DAYS = 7
+FORECAST_MAX_DAYS = 60
+
+@dp.message(Command("forecast"))
+async def forecast_cmd(message: types.Message):
+    user_id = message.from_user.id
+    lang = await get_lang(user_id)
+    if user_id not in ADMIN_IDS:
+        await message.answer(get_text("admin_access_denied", lang))
+        return
+
+    args = message.text.split()[1:]
+    if args and args[0].lower() == "dry":
+        result = await check_subscriptions(bot, TEXTS, dry_run=True)
+        await message.answer(get_text("admin_forecast_dry_run", lang).format(**result), parse_mode="Markdown")
+        return
+    try:
+        days = int(args[0]) if args else FORECAST_DEFAULT_DAYS
+    except ValueError:
+        days = 0
+    if not 1 <= days <= FORECAST_MAX_DAYS:
+        await message.answer(get_text("admin_forecast_usage", lang).format(max_days=FORECAST_MAX_DAYS))
+        return
+
+    window_seconds = (REMINDER_WINDOW_END - REMINDER_WINDOW_START) * 3600
+    lines = [
+        get_text("admin_forecast_title", lang).format(days=days),
+        get_text("admin_forecast_limits", lang).format(rate=GLOBAL_RATE, chat_rate=CHAT_RATE,
+                                                       start=REMINDER_WINDOW_START, end=REMINDER_WINDOW_END),
+        "",
+    ]
+    for day, warnings, expired, admin_messages, seconds in await forecast_notifications(days):
+        line = get_text("admin_forecast_line", lang).format(day=day, warnings=warnings, expired=expired,
+                                                            admin=admin_messages, minutes=seconds / 60)
+        if seconds > window_seconds:
+            line += get_text("admin_forecast_over_window", lang)
+        lines.append(line)
+    await message.answer("\n".join(lines))
+
+# Выгрузка платежей в CSV: /export [с] [по] [active] [gz]
+@dp.message(Command("export"))
+async def export_payments(message: types.Message):
+    user_id = message.from_user.id
+    lang = await get_lang(user_id)
+    if user_id not in ADMIN_IDS:
+        await message.answer(get_text("admin_access_denied", lang))
+        return
+
+    dates = []
+    active_only = False
+    compress = False
+    for arg in message.text.split()[1:]:
+        if arg.lower() == "active":
+            active_only = True
+        elif arg.lower() == "gz":
+            compress = True
+        else:
+            try:
+                dates.append(datetime.strptime(arg, "%Y-%m-%d").strftime("%Y-%m-%d"))
+            except ValueError:
+                dates = None
+                break
+    if dates is None or len(dates) > 2:
+        await message.answer(get_text("admin_export_usage", lang))
+        return
+    date_from = dates[0] if dates else None
+    date_to = dates[1] if len(dates) > 1 else None
+
+    await message.answer(get_text("admin_export_in_progress", lang))
+    filename = f"payments_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv" + (".gz" if compress else "")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, filename)
+        try:
+            rows = await export_payments_csv(path, date_from, date_to, active_only, compress)
+            if not rows:
+                await message.answer(get_text("admin_export_empty", lang))
+                return
+            await bot.send_chat_action(chat_id=user_id, action=ChatAction.UPLOAD_DOCUMENT)
+            await bot.send_document(
+                chat_id=user_id,
+                document=FSInputFile(path, filename=filename),
+                caption=get_text("admin_export_caption", lang).format(rows=rows)
+            )
+        except Exception as e:
+            logging.exception(f"Ошибка выгрузки платежей для админа {user_id}: {e}")
+            await message.answer(get_text("error_occurred", lang))
+
+# Массовое начисление/продление подписок: CSV-файл с подписью /import
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024 # Лимит скачивания файлов Bot API
+
+@dp.message(Command("import"))
+async def import_payments(message: types.Message):
+    user_id = message.from_user.id
+    lang = await get_lang(user_id)
+    if user_id not in ADMIN_IDS:
+        await message.answer(get_text("admin_access_denied", lang))
+        return
+    document = message.document
+    if document is None or (document.file_size or 0) > IMPORT_MAX_FILE_SIZE:
+        await message.answer(get_text("admin_import_usage", lang))
+        return
+
+    await message.answer(get_text("admin_import_in_progress", lang))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "import.csv")
+        try:
+            await bot.download(document, destination=path)
+            # Сам импорт - тоже обрабатываемый апдейт, уступаем только остальным
+            imported, errors = await import_payments_csv(path, is_busy=lambda: inflight_updates > 1)
+            await message.answer(get_text("admin_import_done", lang).format(imported=imported, errors=len(errors)))
+            if errors:
+                report_path = os.path.join(tmp_dir, "import_errors.csv")
+                await write_import_report(report_path, errors)
+                await bot.send_document(
+                    chat_id=user_id,
+                    document=FSInputFile(report_path, filename="import_errors.csv"),
+                    caption=get_text("admin_import_report_caption", lang)
+                )
+        except Exception as e:
+            logging.exception(f"Ошибка импорта платежей для админа {user_id}: {e}")
+            await message.answer(get_text("error_occurred", lang))
+
+# Рассылка пользователям: /broadcast [manual] [ru|en|es] [active] (ответом на сообщение), status, cancel <id>
+BROADCAST_LANGUAGES = ("en", "ru", "es")
+BROADCAST_STATUS_LIMIT = 10
+
+def broadcast_audience(language: str, active_on: str, lang: str) -> str:
+    """Описание получателей рассылки для админа."""
+    parts = []
+    if language:
+        parts.append(get_text("admin_broadcast_audience_language", lang).format(language=language))
+    if active_on:
+        parts.append(get_text("admin_broadcast_audience_active", lang))
+    return ", ".join(parts) or get_text("admin_broadcast_audience_all", lang)
+
+def remember_instruction_file_id(path: str, file_id: str):
+    """file_id инструкции, загруженной рассылкой, - в общий кеш file_id (его же использует send_instruction)."""
+    instruction_file_ids[os.path.basename(path)] = file_id
+    save_cache()
+
+def manual_broadcast_content() -> dict:
+    """Рассылка инструкции: каждому пользователю - файл на его языке, по кешированному file_id, если он есть."""
+    variants = {}
+    for lang in BROADCAST_LANGUAGES:
+        filename = INSTRUCTION_FILES.get(lang, DEFAULT_INSTRUCTION_FILE)
+        path = os.path.join(MEDIA_DIR, filename)
+        file_id = instruction_file_ids.get(filename)
+        if file_id or os.path.exists(path):
+            variants[lang] = {"type": "document", "file": path, "file_id": file_id,
+                              "text": html.escape(get_text("broadcast_manual_caption", lang))}
+    return {"variants": variants}
+
+@dp.message(Command("broadcast"))
+async def broadcast_cmd(message: types.Message):
+    user_id = message.from_user.id
+    lang = await get_lang(user_id)
+    if user_id not in ADMIN_IDS:
+        await message.answer(get_text("admin_access_denied", lang))
+        return
+
+    args = [arg.lower() for arg in (message.text or message.caption or "").split()[1:]]
+    if args[:1] == ["status"]:
+        lines = []
+        for (broadcast_id, created_at, status, language, active_on, total, sent, failed,
+             blocked) in await get_recent_broadcasts(BROADCAST_STATUS_LIMIT):
+            lines.append(get_text("admin_broadcast_status_line", lang).format(
+                id=broadcast_id, created_at=created_at, status=status,
+                audience=broadcast_audience(language, active_on, lang), done=sent + failed + blocked,
+                total=total, sent=sent, failed=failed, blocked=blocked
+            ))
+        await message.answer("\n".join(lines) or get_text("admin_broadcast_status_empty", lang))
+        return
+    if args[:1] == ["cancel"]:
+        broadcast_id = int(args[1]) if len(args) == 2 and args[1].isdigit() else None
+        if broadcast_id is None:
+            await message.answer(get_text("admin_broadcast_usage", lang))
+        elif await cancel_broadcast(broadcast_id):
+            await message.answer(get_text("admin_broadcast_cancel_ok", lang).format(id=broadcast_id))
+        else:
+            await message.answer(get_text("admin_broadcast_not_found", lang).format(id=broadcast_id))
+        return
+
+    language = next((arg for arg in args if arg in BROADCAST_LANGUAGES), None)
+    active_on = datetime.now().strftime("%Y-%m-%d") if "active" in args else None
+    if "manual" in args:
+        content = manual_broadcast_content()
+    else:
+        variant = variant_from_message(message.reply_to_message) if message.reply_to_message else None
+        content = {"variants": {"*": variant}} if variant else {"variants": {}}
+    if not content["variants"] or any(arg not in ("manual", "active", *BROADCAST_LANGUAGES) for arg in args):
+        await message.answer(get_text("admin_broadcast_usage", lang))
+        return
+
+    broadcast_id, total = await create_broadcast(user_id, lang, language, active_on, content)
+    kb = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text=get_text("admin_broadcast_button_start", lang), callback_data=f"broadcast_start_{broadcast_id}"),
+        InlineKeyboardButton(text=get_text("admin_broadcast_button_cancel", lang), callback_data=f"broadcast_cancel_{broadcast_id}"),
+    ]])
+    await message.answer(
+        get_text("admin_broadcast_confirm", lang).format(id=broadcast_id, total=total,
+                                                         audience=broadcast_audience(language, active_on, lang)),
+        reply_markup=kb
+    )
+
+@dp.callback_query(lambda c: c.data.startswith(("broadcast_start_", "broadcast_cancel_")) and c.data.rsplit("_", 1)[1].isdigit())
+async def broadcast_confirm(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    lang = await get_lang(user_id)
+    if user_id not in ADMIN_IDS:
+        await callback.answer(get_text("admin_access_denied", lang), show_alert=True)
+        return
+    action, _, raw_id = callback.data.removeprefix("broadcast_").partition("_")
+    broadcast_id = int(raw_id)
+
+    if action == "start":
+        # Это сообщение отправитель рассылки будет обновлять ходом рассылки
+        total = await start_broadcast(broadcast_id, callback.message.chat.id, callback.message.message_id)
+        if total is not None:
+            await callback.message.edit_text(get_text("admin_broadcast_started", lang).format(id=broadcast_id, total=total))
+            wake_broadcast_sender()
+            await callback.answer()
+            return
+    elif await cancel_broadcast(broadcast_id):
+        await callback.message.edit_text(get_text("admin_broadcast_cancel_ok", lang).format(id=broadcast_id))
+        await callback.answer()
+        return
+    await callback.answer(get_text("admin_broadcast_not_found", lang).format(id=broadcast_id), show_alert=True)
+
 # Кнопка "Назад" в главное меню админки
 @dp.callback_query(lambda c: c.data == "admin_back_to_main")
 async def admin_back_to_main(callback: types.CallbackQuery):
@@ -880,45 +1609,166 @@ async def admin_back_to_main(callback: types.CallbackQuery):
         return
      lang = await get_lang(user_id)
      # Показываем главное меню админки снова
-     await callback.message.edit_text(
-            get_text("admin_panel_title", lang),
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text=get_text("admin_list_tw_accounts", lang), callback_data="list_tw_accounts")]
-            ]))
+     await callback.message.edit_text(get_text("admin_panel_title", lang), reply_markup=admin_main_keyboard(lang))
      await callback.answer()
 
+# Статистика запросов к БД (медленные запросы и полные обходы таблиц)
+@dp.callback_query(lambda c: c.data == "admin_db_stats")
+async def admin_db_stats(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    if user_id not in ADMIN_IDS:
+        await callback.answer("Доступ запрещен.", show_alert=True)
+        return
+    lang = await get_lang(user_id)
+
+    stats = get_query_stats(limit=10)
+    message_text = get_text("admin_db_stats_title", lang).format(threshold=int(SLOW_QUERY_MS)) + "\n\n"
+    message_text += get_text("admin_handler_load", lang).format(**admission_control.stats()) + "\n"
+    message_text += get_text("admin_throttle_stats", lang).format(**throttling.stats()) + "\n\n"
+    if backup_metrics:
+        last = backup_metrics[-1]
+        status = (f"OK, {last['copy_sec'] + last['check_sec'] + last['compress_sec']:.1f} s, "
+                  f"{last['size_bytes'] / 1024:.0f} KB") if last["ok"] else f"ERROR: {last.get('error')}"
+        message_text += get_text("admin_last_backup", lang).format(started_at=last["started_at"], status=status) + "\n\n"
+    if not stats:
+        message_text += get_text("admin_db_stats_empty", lang)
+    for i, stat in enumerate(stats, 1):
+        message_text += get_text("admin_db_stats_entry", lang).format(
+            i=i,
+            total=stat.total_ms,
+            count=stat.count,
+            avg=stat.avg_ms,
+            p95=stat.p95_ms,
+            max=stat.max_ms,
+            slow=stat.slow_count,
+            scan=" [FULL SCAN]" if stat.full_scan else "",
+            sql=stat.sql[:150]
+        )
+
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=get_text("admin_back_to_main", lang), callback_data="admin_back_to_main")]
+    ])
+    # Без parse_mode: SQL может содержать символы разметки (*, _)
+    await callback.message.edit_text(message_text[:4000], reply_markup=kb)
+    await callback.answer()
+
 # ========== ЗАПУСК БОТА ==========
-async def main():
+async def load_bot_state():
+    """Инициализация БД и загрузка кешей и индексов, нужных обработчикам (при старте бота и в replay.py)."""
     # Загружаем кеш file_id из файла
     load_cache()
 
     # Инициализация БД
     await init_database_module()
 
+    # Загружаем индекс известных tx_hash для ранней отбраковки дубликатов
+    await tx_hash_index.load()
+    # Индекс окончаний подписок: ежедневная проверка берет из него только наступившие
+    await expiry_index.load()
+    # Пользователи, заблокировавшие бота: им не отправляются рассылки
+    await blocked_users.load()
+
     # Загружаем языки пользователей из БД в кэш при старте
-    async with aiosqlite.connect(DATABASE_FILE) as db:
+    async with connect_db() as db:
         async with db.execute("SELECT user_id, language FROM users WHERE language IS NOT NULL") as cursor:
             rows = await cursor.fetchall()
             for row in rows:
                 user_languages[row[0]] = row[1]
             logging.info(f"Загружено {len(user_languages)} языковых настроек пользователей.")
 
-    # Запускаем планировщик проверки подписок
-    asyncio.create_task(start_scheduler(bot, TEXTS))
+
+async def main():
+    await load_bot_state()
+
+    # Фоновые задачи, которые должен выполнять только один экземпляр бота (иначе каждое напоминание
+    # уйдет столько раз, сколько запущено экземпляров). Запускаются, пока экземпляр держит аренду
+    # лидера; останавливаются по очереди в порядке запуска.
+    leader_jobs = {}
+    # Фоновые миграции данных (например, первичный расчет сводок для /stats)
+    leader_jobs["data_migrations"] = lambda: run_data_migrations(
+        {"plan_prices": {details["price"]: plan_id for plan_id, details in PLANS.items()}}
+    )
+    # Планировщик проверки подписок
+    leader_jobs["scheduler"] = lambda: start_scheduler(bot, TEXTS)
+    # Фоновая архивация старых платежей (работает в простое)
+    leader_jobs["archiver"] = lambda: start_archiver(bot_is_idle)
+    # Периодические онлайн-бэкапы БД
+    leader_jobs["backups"] = start_backup_scheduler
+    # Фоновая проверка транзакций в сети TRON
+    if TRON_VERIFY_ENABLED:
+        leader_jobs["tron_verifier"] = tron_verifier.run
+    else:
+        logging.info("Проверка транзакций TRON отключена (TRON_VERIFY_ENABLED=0).")
+    # Отправка запланированных напоминаний о подписках (пишет уведомления админам в outbox)
+    leader_jobs["reminders"] = lambda: start_reminder_sender(bot, TEXTS)
+    # Рассылки админа (незавершенная продолжается с сохраненного курсора)
+    leader_jobs["broadcasts"] = lambda: start_broadcast_sender(bot, TEXTS, remember_instruction_file_id)
+    # Отправка уведомлений админам из outbox (в т.ч. оставшихся с прошлого запуска).
+    # При остановке выключается после задач, которые пишут в outbox.
+    leader_jobs["outbox_sender"] = lambda: start_outbox_sender(bot)
+
+    # Запускаем фоновые задачи (ссылки храним, чтобы корректно остановить их при выключении)
+    background_tasks["leader"] = asyncio.create_task(leader_lease.run(leader_jobs))
+    # Очередь отправки Bot API - последней: до самой остановки через нее отправляют все остальные
+    background_tasks["send_queue"] = asyncio.create_task(send_queue.run())
     logging.info("Запуск опроса бота...")
-    # Регистрируем обработчик для сохранения кеша при выключении
-    # dp.shutdown.register(save_cache) # Не работает в asyncio.run? Проще сохранять после каждого добавления.
 
+    # SIGINT/SIGTERM останавливают опрос (aiogram), затем вызывается on_shutdown
+    await dp.start_polling(bot)
+
+
+# ========== ОСТАНОВКА БОТА ==========
+# Сколько ждать завершения начатых обработчиков и фоновых задач при остановке (сек)
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "20"))
+background_tasks = {}
+
+@dp.shutdown()
+async def on_shutdown():
+    """
+    Корректная остановка: опрос уже остановлен (новые апдейты не принимаются), сессия бота еще открыта.
+    Дожидаемся начатых обработчиков, останавливаем фоновые задачи (планировщик сохраняет чекпойнт),
+    сохраняем кеш и переносим WAL в основной файл БД.
+    """
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+
+    # 1. Начатые обработчики (подтверждение платежа и т.п.) доводим до конца
+    if inflight_updates:
+        logging.info(f"Остановка: ожидание {inflight_updates} обрабатываемых апдейтов...")
+        try:
+            await asyncio.wait_for(no_inflight_updates.wait(), timeout=max(0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            logging.warning(f"Остановка: {inflight_updates} апдейтов не завершились за {SHUTDOWN_TIMEOUT} сек.")
+
+    # 2. Фоновые задачи: отмена в порядке запуска, каждая сохраняет прогресс в своем finally
+    for name, task in background_tasks.items():
+        if task.done():
+            continue
+        task.cancel()
+        try:
+            await asyncio.wait_for(task, timeout=max(1, deadline - time.monotonic()))
+        except asyncio.CancelledError:
+            pass
+        except asyncio.TimeoutError:
+            logging.warning(f"Остановка: фоновая задача '{name}' не завершилась вовремя.")
+        except Exception as e:
+            logging.error(f"Остановка: ошибка фоновой задачи '{name}': {e}")
+    background_tasks.clear()
+
+    # 3. Кеш file_id, запись апдейтов и WAL (все соединения с БД к этому моменту закрыты)
+    save_cache()
+    if update_recorder:
+        update_recorder.close()
     try:
-        await dp.start_polling(bot)
-    finally:
-        # Сохраняем кеш при остановке бота (даже при ошибке или KeyboardInterrupt)
-        logging.info("Бот останавливается, сохраняем кеш file_id...")
-        save_cache()
+        busy, wal_pages, moved_pages = await checkpoint_wal()
+        logging.info(f"Остановка: WAL перенесен в БД ({moved_pages}/{wal_pages} стр., busy={busy}).")
+    except Exception as e:
+        logging.error(f"Остановка: ошибка checkpoint WAL: {e}")
+    logging.info("Бот остановлен корректно.")
 
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    # Форматирование и вывод логов - в фоновом потоке, цикл событий только кладет записи в очередь
+    log_listener = setup_logging()
     if not os.path.exists(MEDIA_DIR):
         os.makedirs(MEDIA_DIR)
         logging.info(f"Создана директория: {MEDIA_DIR}")
@@ -927,4 +1777,6 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         logging.info("Бот остановлен вручную.")
     except Exception as e:
-         logging.exception(f"Критическая ошибка при запуске бота: {e}")
\ No newline at end of file
+         logging.exception(f"Критическая ошибка при запуске бота: {e}")
+    finally:
+        log_listener.stop() # Дописывает оставшиеся в очереди записи
\ No newline at end of file
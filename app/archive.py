@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+
+from database import connect_db
+
+load_dotenv()
+
+# Платежи старше этого срока (по purchase_date) и вытесненные более новым платежом уходят в архив
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_INTERVAL = 6 * 3600          # Как часто запускать архивацию (сек)
+VACUUM_PAGES_PER_SLICE = 256         # Страниц за один шаг incremental_vacuum
+SLICE_PAUSE = 1.0                    # Пауза между порциями (сек), чтобы не занимать блокировку записи
+IDLE_WAIT = 60                       # Сколько ждать, если бот сейчас занят (сек)
+# Скорость полного VACUUM (МБ/с) - для оценки длительности разового перевода в INCREMENTAL (/vacuum)
+VACUUM_ESTIMATE_MB_PER_SEC = float(os.getenv("VACUUM_ESTIMATE_MB_PER_SEC", "50"))
+
+_auto_vacuum_reported = False  # Сообщение о режиме без INCREMENTAL - один раз за запуск
+
+# Колонки, общие для payments и payments_archive
+_COLUMNS = ("id, user_id, tw_username, tx_hash, amount, purchase_date, subscription_end, "
+            "verification_status, verification_note, verify_attempts, plan_id, account_id")
+
+
+async def archive_batch(cutoff_date: str, limit: int = ARCHIVE_BATCH_SIZE) -> int:
+    """
+    Переносит в архив одну порцию платежей одной короткой транзакцией. Возвращает число перенесенных.
+    Последний платеж каждой пары (user_id, tw_username) всегда остается в горячей таблице,
+    поэтому планировщик, список аккаунтов и поиск по-прежнему видят актуальные подписки.
+    Платежи, ожидающие проверки в сети, не трогаем.
+    """
+    archived_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    async with connect_db() as db:
+        query = """
+            SELECT p.id FROM payments p
+            WHERE p.purchase_date < ?
+              AND p.verification_status != 'pending'
+              AND EXISTS (
+                  SELECT 1 FROM payments n
+                  WHERE n.user_id = p.user_id AND n.tw_username = p.tw_username AND n.id > p.id
+              )
+            ORDER BY p.id
+            LIMIT ?
+        """
+        async with db.execute(query, (cutoff_date, limit)) as cursor:
+            ids = [row[0] for row in await cursor.fetchall()]
+        if not ids:
+            return 0
+
+        placeholders = ",".join("?" * len(ids))
+        await db.execute(f"""
+            INSERT INTO payments_archive ({_COLUMNS}, archived_at)
+            SELECT {_COLUMNS}, ? FROM payments WHERE id IN ({placeholders})
+        """, (archived_at, *ids))
+        await db.execute(f"DELETE FROM payments WHERE id IN ({placeholders})", ids)
+        await db.commit()
+    return len(ids)
+
+
+async def archive_superseded_payments(is_idle) -> int:
+    """Переносит в архив все подходящие платежи порциями, пока бот простаивает."""
+    cutoff_date = (datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)).strftime("%Y-%m-%d")
+    total = 0
+    while is_idle():
+        moved = await archive_batch(cutoff_date)
+        total += moved
+        if moved < ARCHIVE_BATCH_SIZE:
+            break
+        await asyncio.sleep(SLICE_PAUSE)
+    if total:
+        logging.info("Архивация: перенесено %s платежей старше %s в payments_archive.", total, cutoff_date)
+    return total
+
+
+async def get_auto_vacuum_status():
+    """
+    Режим auto_vacuum (0 - NONE, 1 - FULL, 2 - INCREMENTAL), размер файла БД (МБ)
+    и оценка длительности разового полного VACUUM (сек).
+    """
+    async with connect_db() as db:
+        async with db.execute("PRAGMA auto_vacuum") as cursor:
+            mode = (await cursor.fetchone())[0]
+        async with db.execute("PRAGMA page_count") as cursor:
+            page_count = (await cursor.fetchone())[0]
+        async with db.execute("PRAGMA page_size") as cursor:
+            page_size = (await cursor.fetchone())[0]
+    size_mb = page_count * page_size / 1024 / 1024
+    return mode, size_mb, size_mb / VACUUM_ESTIMATE_MB_PER_SEC
+
+
+async def convert_to_incremental_auto_vacuum() -> float:
+    """
+    Переводит существующую БД в режим auto_vacuum=INCREMENTAL разовым полным VACUUM.
+    VACUUM переписывает весь файл и все это время держит блокировку записи: обработчики, которые
+    ждут ее дольше busy_timeout, получают "database is locked". Поэтому перевод не запускается
+    фоном, а только явно админом (/vacuum now) в выбранное им время. Возвращает длительность (сек).
+    """
+    _, size_mb, estimate = await get_auto_vacuum_status()
+    logging.warning("Перевод БД (%.0f МБ) в режим auto_vacuum=INCREMENTAL: полный VACUUM, "
+                    "запись в БД заблокирована примерно на %.0f сек.", size_mb, estimate)
+    started = time.monotonic()
+    async with connect_db() as db:
+        await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        await db.execute("VACUUM")
+    elapsed = time.monotonic() - started
+    logging.info("Режим auto_vacuum=INCREMENTAL включен за %.1f сек.", elapsed)
+    return elapsed
+
+
+async def incremental_vacuum(is_idle) -> int:
+    """
+    Освобождает свободные страницы файла БД небольшими порциями, пока бот простаивает.
+    Только в режиме INCREMENTAL: новые БД создаются в нем, существующие переводит админ (/vacuum).
+    """
+    global _auto_vacuum_reported
+    freed = 0
+    async with connect_db() as db:
+        async with db.execute("PRAGMA auto_vacuum") as cursor:
+            mode = (await cursor.fetchone())[0]
+        if mode != 2: # INCREMENTAL
+            if not _auto_vacuum_reported:
+                _auto_vacuum_reported = True
+                logging.info("Incremental VACUUM недоступен: БД не в режиме auto_vacuum=INCREMENTAL "
+                             "(перевод - командой /vacuum).")
+            return 0
+        while is_idle():
+            async with db.execute("PRAGMA freelist_count") as cursor:
+                free_pages = (await cursor.fetchone())[0]
+            if not free_pages:
+                break
+            step = min(free_pages, VACUUM_PAGES_PER_SLICE)
+            # incremental_vacuum выполняется по мере чтения результата
+            async with db.execute(f"PRAGMA incremental_vacuum({step})") as cursor:
+                await cursor.fetchall()
+            await db.commit()
+            freed += step
+            await asyncio.sleep(SLICE_PAUSE)
+    if freed:
+        logging.info("Incremental VACUUM: освобождено ~%s страниц.", freed)
+    return freed
+
+
+async def start_archiver(is_idle):
+    """
+    Фоновая архивация старых платежей и освобождение места в файле БД.
+    is_idle: функция без аргументов, True - входящих апдейтов давно не было.
+    """
+    logging.info("Архивация платежей запущена (старше %s дней).", ARCHIVE_AFTER_DAYS)
+    while True:
+        try:
+            if not is_idle():
+                await asyncio.sleep(IDLE_WAIT)
+                continue
+            await archive_superseded_payments(is_idle)
+            await incremental_vacuum(is_idle)
+        except Exception as e:
+            logging.exception("Ошибка фоновой архивации: %s", e)
+        await asyncio.sleep(ARCHIVE_INTERVAL)
@@ -0,0 +1,145 @@
+import asyncio
+import glob
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from collections import deque
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+from database import DATABASE_FILE
+
+load_dotenv()
+
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "24"))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))           # Сколько последних снимков хранить
+BACKUP_PAGES_PER_STEP = 256                                 # Страниц за один шаг backup API
+BACKUP_STEP_SLEEP = 0.05                                    # Пауза между шагами (сек): запись в БД не ждет
+# Запись в БД другим соединением начинает пошаговое копирование заново; после стольких перезапусков
+# (занятая БД) копируем одним шагом - под снимком чтения, в WAL запись при этом не блокируется
+BACKUP_MAX_RESTARTS = 3
+BACKUP_FIRST_DELAY = 300                                    # Первый бэкап через 5 минут после старта
+
+# Метрики последних бэкапов (для админ-панели)
+backup_metrics = deque(maxlen=10)
+
+
+class _BackupRestarted(Exception):
+    """Пошаговое копирование перезапускалось слишком часто."""
+
+
+def _copy_database(source_path: str, target_path: str):
+    """
+    Копирует БД через SQLite online backup API небольшими шагами.
+    Между шагами блокировка источника снимается, поэтому обработчики продолжают писать.
+    Запись другим соединением перезапускает копирование с начала; если это случилось больше
+    BACKUP_MAX_RESTARTS раз, копия снимается одним шагом.
+    Возвращает (число скопированных страниц, число перезапусков).
+    """
+    state = {"total": 0, "remaining": None, "restarts": 0}
+
+    def progress(status, remaining, total):
+        if state["remaining"] is not None and remaining > state["remaining"]:
+            state["restarts"] += 1 # Осталось больше, чем на прошлом шаге - копирование началось заново
+            if state["restarts"] > BACKUP_MAX_RESTARTS:
+                raise _BackupRestarted()
+        state["remaining"] = remaining
+        state["total"] = total
+
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(target_path)
+    try:
+        try:
+            source.backup(target, pages=BACKUP_PAGES_PER_STEP, progress=progress, sleep=BACKUP_STEP_SLEEP)
+        except _BackupRestarted:
+            logging.warning("Бэкап БД: пошаговое копирование перезапускалось %s раз из-за записи, копируем одним шагом.",
+                            state["restarts"])
+            source.backup(target, pages=-1, progress=progress)
+    finally:
+        target.close()
+        source.close()
+    return state["total"], state["restarts"]
+
+
+def _integrity_check(path: str) -> str:
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("PRAGMA integrity_check").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _compress(source_path: str, target_path: str):
+    with open(source_path, "rb") as src, gzip.open(target_path, "wb") as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+def _rotate(keep: int) -> list:
+    """Удаляет старые снимки, оставляя keep последних. Возвращает удаленные пути."""
+    snapshots = sorted(glob.glob(os.path.join(BACKUP_DIR, "bot_database_*.db.gz")))
+    removed = snapshots[:-keep] if keep > 0 else []
+    for path in removed:
+        os.remove(path)
+    return removed
+
+
+async def create_backup() -> dict:
+    """
+    Делает сжатый проверенный снимок БД. Вся тяжелая работа выполняется в отдельном потоке,
+    цикл событий не блокируется. Возвращает метрики бэкапа.
+    """
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    raw_path = os.path.join(BACKUP_DIR, f"bot_database_{stamp}.db.tmp")
+    final_path = os.path.join(BACKUP_DIR, f"bot_database_{stamp}.db.gz")
+    metrics = {"started_at": stamp, "ok": False}
+
+    try:
+        start = time.perf_counter()
+        metrics["pages"], metrics["restarts"] = await asyncio.to_thread(_copy_database, DATABASE_FILE, raw_path)
+        metrics["copy_sec"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        integrity = await asyncio.to_thread(_integrity_check, raw_path)
+        metrics["check_sec"] = time.perf_counter() - start
+        if integrity != "ok":
+            raise RuntimeError(f"integrity_check снимка: {integrity}")
+
+        start = time.perf_counter()
+        await asyncio.to_thread(_compress, raw_path, final_path + ".tmp")
+        os.replace(final_path + ".tmp", final_path) # Атомарно: неполный архив не попадет в ротацию
+        metrics["compress_sec"] = time.perf_counter() - start
+        metrics["size_bytes"] = os.path.getsize(final_path)
+
+        metrics["removed"] = len(await asyncio.to_thread(_rotate, BACKUP_KEEP))
+        metrics["ok"] = True
+        logging.info(
+            "Бэкап БД %s: %s стр., копирование %.2f с (перезапусков %s), проверка %.2f с, сжатие %.2f с, "
+            "%.0f КБ, удалено старых: %s.",
+            final_path, metrics["pages"], metrics["copy_sec"], metrics["restarts"], metrics["check_sec"],
+            metrics["compress_sec"], metrics["size_bytes"] / 1024, metrics["removed"]
+        )
+    except Exception as e:
+        metrics["error"] = str(e)
+        logging.exception("Ошибка создания бэкапа БД: %s", e)
+        if os.path.exists(final_path + ".tmp"):
+            os.remove(final_path + ".tmp")
+    finally:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+        backup_metrics.append(metrics)
+    return metrics
+
+
+async def start_backup_scheduler():
+    """Периодический онлайн-бэкап БД без остановки бота."""
+    logging.info("Бэкапы БД запущены: каждые %s ч., хранится %s шт. в '%s'.", BACKUP_INTERVAL_HOURS, BACKUP_KEEP, BACKUP_DIR)
+    await asyncio.sleep(BACKUP_FIRST_DELAY)
+    while True:
+        await create_backup()
+        await asyncio.sleep(BACKUP_INTERVAL_HOURS * 3600)
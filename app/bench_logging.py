@@ -0,0 +1,74 @@
+"""
+Замер времени, которое логирование отнимает у цикла событий во время рассылки.
+Запуск: python bench_logging.py [число_записей]
+
+Сравнивает прежнюю схему (logging.basicConfig: форматирование и запись в файл в потоке цикла)
+с конвейером log_setup (QueueHandler + QueueListener), в текстовом и JSON-формате и с
+сэмплированием строк горячего пути. Вывод идет во временный файл, чтобы учитывать реальный ввод-вывод.
+"""
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from log_setup import setup_logging
+
+RECORDS = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+
+
+async def simulate_broadcast(records: int, sampled: bool) -> float:
+    """Имитация рассылки: строка лога на каждое "отправленное" сообщение. Возвращает время в логировании (сек)."""
+    spent = 0.0
+    extra = {"sample": "reminder_sent", "user_id": 0, "kind": "warning"} if sampled else {"user_id": 0, "kind": "warning"}
+    for i in range(records):
+        extra["user_id"] = i
+        started = time.perf_counter()
+        logging.info("Отправлено ПРЕДУПРЕЖДЕНИЕ user_id=%s для TW='%s' (осталось %s дн.)",
+                     i, f"tw_user_{i}", 3, extra=extra)
+        spent += time.perf_counter() - started
+        if i % 100 == 0:
+            await asyncio.sleep(0)
+    return spent
+
+
+def run_case(name: str, records: int, log_file, fmt: str = None, sampled: bool = False):
+    root = logging.getLogger()
+    listener = None
+    if fmt is None:
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        logging.basicConfig(stream=log_file, level=logging.INFO,
+                            format='%(asctime)s - %(levelname)s - %(message)s', force=True)
+    else:
+        listener = setup_logging("INFO", fmt, stream=log_file)
+
+    spent = asyncio.run(simulate_broadcast(records, sampled))
+    drain_started = time.perf_counter()
+    if listener:
+        listener.stop()  # Время дописи очереди фоновым потоком - не на цикле событий
+    drain = time.perf_counter() - drain_started
+    log_file.flush()
+    print(f"{name:<34} цикл: {spent * 1000:8.1f} мс ({spent / records * 1e6:6.2f} мкс/запись), "
+          f"фоновая допись: {drain * 1000:7.1f} мс")
+    return spent
+
+
+def main():
+    print(f"Записей: {RECORDS}")
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, "bench.log"), "w", encoding="utf-8") as log_file:
+            baseline = run_case("basicConfig (синхронно)", RECORDS, log_file)
+            for name, fmt, sampled in (
+                ("QueueListener, text", "text", False),
+                ("QueueListener, json", "json", False),
+                ("QueueListener, json + сэмплинг", "json", True),
+            ):
+                spent = run_case(name, RECORDS, log_file, fmt, sampled)
+                print(f"{'':<34} экономия времени цикла: {(1 - spent / baseline) * 100:5.1f}%")
+    logging.getLogger().handlers.clear()
+
+
+if __name__ == "__main__":
+    main()
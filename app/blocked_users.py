@@ -0,0 +1,57 @@
+import logging
+
+from aiogram.exceptions import TelegramForbiddenError
+
+from database import get_blocked_user_ids, mark_user_blocked, clear_user_blocked
+
+
+class BlockedUsers:
+    """
+    Пользователи, заблокировавшие бота (users.blocked_at).
+    Отметка ставится по ответу Forbidden на любой запрос к Bot API в личный чат - напоминания,
+    ответы обработчиков, уведомления админам (request_middleware сессии бота) - и снимается при
+    следующем апдейте от пользователя (update_middleware). Массовые отправки отбирают получателей
+    в SQL по blocked_at IS NULL.
+    Множество в памяти нужно только, чтобы не писать в БД на каждом апдейте: запись идет,
+    лишь когда пишет пользователь с отметкой.
+    """
+
+    def __init__(self):
+        self._blocked = set()
+
+    async def load(self):
+        """Загружает отметки из БД (при старте)."""
+        self._blocked = await get_blocked_user_ids()
+        logging.info("Пользователей, заблокировавших бота: %s.", len(self._blocked))
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._blocked
+
+    async def request_middleware(self, make_request, bot, method):
+        try:
+            return await make_request(bot, method)
+        except TelegramForbiddenError:
+            chat_id = getattr(method, "chat_id", None)
+            # Личный чат: chat_id совпадает с user_id (у групп и каналов он отрицательный или @имя)
+            if isinstance(chat_id, int) and chat_id > 0 and chat_id not in self._blocked:
+                self._blocked.add(chat_id)
+                try:
+                    await mark_user_blocked(chat_id)
+                    logging.info("Пользователь %s заблокировал бота, отправки ему приостановлены.", chat_id)
+                except Exception as e:
+                    logging.error("Не удалось сохранить блокировку бота пользователем %s: %s", chat_id, e)
+            raise
+
+    async def update_middleware(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None and user.id in self._blocked:
+            try:
+                await clear_user_blocked(user.id)
+                self._blocked.discard(user.id)
+                logging.info("Пользователь %s снова пишет боту, отметка о блокировке снята.", user.id)
+            except Exception as e:
+                logging.error("Не удалось снять отметку о блокировке с пользователя %s: %s", user.id, e)
+        return await handler(event, data)
+
+
+blocked_users = BlockedUsers()
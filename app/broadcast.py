@@ -0,0 +1,256 @@
+import asyncio
+import logging
+import os
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
+from aiogram.types import FSInputFile, Message
+from dotenv import load_dotenv
+
+from database import (
+    LeaseLost,
+    get_next_broadcast,
+    get_broadcast_recipients,
+    save_broadcast_progress,
+)
+from leader import current_fence, lease_valid
+from send_queue import send_lane, LANE_ADMIN, LANE_BULK
+
+load_dotenv()
+
+# Одновременных отправок: темп все равно задает очередь отправки (send_queue), а параллельность
+# скрывает задержку каждого запроса к Bot API - иначе один поток не набрал бы и 10 сообщений/сек
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "16"))
+BROADCAST_PAGE_SIZE = 500            # Получателей за один запрос к БД
+BROADCAST_CHECKPOINT_INTERVAL = 2.0  # Как часто сохранять курсор (сек): столько отправок может повториться после сбоя
+BROADCAST_REPORT_INTERVAL = 5.0      # Как часто обновлять сообщение админу о ходе рассылки (сек)
+BROADCAST_POLL_INTERVAL = 30         # Проверка новых рассылок, запущенных другим экземпляром бота (сек)
+BROADCAST_ABORT_FAILURES = 50        # Столько ошибок без единой доставки - содержимое не отправляется, стоп
+
+MEDIA_TYPES = ("photo", "document", "video", "animation")
+
+_broadcast_wakeup = asyncio.Event()
+
+
+def wake_broadcast_sender():
+    """Сигнал отправителю: админ запустил рассылку."""
+    _broadcast_wakeup.set()
+
+
+def variant_from_message(message: Message):
+    """
+    Вариант рассылки из сообщения админа: текст или медиа по file_id (файл не загружается заново)
+    с подписью; форматирование сохраняется как HTML. None - тип сообщения не поддерживается.
+    """
+    for media_type in MEDIA_TYPES:
+        media = getattr(message, media_type)
+        if media:
+            file_id = media[-1].file_id if media_type == "photo" else media.file_id
+            return {"type": media_type, "file_id": file_id, "text": message.html_text or None}
+    if message.text:
+        return {"type": "text", "text": message.html_text}
+    return None
+
+
+def pick_variant(content: dict, language: str) -> dict:
+    """Вариант для языка получателя: свой, общий ("*"), английский или любой."""
+    variants = content["variants"]
+    return variants.get(language) or variants.get("*") or variants.get("en") or next(iter(variants.values()))
+
+
+class BroadcastRun:
+    """
+    Отправка одной рассылки: получатели страницами по возрастанию user_id, отправка пулом
+    из BROADCAST_WORKERS задач в фоновой полосе очереди отправки.
+    Курсор в БД - последний user_id, до которого включительно все отправки завершены, поэтому
+    после сбоя рассылка продолжается с него (повторно может уйти не больше чем за
+    BROADCAST_CHECKPOINT_INTERVAL). Счетчики сохраняются вместе с курсором и ему соответствуют.
+    """
+
+    def __init__(self, bot: Bot, texts: dict, row, on_file_id=None):
+        (self.id, self.admin_language, self.language, self.active_on, self.content, self.cursor, self.total,
+         self.sent, self.failed, self.blocked, self.report_chat_id, self.report_message_id) = row
+        self.bot = bot
+        self.texts = texts.get(self.admin_language, texts["en"])
+        self.on_file_id = on_file_id  # (путь к файлу, file_id) - после первой загрузки файла
+        self.stopped = False
+        self.status = "running"
+        self._upload_lock = asyncio.Lock()
+        self._checkpoint_lock = asyncio.Lock() # Чекпойнты по очереди: курсор в БД не откатывается назад
+        self._page = []
+        self._results = []     # Результат по индексу страницы: "sent", "failed", "blocked" или None
+        self._watermark = 0    # Индекс первой незавершенной отправки страницы
+        self._started = time.monotonic()
+        self._processed = 0    # Завершено отправок в этом запуске (для скорости)
+        self._run_sent = 0     # Доставлено в этом запуске (еще не учтенные в sent тоже)
+        self._checkpoint_at = self._report_at = time.monotonic()
+
+    async def _deliver(self, chat_id: int, variant: dict):
+        if variant["type"] == "text":
+            await self.bot.send_message(chat_id, variant["text"], parse_mode="HTML")
+            return
+        send = getattr(self.bot, f"send_{variant['type']}")
+        if not variant.get("file_id"):
+            async with self._upload_lock:
+                if not variant.get("file_id"):
+                    # Файл с диска загружается один раз, дальше отправляется по file_id
+                    message = await send(chat_id, FSInputFile(variant["file"]), caption=variant.get("text"),
+                                         parse_mode="HTML")
+                    media = getattr(message, variant["type"])
+                    variant["file_id"] = media[-1].file_id if variant["type"] == "photo" else media.file_id
+                    if self.on_file_id:
+                        self.on_file_id(variant["file"], variant["file_id"])
+                    return
+        await send(chat_id, variant["file_id"], caption=variant.get("text"), parse_mode="HTML")
+
+    async def _send_one(self, chat_id: int, language: str) -> str:
+        try:
+            await self._deliver(chat_id, pick_variant(self.content, language))
+            return "sent"
+        except TelegramForbiddenError:
+            return "blocked" # Отметку users.blocked_at ставит blocked_users
+        except TelegramBadRequest as e:
+            logging.warning("Рассылка #%s: не доставлено user_id=%s: %s", self.id, chat_id, e,
+                            extra={"sample": "broadcast_failed"})
+            return "failed"
+        except Exception as e:
+            logging.warning("Рассылка #%s: ошибка отправки user_id=%s: %s", self.id, chat_id, e,
+                            extra={"sample": "broadcast_failed"})
+            return "failed"
+
+    async def _worker(self, queue: asyncio.Queue):
+        while not self.stopped:
+            try:
+                index = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            if not lease_valid():
+                self.stopped = True # Аренда лидера истекла: рассылку продолжит новый лидер с курсора
+                return
+            chat_id, language = self._page[index]
+            result = self._results[index] = await self._send_one(chat_id, language)
+            self._processed += 1
+            if result == "sent":
+                self._run_sent += 1
+            elif (result == "failed" and not self.sent and not self._run_sent
+                  and self._processed >= BROADCAST_ABORT_FAILURES):
+                # Ни одной доставки - скорее всего, не отправляется само сообщение: не ждем чекпойнта
+                await self._checkpoint()
+                continue
+            await self._maybe_checkpoint()
+
+    def _advance(self):
+        """Сдвигает курсор по подряд завершенным отправкам страницы и учитывает их в счетчиках."""
+        while self._watermark < len(self._page) and self._results[self._watermark] is not None:
+            result = self._results[self._watermark]
+            if result == "sent":
+                self.sent += 1
+            elif result == "blocked":
+                self.blocked += 1
+            else:
+                self.failed += 1
+            self.cursor = self._page[self._watermark][0]
+            self._watermark += 1
+
+    async def _checkpoint(self, status: str = "running"):
+        async with self._checkpoint_lock:
+            if self.status != "running":
+                return # Рассылку уже завершил чекпойнт другой задачи пула
+            self._advance()
+            if status == "running" and not self.sent and not self._run_sent and self.failed >= BROADCAST_ABORT_FAILURES:
+                logging.error("Рассылка #%s: %s ошибок без единой доставки, рассылка остановлена.", self.id, self.failed)
+                status = "failed"
+            if not await save_broadcast_progress(self.id, self.cursor, self.sent, self.failed, self.blocked,
+                                                 status, fence=current_fence()):
+                status = "cancelled" # Админ отменил рассылку
+            self.status = status
+            if status != "running":
+                self.stopped = True
+            self._checkpoint_at = time.monotonic()
+
+    async def _maybe_checkpoint(self):
+        now = time.monotonic()
+        if now - self._checkpoint_at >= BROADCAST_CHECKPOINT_INTERVAL:
+            self._checkpoint_at = now # Остальные задачи пула не начинают второй чекпойнт, пока идет этот
+            await self._checkpoint()
+        if now - self._report_at >= BROADCAST_REPORT_INTERVAL:
+            self._report_at = now
+            await self.report()
+
+    async def report(self):
+        """Обновляет сообщение админу: прогресс, скорость и оставшееся время (или итог)."""
+        if not self.report_chat_id:
+            return
+        done = self.sent + self.failed + self.blocked
+        values = {"id": self.id, "done": done, "total": self.total, "sent": self.sent,
+                  "failed": self.failed, "blocked": self.blocked}
+        if self.status == "running":
+            rate = self._processed / max(0.001, time.monotonic() - self._started)
+            eta = max(0, self.total - done) / rate / 60 if rate else 0
+            text = self.texts["admin_broadcast_progress"].format(rate=rate, eta=eta, **values)
+        else:
+            text = self.texts[f"admin_broadcast_{self.status}"].format(**values)
+        try:
+            with send_lane(LANE_ADMIN):
+                await self.bot.edit_message_text(text, chat_id=self.report_chat_id,
+                                                 message_id=self.report_message_id)
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                logging.warning("Рассылка #%s: не удалось обновить отчет админу: %s", self.id, e)
+        except Exception as e:
+            logging.warning("Рассылка #%s: не удалось обновить отчет админу: %s", self.id, e)
+
+    async def run(self):
+        logging.info("Рассылка #%s: отправка с user_id > %s, получателей всего %s.", self.id, self.cursor, self.total)
+        try:
+            while not self.stopped:
+                self._page = await get_broadcast_recipients(self.cursor, self.language, self.active_on,
+                                                            BROADCAST_PAGE_SIZE)
+                if not self._page:
+                    await self._checkpoint("done")
+                    break
+                self._results = [None] * len(self._page)
+                self._watermark = 0
+                queue = asyncio.Queue()
+                for index in range(len(self._page)):
+                    queue.put_nowait(index)
+                await asyncio.gather(*(self._worker(queue) for _ in range(min(BROADCAST_WORKERS, len(self._page)))))
+                if not self.stopped:
+                    await self._checkpoint()
+        finally:
+            if self.status == "running" and self._page:
+                # Остановка бота или потеря аренды посреди страницы: сохраняем, докуда дошли
+                try:
+                    await self._checkpoint()
+                except Exception as e:
+                    logging.warning("Рассылка #%s: не удалось сохранить курсор при остановке: %s", self.id, e)
+        if self.status != "running":
+            await self.report()
+        logging.info("Рассылка #%s: %s, доставлено %s, ошибок %s, заблокировали бота %s.",
+                     self.id, self.status, self.sent, self.failed, self.blocked)
+
+
+async def start_broadcast_sender(bot: Bot, texts: dict, on_file_id=None):
+    """
+    Фоновая отправка рассылок админа (задача лидера), по одной, в порядке создания.
+    Незавершенная рассылка переживает перезапуск бота: продолжается с сохраненного курсора.
+    """
+    logging.info("Отправитель рассылок запущен.")
+    with send_lane(LANE_BULK):
+        while True:
+            _broadcast_wakeup.clear()
+            try:
+                while (row := await get_next_broadcast()) is not None:
+                    broadcast = BroadcastRun(bot, texts, row, on_file_id)
+                    await broadcast.run()
+                    if broadcast.status == "running":
+                        break # Аренда потеряна - продолжит новый лидер
+            except LeaseLost as e:
+                logging.warning("Рассылки: %s", e)
+            except Exception as e:
+                logging.exception("Ошибка в цикле отправки рассылок: %s", e)
+            try:
+                await asyncio.wait_for(_broadcast_wakeup.wait(), timeout=BROADCAST_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
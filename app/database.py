@@ -1,81 +1,332 @@
 import aiosqlite
+import json
+import time
 from datetime import datetime, timedelta
 import logging
 
-DATABASE_FILE = "bot_database.db"
-
-async def init_db():
-    """Инициализация базы данных."""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
-        # Таблица пользователей (хранит ID телеграм, ник и язык)
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                language TEXT DEFAULT 'en'
-            )
-        ''')
+from db_profiler import profiled_connect
 
-        # Таблица платежей (связана с users, хранит данные о платеже и TW аккаунте)
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS payments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,      -- ID пользователя Telegram
-                tw_username TEXT NOT NULL,   -- Имя пользователя TradingView
-                tx_hash TEXT UNIQUE NOT NULL,-- Хэш транзакции (уникальный)
-                amount REAL NOT NULL,        -- Сумма платежа
-                purchase_date TEXT NOT NULL, -- Дата покупки (YYYY-MM-DD)
-                subscription_end TEXT NOT NULL,-- Дата окончания подписки (YYYY-MM-DD)
-                FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE -- Удаление платежей при удалении пользователя
-            )
-        ''')
-
-        # Индексы для ускорения запросов
-        # Индекс по user_id и tw_username для поиска подписок конкретного пользователя для конкретного аккаунта
-        await db.execute('CREATE INDEX IF NOT EXISTS idx_payments_user_tw ON payments(user_id, tw_username)')
-        # Индекс по tw_username для админ-панели и поиска
-        await db.execute('CREATE INDEX IF NOT EXISTS idx_payments_tw_username ON payments(tw_username)')
-         # Индекс по дате окончания для планировщика
-        await db.execute('CREATE INDEX IF NOT EXISTS idx_payments_sub_end ON payments(subscription_end)')
-        await db.execute('CREATE INDEX IF NOT EXISTS idx_users_user_id ON users(user_id)')
-
-        # Миграция: проверка и добавление колонки language в users, если ее нет
-        try:
-            cursor = await db.execute("PRAGMA table_info(users)")
-            columns = [col[1] for col in await cursor.fetchall()]
-            if 'language' not in columns:
-                await db.execute('ALTER TABLE users ADD COLUMN language TEXT DEFAULT \'en\'')
-                logging.info("Добавлена колонка 'language' в таблицу 'users'.")
-        except Exception as e:
-            logging.error(f"Ошибка при проверке/миграции таблицы users: {e}")
+DATABASE_FILE = "bot_database.db"
 
-        await db.commit()
-        logging.info("Инициализация/проверка базы данных завершена.")
 
+def connect_db():
+    """
+    Открывает соединение с БД через профилирующую обертку.
+    Все обращения к БД должны идти через эту функцию, чтобы медленные запросы попадали в статистику.
+    """
+    return profiled_connect(DATABASE_FILE)
 
 async def save_payment(db: aiosqlite.Connection, user_id: int, tw_username: str, tx_hash: str,
-                       amount: float, purchase_date: str, subscription_end: str):
+                       amount: float, purchase_date: str, subscription_end: str, plan_id: str = None):
     """
     Сохранение записи о платеже. Используется внутри транзакции save_user_and_payment.
+    В той же транзакции обновляет сводки daily_revenue/daily_subscriptions.
     """
     try:
+        # Предыдущая подписка этой пары (user_id, tw_username) - для коррекции снимка активных/истекших
+        async with db.execute('''
+            SELECT subscription_end FROM payments
+            WHERE user_id = ? AND tw_username = ?
+            ORDER BY id DESC LIMIT 1
+        ''', (user_id, tw_username)) as cursor:
+            previous = await cursor.fetchone()
+
+        account_id = await upsert_tw_account(db, tw_username, user_id)
         await db.execute('''
             INSERT INTO payments
-            (user_id, tw_username, tx_hash, amount, purchase_date, subscription_end)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (user_id, tw_username, tx_hash, amount, purchase_date, subscription_end))
-        logging.info(f"Платеж для user_id={user_id}, tw_username='{tw_username}', hash='{tx_hash}' подготовлен к сохранению.")
+            (user_id, tw_username, account_id, tx_hash, amount, purchase_date, subscription_end, plan_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (user_id, tw_username, account_id, tx_hash, amount, purchase_date, subscription_end, plan_id))
+        await update_rollups_for_payment(db, purchase_date, plan_id, amount,
+                                         previous[0] if previous else None, subscription_end)
+        logging.info("Платеж для user_id=%s, tw_username='%s', hash='%s' подготовлен к сохранению.", user_id, tw_username, tx_hash)
     except aiosqlite.IntegrityError as e:
         # Обрабатывается в вызывающей функции (confirm_payment в app.py)
-        logging.error(f"Ошибка целостности при сохранении платежа (вероятно, дубликат хеша '{tx_hash}'): {e}")
+        logging.error("Ошибка целостности при сохранении платежа (вероятно, дубликат хеша '%s'): %s", tx_hash, e)
         raise
     except Exception as e:
-        logging.exception(f"Неизвестная ошибка при подготовке сохранения платежа: {e}")
+        logging.exception("Неизвестная ошибка при подготовке сохранения платежа: %s", e)
+        raise
+
+async def upsert_tw_account(db: aiosqlite.Connection, tw_username: str, user_id: int) -> int:
+    """
+    Добавляет аккаунт TradingView в справочник tw_accounts (или обновляет ник TG последнего плательщика).
+    Возвращает id аккаунта. Не коммитит: вызывается в транзакции платежа.
+    """
+    async with db.execute('''
+        INSERT INTO tw_accounts (tw_username, tg_username)
+        VALUES (?, (SELECT username FROM users WHERE user_id = ?))
+        ON CONFLICT(tw_username) DO UPDATE SET tg_username = excluded.tg_username
+        WHERE tg_username IS NOT excluded.tg_username
+        RETURNING id
+    ''', (tw_username, user_id)) as cursor:
+        row = await cursor.fetchone()
+    if row is None:
+        # Аккаунт уже есть и ник не изменился - UPDATE не выполнялся, RETURNING ничего не вернул
+        async with db.execute("SELECT id FROM tw_accounts WHERE tw_username = ?", (tw_username,)) as cursor:
+            row = await cursor.fetchone()
+    return row[0]
+
+async def import_payments_batch(db: aiosqlite.Connection, rows):
+    """
+    Импорт порции платежей из CSV (bulk-импорт админа) одной короткой транзакцией.
+    rows: [(line, user_id, tg_username, language, tw_username, tx_hash, amount, purchase_date,
+            subscription_end, extend_days, plan_id)] - уже проверенные строки файла;
+    subscription_end None - продление на extend_days от текущего окончания подписки пары
+    (от сегодня, если она уже истекла).
+    Поддерживает то же, что save_payment: справочник tw_accounts, сводки, уникальность tx_hash
+    вместе с архивом. Платежи помечаются verification_status='manual' (проверка в сети не нужна).
+    Соединение открывает вызывающий (одно на весь импорт, чтобы кеш страниц не остывал между порциями).
+    Возвращает (импортированные tx_hash, ошибки [(line, текст)]).
+    """
+    errors = []
+    today = datetime.now().strftime("%Y-%m-%d")
+    # Блокировка записи на всю порцию: между проверкой хешей и вставкой их никто не займет
+    await db.execute("BEGIN IMMEDIATE")
+    try:
+        hashes = [row[5] for row in rows]
+        placeholders = ",".join("?" * len(hashes))
+        async with db.execute(f'''
+            SELECT tx_hash FROM payments WHERE tx_hash IN ({placeholders})
+            UNION ALL
+            SELECT tx_hash FROM payments_archive WHERE tx_hash IN ({placeholders})
+        ''', hashes * 2) as cursor:
+            used = {row[0] for row in await cursor.fetchall()}
+        accepted = []
+        for row in rows:
+            if row[5] in used:
+                errors.append((row[0], f"tx_hash '{row[5]}' уже использован"))
+                continue
+            used.add(row[5])
+            accepted.append(row)
+        if not accepted:
+            await db.rollback()
+            return [], errors
+
+        # 1. Пользователи: новые создаются, у существующих обновляется только ник (если указан)
+        users = {row[1]: (row[1], row[2], row[3]) for row in accepted}
+        await db.executemany('''
+            INSERT INTO users (user_id, username, language) VALUES (?, ?, COALESCE(?, 'en'))
+            ON CONFLICT(user_id) DO UPDATE SET username = COALESCE(excluded.username, username)
+        ''', users.values())
+
+        # 2. Справочник аккаунтов (ник TG - последнего плательщика в порции)
+        accounts = {row[4]: (row[4], row[1]) for row in accepted}
+        await db.executemany('''
+            INSERT INTO tw_accounts (tw_username, tg_username)
+            VALUES (?, (SELECT username FROM users WHERE user_id = ?))
+            ON CONFLICT(tw_username) DO UPDATE SET tg_username = excluded.tg_username
+            WHERE tg_username IS NOT excluded.tg_username
+        ''', accounts.values())
+        placeholders = ",".join("?" * len(accounts))
+        async with db.execute(
+            f"SELECT tw_username, id FROM tw_accounts WHERE tw_username IN ({placeholders})", list(accounts)
+        ) as cursor:
+            account_ids = dict(await cursor.fetchall())
+
+        # 3. Текущее окончание подписки каждой пары - для продления и коррекции снимка подписок
+        pairs = list({(row[1], row[4]) for row in accepted})
+        values = ",".join("(?, ?)" for _ in pairs)
+        async with db.execute(f'''
+            WITH pairs(user_id, tw_username) AS (VALUES {values})
+            SELECT p.user_id, p.tw_username, p.subscription_end
+            FROM pairs
+            JOIN payments p ON p.id = (
+                SELECT MAX(id) FROM payments
+                WHERE user_id = pairs.user_id AND tw_username = pairs.tw_username
+            )
+        ''', [value for pair in pairs for value in pair]) as cursor:
+            latest = {(user_id, tw_username): end for user_id, tw_username, end in await cursor.fetchall()}
+
+        # 4. Платежи (по порядку строк файла: следующее продление идет от предыдущего)
+        payments = []
+        revenue = {}
+        active_delta = expired_delta = 0
+        for (line, user_id, _, _, tw_username, tx_hash, amount, purchase_date,
+             subscription_end, extend_days, plan_id) in accepted:
+            previous_end = latest.get((user_id, tw_username))
+            if subscription_end is None:
+                base = previous_end if previous_end and previous_end >= today else today
+                subscription_end = (datetime.strptime(base, "%Y-%m-%d") + timedelta(days=extend_days)).strftime("%Y-%m-%d")
+            latest[(user_id, tw_username)] = subscription_end
+            payments.append((user_id, tw_username, account_ids[tw_username], tx_hash, amount,
+                             purchase_date, subscription_end, plan_id))
+            # Те же правила, что в update_rollups_for_payment, но одним запросом на порцию
+            key = (purchase_date, plan_id or "other")
+            day_revenue = revenue.setdefault(key, [0.0, 0])
+            day_revenue[0] += amount
+            day_revenue[1] += 1
+            if subscription_end >= today and (previous_end is None or previous_end < today):
+                active_delta += 1
+                expired_delta -= 1 if previous_end is not None else 0
+        await db.executemany('''
+            INSERT INTO payments
+            (user_id, tw_username, account_id, tx_hash, amount, purchase_date, subscription_end, plan_id,
+             verification_status, verification_note)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'manual', 'import')
+        ''', payments)
+
+        # 5. Сводки
+        await db.executemany('''
+            INSERT INTO daily_revenue (day, plan_id, revenue, payments) VALUES (?, ?, ?, ?)
+            ON CONFLICT(day, plan_id) DO UPDATE SET
+                revenue = revenue + excluded.revenue,
+                payments = payments + excluded.payments
+        ''', [(day, plan_id, total, count) for (day, plan_id), (total, count) in revenue.items()])
+        if active_delta:
+            await adjust_subscription_snapshot(db, today, active_delta, expired_delta)
+        await db.commit()
+    except Exception:
+        await db.rollback()
         raise
+    return [payment[3] for payment in payments], errors
+
+async def enqueue_outbox_messages(db: aiosqlite.Connection, chat_ids, text: str, parse_mode: str = "Markdown"):
+    """
+    Кладет сообщение в outbox для каждого получателя, кроме заблокировавших бота.
+    Не коммитит: вызывается внутри транзакции, которая создает событие (платеж, результат проверки).
+    """
+    created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    await db.executemany('''
+        INSERT INTO admin_outbox (chat_id, text, parse_mode, created_at)
+        SELECT ?1, ?2, ?3, ?4
+        WHERE NOT EXISTS (SELECT 1 FROM users WHERE user_id = ?1 AND blocked_at IS NOT NULL)
+    ''', [(chat_id, text, parse_mode, created_at) for chat_id in chat_ids])
+
+async def get_blocked_user_ids():
+    """Множество user_id пользователей, заблокировавших бота."""
+    async with connect_db() as db:
+        async with db.execute("SELECT user_id FROM users WHERE blocked_at IS NOT NULL") as cursor:
+            return {row[0] for row in await cursor.fetchall()}
+
+async def mark_user_blocked(user_id: int):
+    """Отмечает, что пользователь заблокировал бота (время первой отметки сохраняется)."""
+    blocked_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    async with connect_db() as db:
+        await db.execute("UPDATE users SET blocked_at = ? WHERE user_id = ? AND blocked_at IS NULL",
+                         (blocked_at, user_id))
+        await db.commit()
+
+async def clear_user_blocked(user_id: int):
+    """Снимает отметку о блокировке: пользователь снова написал боту."""
+    async with connect_db() as db:
+        await db.execute("UPDATE users SET blocked_at = NULL WHERE user_id = ? AND blocked_at IS NOT NULL",
+                         (user_id,))
+        await db.commit()
+
+async def get_due_outbox_messages(now: float, limit: int):
+    """
+    Сообщения outbox, время отправки которых наступило.
+    Возвращает: [(id, chat_id, text, parse_mode, attempts)]
+    """
+    async with connect_db() as db:
+        query = '''
+            SELECT id, chat_id, text, parse_mode, attempts
+            FROM admin_outbox
+            WHERE next_attempt_at <= ?
+            ORDER BY next_attempt_at, id
+            LIMIT ?
+        '''
+        async with db.execute(query, (now, limit)) as cursor:
+            return await cursor.fetchall()
+
+async def complete_outbox_batch(done_ids, retries, fence=None):
+    """
+    Фиксирует результат отправки пачки в одной транзакции.
+    done_ids: [id] - доставлены (или отброшены), удаляются;
+    retries: [(next_attempt_at, id)] - повторить позже.
+    """
+    async with connect_db() as db:
+        await check_fence(db, fence)
+        if done_ids:
+            await db.executemany("DELETE FROM admin_outbox WHERE id = ?", [(i,) for i in done_ids])
+        if retries:
+            await db.executemany(
+                "UPDATE admin_outbox SET attempts = attempts + 1, next_attempt_at = ? WHERE id = ?", retries
+            )
+        await db.commit()
+
+async def update_rollups_for_payment(db: aiosqlite.Connection, purchase_date: str, plan_id: str, amount: float,
+                                     previous_end: str, subscription_end: str):
+    """
+    Инкрементально обновляет сводки при новом платеже (без коммита, внутри транзакции платежа).
+    previous_end: окончание предыдущей подписки этой пары (user_id, tw_username) или None.
+    """
+    await db.execute('''
+        INSERT INTO daily_revenue (day, plan_id, revenue, payments) VALUES (?, ?, ?, 1)
+        ON CONFLICT(day, plan_id) DO UPDATE SET
+            revenue = revenue + excluded.revenue,
+            payments = payments + 1
+    ''', (purchase_date, plan_id or "other", amount))
+
+    # Снимок за сегодня: подписка стала активной
+    today = datetime.now().strftime("%Y-%m-%d")
+    if subscription_end >= today and (previous_end is None or previous_end < today):
+        await adjust_subscription_snapshot(db, today, 1, -1 if previous_end is not None else 0)
+
+async def adjust_subscription_snapshot(db: aiosqlite.Connection, day: str, active_delta: int, expired_delta: int):
+    """
+    Корректирует снимок подписок за день после платежей (без коммита, внутри транзакции платежа).
+    Если планировщик еще не сделал снимок за этот день, строка создается из последнего прежнего
+    снимка с поправкой - иначе платежи до снимка пропали бы из /stats. Планировщик затем
+    перезаписывает ее полным пересчетом.
+    """
+    await db.execute('''
+        INSERT INTO daily_subscriptions (day, active, expired)
+        SELECT ?1, MAX(0, COALESCE(last.active, 0) + ?2), MAX(0, COALESCE(last.expired, 0) + ?3)
+        FROM (SELECT 1) LEFT JOIN (
+            SELECT active, expired FROM daily_subscriptions WHERE day < ?1 ORDER BY day DESC LIMIT 1
+        ) AS last
+        WHERE true
+        ON CONFLICT(day) DO UPDATE SET
+            active = MAX(0, active + ?2),
+            expired = MAX(0, expired + ?3)
+    ''', (day, active_delta, expired_delta))
+
+async def save_subscription_snapshot(day: str, active: int, expired: int):
+    """Сохраняет снимок числа активных/истекших подписок (пишет планировщик)."""
+    async with connect_db() as db:
+        await db.execute('''
+            INSERT INTO daily_subscriptions (day, active, expired) VALUES (?, ?, ?)
+            ON CONFLICT(day) DO UPDATE SET active = excluded.active, expired = excluded.expired
+        ''', (day, active, expired))
+        await db.commit()
+
+async def get_revenue_by_plan(day_from: str, day_to: str):
+    """Выручка и число платежей по планам за период (только из сводки). [(plan_id, revenue, payments)]"""
+    async with connect_db() as db:
+        query = '''
+            SELECT plan_id, SUM(revenue), SUM(payments)
+            FROM daily_revenue
+            WHERE day >= ? AND day <= ?
+            GROUP BY plan_id
+            ORDER BY SUM(revenue) DESC
+        '''
+        async with db.execute(query, (day_from, day_to)) as cursor:
+            return await cursor.fetchall()
+
+async def get_revenue_by_day(day_from: str, day_to: str):
+    """Выручка и число платежей по дням за период (только из сводки). [(day, revenue, payments)]"""
+    async with connect_db() as db:
+        query = '''
+            SELECT day, SUM(revenue), SUM(payments)
+            FROM daily_revenue
+            WHERE day >= ? AND day <= ?
+            GROUP BY day
+            ORDER BY day DESC
+        '''
+        async with db.execute(query, (day_from, day_to)) as cursor:
+            return await cursor.fetchall()
+
+async def get_latest_subscription_snapshot():
+    """Последний снимок подписок: (day, active, expired) или None."""
+    async with connect_db() as db:
+        async with db.execute("SELECT day, active, expired FROM daily_subscriptions ORDER BY day DESC LIMIT 1") as cursor:
+            return await cursor.fetchone()
 
 async def get_user_language(user_id: int) -> str:
     """Получает язык пользователя из БД, по умолчанию 'en'."""
-    async with aiosqlite.connect(DATABASE_FILE) as db:
+    async with connect_db() as db:
         async with db.execute("SELECT language FROM users WHERE user_id = ?", (user_id,)) as cursor:
             result = await cursor.fetchone()
             return result[0] if result and result[0] else 'en'
@@ -86,66 +337,187 @@ async def get_distinct_tw_usernames_with_users():
     """
     Получение списка уникальных TW аккаунтов и связанных с ними пользователей Telegram.
     Используется для построения списка в админ-панели.
-    Возвращает: список кортежей [(tw_username, tg_user_id, tg_username)]
+    Возвращает: список кортежей [(account_id, tw_username, tg_user_id, tg_username)]
                отсортированный по tw_username.
     """
-    async with aiosqlite.connect(DATABASE_FILE) as db:
-        # Выбираем уникальные tw_username, и для каждого берем user_id и username
-        # из ПОСЛЕДНЕГО платежа для этого tw_username (на случай если разные юзеры платили за один TW акк)
+    async with connect_db() as db:
+        # Для каждого аккаунта берем user_id и username из ПОСЛЕДНЕГО платежа
+        # (на случай если разные юзеры платили за один TW акк).
         # Хотя логика бота не должна этого допускать, но для надежности запроса.
         query = '''
             SELECT
-                p.tw_username,
+                a.id,
+                a.tw_username,
                 p.user_id,
                 u.username
-            FROM payments p
+            FROM tw_accounts a
+            JOIN payments p ON p.id = (SELECT MAX(id) FROM payments WHERE account_id = a.id)
             LEFT JOIN users u ON p.user_id = u.user_id
-            WHERE p.id IN (
-                -- Находим ID последнего платежа для каждого tw_username
-                SELECT MAX(id) FROM payments GROUP BY tw_username
-            )
-            ORDER BY p.tw_username COLLATE NOCASE; -- Сортировка без учета регистра
+            ORDER BY a.tw_username COLLATE NOCASE; -- Сортировка без учета регистра
         '''
         async with db.execute(query) as cursor:
             return await cursor.fetchall()
 
-async def get_payments_for_tw_account(tw_username: str):
+async def get_payments_for_tw_account(account_id: int):
     """
-    Получение ВСЕХ платежей для конкретного аккаунта TradingView.
+    Получение ВСЕХ платежей (включая архивные) для аккаунта TradingView по его id в tw_accounts.
     Используется для показа деталей и истории в админ-панели.
     Возвращает: список кортежей платежей + telegram username, отсортированный от новых к старым.
-    Структура кортежа: (id, user_id, tw_username, tx_hash, amount, purchase_date, subscription_end, tg_username)
+    Структура кортежа: (id, user_id, tw_username, tx_hash, amount, purchase_date, subscription_end, tg_username,
+                        verification_status)
     """
-    async with aiosqlite.connect(DATABASE_FILE) as db:
+    async with connect_db() as db:
+        # Читаем и горячую таблицу, и архив: для админки история выглядит единой
         query = '''
             SELECT
                 p.id, p.user_id, p.tw_username, p.tx_hash, p.amount,
                 p.purchase_date, p.subscription_end,
-                u.username AS tg_username
-            FROM payments p
+                u.username AS tg_username,
+                p.verification_status
+            FROM (
+                SELECT id, user_id, tw_username, tx_hash, amount, purchase_date, subscription_end, verification_status
+                FROM payments WHERE account_id = ?
+                UNION ALL
+                SELECT id, user_id, tw_username, tx_hash, amount, purchase_date, subscription_end, verification_status
+                FROM payments_archive WHERE account_id = ?
+            ) p
             LEFT JOIN users u ON p.user_id = u.user_id -- Используем LEFT JOIN на случай, если юзер удален
-            WHERE p.tw_username = ?
             ORDER BY p.purchase_date DESC, p.id DESC; -- Сортируем по дате, затем по ID
         '''
-        async with db.execute(query, (tw_username,)) as cursor:
+        async with db.execute(query, (account_id, account_id)) as cursor:
+            return await cursor.fetchall()
+
+async def iter_payments_for_export(date_from: str = None, date_to: str = None, active_only: bool = False):
+    """
+    Асинхронный генератор платежей (архив + горячая таблица) для выгрузки, по возрастанию id.
+    Строки читаются курсором порциями, таблица целиком в память не загружается.
+    date_from/date_to: фильтр по purchase_date (YYYY-MM-DD, включительно);
+    active_only: только платежи с еще не истекшей подпиской.
+    Отдает кортежи: (id, user_id, tg_username, tw_username, tx_hash, amount, purchase_date,
+                     subscription_end, verification_status, plan_id)
+    """
+    conditions = []
+    params = []
+    if date_from:
+        conditions.append("p.purchase_date >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("p.purchase_date <= ?")
+        params.append(date_to)
+    if active_only:
+        conditions.append("p.subscription_end >= ?")
+        params.append(datetime.now().strftime("%Y-%m-%d"))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    async with connect_db() as db:
+        # Сначала архив (старые платежи), затем горячая таблица - без общей сортировки,
+        # чтобы не строить временное B-дерево по всей выборке
+        for table in ("payments_archive", "payments"):
+            query = f'''
+                SELECT
+                    p.id, p.user_id, u.username, p.tw_username, p.tx_hash, p.amount,
+                    p.purchase_date, p.subscription_end, p.verification_status, p.plan_id
+                FROM {table} p
+                LEFT JOIN users u ON p.user_id = u.user_id
+                {where}
+                ORDER BY p.id
+            '''
+            async with db.execute(query, params) as cursor:
+                async for row in cursor:
+                    yield row
+
+async def search_tw_accounts(query: str, limit: int, offset: int = 0):
+    """
+    Поиск аккаунтов по подстроке в нике TradingView или Telegram (без учета регистра).
+    Запросы от 3 символов идут через триграммный индекс FTS5, более короткие - префиксным
+    поиском по индексам NOCASE.
+    Возвращает: [(account_id, tw_username, tg_username)], отсортированный по tw_username.
+    Пустой запрос (в том числе из одного "@") ничего не находит - иначе префикс совпал бы со всеми.
+    """
+    query = query.strip().lstrip("@").strip()
+    if not query:
+        return []
+    async with connect_db() as db:
+        if len(query) >= 3:
+            sql = '''
+                SELECT a.id, a.tw_username, a.tg_username
+                FROM account_search f
+                JOIN tw_accounts a ON a.id = f.rowid
+                WHERE account_search MATCH ?
+                ORDER BY a.tw_username COLLATE NOCASE
+                LIMIT ? OFFSET ?
+            '''
+            # Запрос как фраза: trigram ищет ее как подстроку в любой колонке
+            params = ('"' + query.replace('"', '""') + '"', limit, offset)
+        else:
+            sql = '''
+                SELECT id, tw_username, tg_username FROM tw_accounts
+                WHERE tw_username >= ? COLLATE NOCASE AND tw_username < ? COLLATE NOCASE
+                UNION
+                SELECT id, tw_username, tg_username FROM tw_accounts
+                WHERE tg_username >= ? COLLATE NOCASE AND tg_username < ? COLLATE NOCASE
+                ORDER BY 2 COLLATE NOCASE
+                LIMIT ? OFFSET ?
+            '''
+            upper = query + "\U0010ffff"
+            params = (query, upper, query, upper, limit, offset)
+        async with db.execute(sql, params) as cursor:
             return await cursor.fetchall()
 
+# --- Функции для проверки транзакций в сети TRON ---
+
+async def get_pending_verifications(after_id: int, limit: int):
+    """
+    Платежи, ожидающие проверки в сети (по частичному индексу idx_payments_pending), с id > after_id.
+    Возвращает: [(id, user_id, tw_username, tx_hash, amount, verify_attempts)]
+    """
+    async with connect_db() as db:
+        query = '''
+            SELECT id, user_id, tw_username, tx_hash, amount, verify_attempts
+            FROM payments
+            WHERE verification_status = 'pending' AND id > ?
+            ORDER BY id
+            LIMIT ?
+        '''
+        async with db.execute(query, (after_id, limit)) as cursor:
+            return await cursor.fetchall()
+
+async def save_verification_results(results, admin_ids=(), admin_messages=()):
+    """
+    Сохраняет результаты проверки пачкой в одной транзакции вместе с уведомлениями админам (outbox).
+    results: [(verification_status, verification_note, payment_id)]
+    admin_messages: [text] - по одному сообщению на каждого из admin_ids
+    """
+    async with connect_db() as db:
+        await db.executemany('''
+            UPDATE payments
+            SET verification_status = ?, verification_note = ?, verify_attempts = verify_attempts + 1
+            WHERE id = ?
+        ''', results)
+        for text in admin_messages:
+            await enqueue_outbox_messages(db, admin_ids, text)
+        await db.commit()
+
 # --- Функции для Планировщика Уведомлений ---
 
-async def get_subscriptions_for_notification_check():
+async def get_subscriptions_for_notification_check(expired_day: str):
     """
     Получает данные о ПОСЛЕДНЕЙ подписке для КАЖДОЙ уникальной пары (user_id, tw_username).
+    Пользователи, заблокировавшие бота, отбираются только с подпиской, истекшей в день expired_day
+    (по ней админы один раз получают уведомление), остальные их подписки не проверяются.
     Возвращает список кортежей:
-    (user_id, tw_username, subscription_end, language, tg_username)
+    (user_id, tw_username, subscription_end, language, tg_username, timezone, blocked)
     """
-    async with aiosqlite.connect(DATABASE_FILE) as db:
+    async with connect_db() as db:
         query = """
             SELECT
                 p.user_id,
                 p.tw_username,
                 p.subscription_end,
                 COALESCE(u.language, 'en') as language, -- Язык пользователя, 'en' если не найден
-                u.username as tg_username -- Имя пользователя TG для уведомлений админам
+                u.username as tg_username, -- Имя пользователя TG для уведомлений админам
+                u.timezone, -- Часовой пояс (NULL - определяется по языку)
+                u.blocked_at IS NOT NULL as blocked
             FROM payments p
             JOIN users u ON p.user_id = u.user_id -- JOIN чтобы получить язык и имя пользователя
             WHERE p.id IN (
@@ -154,10 +526,395 @@ async def get_subscriptions_for_notification_check():
                 FROM payments
                 GROUP BY user_id, tw_username
             )
+            AND (u.blocked_at IS NULL OR p.subscription_end = ?)
+            ORDER BY p.user_id, p.tw_username -- Стабильный порядок: по нему продолжается прерванная проверка
+        """
+        async with db.execute(query, (expired_day,)) as cursor:
+            return await cursor.fetchall()
+
+async def get_latest_subscription_ends():
+    """
+    Окончание последней подписки каждой пары (user_id, tw_username) для expiry_index.
+    Возвращает (последний payments.id, [(user_id, tw_username, subscription_end)]).
+    Оба запроса - в одной читающей транзакции, поэтому id и подписки согласованы.
+    """
+    async with connect_db() as db:
+        await db.execute("BEGIN")
+        try:
+            async with db.execute("SELECT COALESCE(MAX(id), 0) FROM payments") as cursor:
+                last_id = (await cursor.fetchone())[0]
+            query = """
+                SELECT user_id, tw_username, subscription_end
+                FROM payments
+                WHERE id IN (SELECT MAX(id) FROM payments GROUP BY user_id, tw_username)
+            """
+            async with db.execute(query) as cursor:
+                rows = await cursor.fetchall()
+        finally:
+            await db.rollback()
+    return last_id, rows
+
+async def get_subscription_ends_after(after_id: int):
+    """
+    Платежи с id больше after_id по возрастанию id (догоняющее обновление expiry_index).
+    Возвращает: [(id, user_id, tw_username, subscription_end)]
+    """
+    async with connect_db() as db:
+        query = "SELECT id, user_id, tw_username, subscription_end FROM payments WHERE id > ? ORDER BY id"
+        async with db.execute(query, (after_id,)) as cursor:
+            return await cursor.fetchall()
+
+async def get_subscription_ends_checksum():
+    """
+    Контрольная сумма последних подписок для сверки expiry_index: число подписок с корректной
+    датой окончания, сумма их номеров дней (date.toordinal) и последний payments.id.
+    Считается целиком в SQLite, строки в Python не передаются.
+    """
+    async with connect_db() as db:
+        query = """
+            SELECT COUNT(*),
+                   CAST(TOTAL(julianday(subscription_end) - 1721424.5) AS INTEGER),
+                   (SELECT COALESCE(MAX(id), 0) FROM payments)
+            FROM payments
+            WHERE id IN (SELECT MAX(id) FROM payments GROUP BY user_id, tw_username)
+              AND date(subscription_end) IS subscription_end
         """
         async with db.execute(query) as cursor:
+            return await cursor.fetchone()
+
+async def get_notification_contacts(user_ids):
+    """
+    Язык, имя в Telegram, часовой пояс и отметка о блокировке бота пользователей для напоминаний.
+    Возвращает: {user_id: (language, tg_username, timezone, blocked)}
+    """
+    user_ids = list(user_ids)
+    contacts = {}
+    async with connect_db() as db:
+        # Порциями: число параметров запроса ограничено
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            query = f"""
+                SELECT user_id, COALESCE(language, 'en'), username, timezone, blocked_at IS NOT NULL
+                FROM users WHERE user_id IN ({placeholders})
+            """
+            async with db.execute(query, chunk) as cursor:
+                async for user_id, language, tg_username, timezone, blocked in cursor:
+                    contacts[user_id] = (language, tg_username, timezone, blocked)
+    return contacts
+
+async def get_notification_forecast(start_day: str, days: int):
+    """
+    Прогноз напоминаний проверки подписок на days дней вперед, начиная с start_day, одним запросом.
+    Те же правила, что в service.check_subscriptions, при условии, что никто не продлит подписку:
+    предупреждение - до окончания 0-2 дня, истекшая - окончание раньше дня проверки.
+    Последние подписки сначала сворачиваются по дате окончания, поэтому соединение с днями
+    стоит O(дней x различных дат), а не O(дней x подписок).
+    Возвращает: [(day, warnings, expired)] по возрастанию day.
+    """
+    async with connect_db() as db:
+        query = """
+            WITH RECURSIVE days(n, day) AS (
+                SELECT 0, date(?)
+                UNION ALL
+                SELECT n + 1, date(day, '+1 day') FROM days WHERE n + 1 < ?
+            ),
+            ends(end_day, subscriptions) AS (
+                SELECT p.subscription_end, COUNT(*)
+                FROM payments p
+                JOIN users u ON p.user_id = u.user_id
+                WHERE p.id IN (SELECT MAX(id) FROM payments GROUP BY user_id, tw_username)
+                GROUP BY p.subscription_end
+            )
+            SELECT
+                d.day,
+                COALESCE(SUM(CASE WHEN e.end_day >= d.day AND e.end_day < date(d.day, '+3 day')
+                                  THEN e.subscriptions END), 0),
+                COALESCE(SUM(CASE WHEN e.end_day < d.day THEN e.subscriptions END), 0)
+            FROM days d
+            LEFT JOIN ends e
+            GROUP BY d.day
+            ORDER BY d.day
+        """
+        async with db.execute(query, (start_day, days)) as cursor:
             return await cursor.fetchall()
 
+async def get_scheduler_state(name: str):
+    """Сохраненное состояние фоновой задачи (dict) или None."""
+    async with connect_db() as db:
+        async with db.execute("SELECT value FROM scheduler_state WHERE name = ?", (name,)) as cursor:
+            row = await cursor.fetchone()
+            return json.loads(row[0]) if row else None
+
+async def save_scheduler_state(name: str, state: dict, fence=None):
+    """Сохраняет состояние фоновой задачи (чекпойнт). fence - см. check_fence."""
+    updated_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    async with connect_db() as db:
+        await check_fence(db, fence)
+        await db.execute('''
+            INSERT INTO scheduler_state (name, value, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+        ''', (name, json.dumps(state), updated_at))
+        await db.commit()
+
+async def enqueue_reminders(reminders, fence=None):
+    """
+    Планирует напоминания о подписках. Повторное планирование того же напоминания за тот же день
+    игнорируется, поэтому прерванную проверку подписок можно безопасно повторить.
+    reminders: [(user_id, tw_username, kind, plan_day, subscription_end, language, tg_username, send_at, days)]
+    """
+    async with connect_db() as db:
+        await check_fence(db, fence)
+        await db.executemany('''
+            INSERT OR IGNORE INTO reminder_queue
+            (user_id, tw_username, kind, plan_day, subscription_end, language, tg_username, send_at, days)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', reminders)
+        await db.commit()
+
+async def get_due_reminders(now: float, limit: int):
+    """
+    Напоминания, время отправки которых наступило, вместе с текущим окончанием подписки пары
+    (чтобы не напоминать о уже продленной подписке) и отметкой о блокировке бота пользователем.
+    Возвращает: [(id, user_id, tw_username, kind, subscription_end, language, tg_username, attempts,
+                  current_end, days, blocked)]
+    """
+    async with connect_db() as db:
+        query = '''
+            SELECT r.id, r.user_id, r.tw_username, r.kind, r.subscription_end, r.language, r.tg_username, r.attempts,
+                   (SELECT p.subscription_end FROM payments p
+                    WHERE p.user_id = r.user_id AND p.tw_username = r.tw_username
+                    ORDER BY p.id DESC LIMIT 1),
+                   r.days,
+                   u.blocked_at IS NOT NULL
+            FROM reminder_queue r
+            LEFT JOIN users u ON u.user_id = r.user_id
+            WHERE r.send_at <= ?
+            ORDER BY r.send_at
+            LIMIT ?
+        '''
+        async with db.execute(query, (now, limit)) as cursor:
+            return await cursor.fetchall()
+
+async def get_next_reminder_time():
+    """Время ближайшего запланированного напоминания (unix time) или None."""
+    async with connect_db() as db:
+        async with db.execute("SELECT MIN(send_at) FROM reminder_queue") as cursor:
+            return (await cursor.fetchone())[0]
+
+async def complete_reminders(done_ids, retries, admin_ids=(), admin_messages=(), fence=None):
+    """
+    Фиксирует результат отправки напоминаний одной транзакцией.
+    done_ids: [id] - отправлены (или отброшены), удаляются; retries: [(send_at, id)] - повторить позже;
+    admin_messages: уведомления админам (об истекших подписках), кладутся в outbox.
+    """
+    async with connect_db() as db:
+        await check_fence(db, fence)
+        if done_ids:
+            await db.executemany("DELETE FROM reminder_queue WHERE id = ?", [(i,) for i in done_ids])
+        if retries:
+            await db.executemany(
+                "UPDATE reminder_queue SET attempts = attempts + 1, send_at = ? WHERE id = ?", retries
+            )
+        for message in admin_messages:
+            await enqueue_outbox_messages(db, admin_ids, message)
+        await db.commit()
+
+async def get_user_timezone(user_id: int):
+    """Часовой пояс, указанный пользователем, или None."""
+    async with connect_db() as db:
+        async with db.execute("SELECT timezone FROM users WHERE user_id = ?", (user_id,)) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else None
+
+async def set_user_timezone(user_id: int, timezone: str):
+    """Сохраняет часовой пояс пользователя (None - определять по языку)."""
+    async with connect_db() as db:
+        await db.execute("UPDATE users SET timezone = ? WHERE user_id = ?", (timezone, user_id))
+        await db.commit()
+
+# --- Рассылки админа ---
+
+def _broadcast_recipients_filter(language: str, active_on: str):
+    """Условие отбора получателей рассылки (общее для подсчета и выборки) и его параметры."""
+    where = "blocked_at IS NULL"
+    params = []
+    if language:
+        where += " AND COALESCE(language, 'en') = ?"
+        params.append(language)
+    if active_on:
+        where += " AND EXISTS (SELECT 1 FROM payments p WHERE p.user_id = users.user_id AND p.subscription_end >= ?)"
+        params.append(active_on)
+    return where, params
+
+async def create_broadcast(created_by: int, admin_language: str, language: str, active_on: str, content: dict):
+    """
+    Создает черновик рассылки (ждет подтверждения админа) вместе с числом получателей на момент создания.
+    language: фильтр по языку или None; active_on: дата - только с действующей на нее подпиской, или None.
+    Возвращает (id, total).
+    """
+    created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    where, params = _broadcast_recipients_filter(language, active_on)
+    async with connect_db() as db:
+        async with db.execute(f"SELECT COUNT(*) FROM users WHERE {where}", params) as cursor:
+            total = (await cursor.fetchone())[0]
+        async with db.execute('''
+            INSERT INTO broadcasts (created_by, created_at, admin_language, language, active_on, content, total)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            RETURNING id
+        ''', (created_by, created_at, admin_language, language, active_on, json.dumps(content, ensure_ascii=False),
+              total)) as cursor:
+            broadcast_id = (await cursor.fetchone())[0]
+        await db.commit()
+    return broadcast_id, total
+
+async def get_next_broadcast():
+    """
+    Самая ранняя незавершенная рассылка или None.
+    Возвращает: (id, admin_language, language, active_on, content, cursor, total, sent, failed, blocked,
+                 report_chat_id, report_message_id)
+    """
+    async with connect_db() as db:
+        query = '''
+            SELECT id, admin_language, language, active_on, content, cursor, total, sent, failed, blocked,
+                   report_chat_id, report_message_id
+            FROM broadcasts WHERE status = 'running'
+            ORDER BY id LIMIT 1
+        '''
+        async with db.execute(query) as cursor:
+            row = await cursor.fetchone()
+    if row is None:
+        return None
+    return row[:4] + (json.loads(row[4]),) + row[5:]
+
+async def get_broadcast_recipients(after_user_id: int, language: str, active_on: str, limit: int):
+    """
+    Следующая страница получателей рассылки по возрастанию user_id (курсор - последний user_id).
+    Заблокировавшие бота пропускаются. Возвращает: [(user_id, language)]
+    """
+    where, params = _broadcast_recipients_filter(language, active_on)
+    async with connect_db() as db:
+        query = f'''
+            SELECT user_id, COALESCE(language, 'en') FROM users
+            WHERE user_id > ? AND {where}
+            ORDER BY user_id LIMIT ?
+        '''
+        async with db.execute(query, (after_user_id, *params, limit)) as cursor:
+            return await cursor.fetchall()
+
+async def save_broadcast_progress(broadcast_id: int, cursor: int, sent: int, failed: int, blocked: int,
+                                  status: str = "running", fence=None) -> bool:
+    """
+    Чекпойнт рассылки: курсор, счетчики и (при завершении) итоговый статус.
+    Возвращает False, если рассылку уже отменили - отправку нужно прекратить.
+    """
+    finished_at = None if status == "running" else datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    async with connect_db() as db:
+        await check_fence(db, fence)
+        result = await db.execute('''
+            UPDATE broadcasts SET cursor = ?, sent = ?, failed = ?, blocked = ?, status = ?, finished_at = ?
+            WHERE id = ? AND status = 'running'
+        ''', (cursor, sent, failed, blocked, status, finished_at, broadcast_id))
+        await db.commit()
+    return result.rowcount == 1
+
+async def start_broadcast(broadcast_id: int, report_chat_id: int, report_message_id: int):
+    """
+    Запускает подтвержденный черновик рассылки; ход рассылки показывается в сообщении report_message_id.
+    Возвращает число получателей или None - черновика нет (уже запущен или отменен).
+    """
+    async with connect_db() as db:
+        async with db.execute('''
+            UPDATE broadcasts SET status = 'running', report_chat_id = ?, report_message_id = ?
+            WHERE id = ? AND status = 'draft'
+            RETURNING total
+        ''', (report_chat_id, report_message_id, broadcast_id)) as cursor:
+            row = await cursor.fetchone()
+        await db.commit()
+    return row[0] if row else None
+
+async def cancel_broadcast(broadcast_id: int) -> bool:
+    """Отменяет черновик или незавершенную рассылку. False - такой нет или она уже завершена."""
+    finished_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    async with connect_db() as db:
+        result = await db.execute(
+            "UPDATE broadcasts SET status = 'cancelled', finished_at = ? WHERE id = ? AND status IN ('draft', 'running')",
+            (finished_at, broadcast_id)
+        )
+        await db.commit()
+    return result.rowcount == 1
+
+async def get_recent_broadcasts(limit: int):
+    """Последние рассылки: [(id, created_at, status, language, active_on, total, sent, failed, blocked)]"""
+    async with connect_db() as db:
+        query = '''
+            SELECT id, created_at, status, language, active_on, total, sent, failed, blocked
+            FROM broadcasts ORDER BY id DESC LIMIT ?
+        '''
+        async with db.execute(query, (limit,)) as cursor:
+            return await cursor.fetchall()
+
+# --- Аренда лидера (один экземпляр бота выполняет фоновые рассылки) ---
+
+class LeaseLost(Exception):
+    """Запись от имени лидера отклонена: аренду уже перехватил другой экземпляр (фенсинг)."""
+
+async def try_acquire_lease(name: str, holder: str, ttl: float):
+    """
+    Захватывает или продлевает аренду одним атомарным запросом.
+    Чужая аренда перехватывается, только если истекла; при смене владельца токен фенсинга растет.
+    Возвращает токен, если аренда наша, иначе None.
+    """
+    now = time.time()
+    async with connect_db() as db:
+        async with db.execute('''
+            INSERT INTO leases (name, holder, token, expires_at, renewed_at) VALUES (?, ?, 1, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                token = CASE WHEN holder = excluded.holder THEN token ELSE token + 1 END,
+                holder = excluded.holder,
+                expires_at = excluded.expires_at,
+                renewed_at = excluded.renewed_at
+            WHERE holder = excluded.holder OR expires_at < excluded.renewed_at
+            RETURNING token
+        ''', (name, holder, now + ttl, now)) as cursor:
+            row = await cursor.fetchone()
+        await db.commit()
+        return row[0] if row else None
+
+async def release_lease(name: str, holder: str, token: int):
+    """Освобождает аренду (корректная остановка): резервный экземпляр подхватит ее без ожидания TTL."""
+    async with connect_db() as db:
+        await db.execute(
+            "UPDATE leases SET expires_at = 0 WHERE name = ? AND holder = ? AND token = ?", (name, holder, token)
+        )
+        await db.commit()
+
+async def check_fence(db: aiosqlite.Connection, fence):
+    """
+    Проверка токена фенсинга - первым запросом транзакции записи.
+    fence: (name, token) или None (без проверки). UPDATE сразу берет блокировку записи, поэтому
+    между проверкой и записью аренду никто не перехватит. Аренда не наша - LeaseLost, транзакция
+    откатывается при закрытии соединения.
+    """
+    if fence is None:
+        return
+    name, token = fence
+    now = time.time()
+    cursor = await db.execute(
+        "UPDATE leases SET renewed_at = ? WHERE name = ? AND token = ? AND expires_at > ?", (now, name, token, now)
+    )
+    if cursor.rowcount != 1:
+        raise LeaseLost(f"Аренда '{name}' с токеном {token} больше не действует.")
+
+async def checkpoint_wal():
+    """
+    Переносит WAL в основной файл БД и обрезает его (при остановке бота).
+    Возвращает (busy, страниц в WAL, перенесено страниц).
+    """
+    async with connect_db() as db:
+        async with db.execute("PRAGMA wal_checkpoint(TRUNCATE)") as cursor:
+            return await cursor.fetchone()
+
 
 # Убраны старые функции get_expiring_subscriptions и get_expired_subscriptions,
 # т.к. новая функция get_subscriptions_for_notification_check() дает все данные,
@@ -167,5 +924,5 @@ async def get_subscriptions_for_notification_check():
 # и логика проверки активности теперь учитывает tw_username.
 
 # Убрана функция get_all_clients(), заменена на get_distinct_tw_usernames_with_users().
-# Убрана функция get_client_payments(tw_username), заменена на get_payments_for_tw_account(tw_username).
+# Убрана функция get_client_payments(tw_username), заменена на get_payments_for_tw_account(account_id).
 # Убрана функция save_user(), т.к. пользователь сохраняется вместе с платежом.
\ No newline at end of file
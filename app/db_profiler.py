@@ -0,0 +1,206 @@
+import logging
+import os
+import re
+import sqlite3
+import time
+from collections import OrderedDict, deque
+
+import aiosqlite
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Порог (мс), после которого запрос считается медленным и логируется вместе с планом
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+# Сколько разных запросов держим в статистике (самые давние вытесняются)
+MAX_TRACKED_STATEMENTS = 200
+# Сколько последних замеров храним на запрос для расчета p95
+RECENT_SAMPLES = 100
+# Как часто (сек) можно повторно снимать план для одного и того же запроса
+PLAN_RECAPTURE_INTERVAL = 600
+
+# Запросы, для которых EXPLAIN QUERY PLAN не имеет смысла
+_NO_PLAN_PREFIXES = ("PRAGMA", "BEGIN", "COMMIT", "ROLLBACK", "CREATE", "ALTER", "DROP",
+                     "EXPLAIN", "VACUUM", "ANALYZE", "SAVEPOINT", "RELEASE", "ATTACH", "DETACH")
+
+
+class QueryStat:
+    """Накопленная статистика по одному (нормализованному) запросу."""
+    __slots__ = ("sql", "count", "total_ms", "max_ms", "slow_count", "recent",
+                 "plan", "full_scan", "plan_captured_at")
+
+    def __init__(self, sql: str):
+        self.sql = sql
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.slow_count = 0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+        self.plan = None
+        self.full_scan = False
+        self.plan_captured_at = 0.0
+
+    @property
+    def avg_ms(self) -> float:
+        return self.total_ms / self.count if self.count else 0.0
+
+    @property
+    def p95_ms(self) -> float:
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+# Статистика по запросам: нормализованный SQL -> QueryStat (LRU)
+_query_stats: "OrderedDict[str, QueryStat]" = OrderedDict()
+
+
+def normalize_sql(sql: str) -> str:
+    """Убирает комментарии и лишние пробелы, чтобы одинаковые запросы попадали в одну запись."""
+    sql = re.sub(r"--[^\n]*", "", sql)
+    return re.sub(r"\s+", " ", sql).strip().rstrip(";")
+
+
+def _get_stat(key: str) -> QueryStat:
+    stat = _query_stats.get(key)
+    if stat is None:
+        stat = QueryStat(key)
+        _query_stats[key] = stat
+        if len(_query_stats) > MAX_TRACKED_STATEMENTS:
+            _query_stats.popitem(last=False)
+    else:
+        _query_stats.move_to_end(key)
+    return stat
+
+
+def plan_has_full_scan(plan_rows) -> bool:
+    """
+    True, если в плане есть полный обход таблицы или индекса (SCAN ...).
+    SEARCH означает поиск по индексу и не считается проблемой.
+    """
+    for row in plan_rows:
+        detail = row[-1]
+        if detail.startswith("SCAN ") and not detail.startswith("SCAN CONSTANT ROW"):
+            return True
+    return False
+
+
+def get_query_stats(limit: int = 10):
+    """Возвращает самые "дорогие" по суммарному времени запросы (список QueryStat)."""
+    return sorted(_query_stats.values(), key=lambda s: s.total_ms, reverse=True)[:limit]
+
+
+def reset_query_stats():
+    _query_stats.clear()
+
+
+class _CursorResult:
+    """
+    Результат execute/executemany, как у aiosqlite: его можно await-ить (курсор) или использовать
+    в async with (курсор закрывается на выходе).
+    """
+    __slots__ = ("_coro", "_cursor")
+
+    def __init__(self, coro):
+        self._coro = coro
+        self._cursor = None
+
+    def __await__(self):
+        return self._coro.__await__()
+
+    async def __aenter__(self):
+        self._cursor = await self._coro
+        return self._cursor
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._cursor.close()
+
+
+class ProfiledConnection:
+    """
+    Обертка над соединением aiosqlite.connect(), которая замеряет время каждого запроса,
+    ведет статистику, снимает EXPLAIN QUERY PLAN для каждого нового запроса и логирует медленные.
+    Время замеряется до получения первой строки (основная работа SQLite для наших запросов).
+    Использует только публичный API aiosqlite; остальные атрибуты передаются соединению как есть.
+    Как и aiosqlite.connect(), ее можно await-ить или использовать в async with.
+    """
+
+    def __init__(self, database: str, **kwargs):
+        self._connection = aiosqlite.connect(database, **kwargs)
+
+    def __await__(self):
+        return self._open().__await__()
+
+    async def _open(self):
+        await self._connection
+        return self
+
+    async def __aenter__(self):
+        return await self._open()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._connection.close()
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def execute(self, sql: str, parameters=None) -> _CursorResult:
+        return _CursorResult(self._timed_execute(sql, parameters))
+
+    def executemany(self, sql: str, parameters) -> _CursorResult:
+        return _CursorResult(self._timed_executemany(sql, parameters))
+
+    async def _timed_execute(self, sql: str, parameters):
+        start = time.perf_counter()
+        cursor = await self._connection.execute(sql, parameters)
+        await self._record(sql, parameters, (time.perf_counter() - start) * 1000)
+        return cursor
+
+    async def _timed_executemany(self, sql: str, parameters):
+        start = time.perf_counter()
+        cursor = await self._connection.executemany(sql, parameters)
+        await self._record(sql, None, (time.perf_counter() - start) * 1000, explain=False)
+        return cursor
+
+    async def commit(self) -> None:
+        start = time.perf_counter()
+        await self._connection.commit()
+        await self._record("COMMIT", None, (time.perf_counter() - start) * 1000)
+
+    async def _explain(self, sql: str, parameters):
+        async with self._connection.execute(f"EXPLAIN QUERY PLAN {sql}", parameters or ()) as cursor:
+            return await cursor.fetchall()
+
+    async def _record(self, sql: str, parameters, elapsed_ms: float, explain: bool = True):
+        key = normalize_sql(sql)
+        stat = _get_stat(key)
+        stat.count += 1
+        stat.total_ms += elapsed_ms
+        stat.recent.append(elapsed_ms)
+        if elapsed_ms > stat.max_ms:
+            stat.max_ms = elapsed_ms
+        # План снимаем для каждого запроса при первой встрече (и не чаще PLAN_RECAPTURE_INTERVAL),
+        # а не только для медленных: полный обход, который пока быстр, - та же будущая регрессия
+        now = time.monotonic()
+        if explain and not key.upper().startswith(_NO_PLAN_PREFIXES) \
+                and (not stat.plan_captured_at or now - stat.plan_captured_at > PLAN_RECAPTURE_INTERVAL):
+            stat.plan_captured_at = now
+            try:
+                plan_rows = await self._explain(sql, parameters)
+                stat.plan = [row[-1] for row in plan_rows]
+                stat.full_scan = plan_has_full_scan(plan_rows)
+            except sqlite3.Error as e:
+                logging.warning("Не удалось получить план запроса '%s': %s", key[:80], e)
+
+        if elapsed_ms < SLOW_QUERY_MS:
+            return
+        stat.slow_count += 1
+        plan_text = "; ".join(stat.plan) if stat.plan else "нет плана"
+        scan_mark = " [FULL SCAN]" if stat.full_scan else ""
+        logging.warning("Медленный запрос (%.1f мс)%s: %s | План: %s", elapsed_ms, scan_mark, key[:200], plan_text)
+
+
+def profiled_connect(database: str, **kwargs) -> ProfiledConnection:
+    """Аналог aiosqlite.connect(), возвращающий ProfiledConnection."""
+    return ProfiledConnection(database, **kwargs)
@@ -0,0 +1,176 @@
+import heapq
+import logging
+import os
+import time
+from datetime import date, timedelta
+
+from dotenv import load_dotenv
+
+from database import (
+    get_latest_subscription_ends,
+    get_subscription_ends_after,
+    get_subscription_ends_checksum,
+    get_notification_contacts,
+)
+
+load_dotenv()
+
+# Окно напоминаний: подписка "к проверке", если до окончания меньше стольких дней (или уже истекла)
+EXPIRY_WARNING_DAYS = 3
+# Как часто сверять индекс с БД (сек): расхождение - перестройка индекса
+EXPIRY_VERIFY_INTERVAL = float(os.getenv("EXPIRY_VERIFY_INTERVAL", str(6 * 3600)))
+
+
+def _ordinal(value: str):
+    """Номер дня для subscription_end в формате YYYY-MM-DD или None (такие подписки проверка пропускает)."""
+    if not value or len(value) != 10 or value[4] != "-" or value[7] != "-":
+        return None
+    try:
+        return date.fromisoformat(value).toordinal()
+    except ValueError:
+        return None
+
+
+class ExpiryIndex:
+    """
+    Индекс окончаний последних подписок пар (user_id, tw_username) в памяти.
+    Будущие окончания лежат в min-куче (номер дня, пара), поэтому ежедневная проверка достает
+    только наступившие - O(log n) на каждую - вместо прохода по всем подпискам в БД.
+    Пары, попавшие в окно напоминаний, хранятся отдельно до продления подписки: истекшим
+    подпискам напоминание уходит каждый день.
+    Устаревшие записи кучи (подписку продлили) не удаляются, а пропускаются при извлечении.
+    Платежи этого экземпляра попадают в индекс сразу (update), остальные записи (импорт, другие
+    экземпляры бота) - при refresh по возрастанию payments.id.
+    """
+    __slots__ = ("_ends", "_heap", "_due", "_horizon", "_ordinal_sum", "_last_id", "_verified_at")
+
+    def __init__(self):
+        self._ends = None       # {(user_id, tw_username): номер дня окончания}; None - индекс не загружен
+        self._heap = []         # [(номер дня, пара)] окончаний позже горизонта
+        self._due = set()       # Пары с окончанием не позже горизонта
+        self._horizon = -1      # Последний день окна напоминаний, до которого разобрана куча
+        self._ordinal_sum = 0   # Сумма номеров дней - для сверки с БД
+        self._last_id = 0       # Последний учтенный payments.id
+        self._verified_at = 0.0
+
+    @property
+    def loaded(self) -> bool:
+        return self._ends is not None
+
+    async def load(self):
+        """Строит индекс по последним подпискам из БД (при старте и при расхождении с БД)."""
+        try:
+            last_id, rows = await get_latest_subscription_ends()
+            ends = {}
+            for user_id, tw_username, subscription_end in rows:
+                ordinal = _ordinal(subscription_end)
+                if ordinal is not None:
+                    ends[(user_id, tw_username)] = ordinal
+            self._ends = ends
+            self._ordinal_sum = sum(ends.values())
+            self._last_id = last_id
+            self._rebuild_heap()
+            self._verified_at = time.monotonic()
+            logging.info("Индекс окончаний подписок загружен: %s подписок.", len(ends))
+        except Exception as e:
+            logging.error("Не удалось загрузить индекс окончаний подписок, проверка пойдет по БД: %s", e)
+            self._ends = None
+
+    def _rebuild_heap(self):
+        """Куча и окно заново по _ends: O(n) через heapify, заодно без устаревших записей."""
+        self._due = {pair for pair, ordinal in self._ends.items() if ordinal <= self._horizon}
+        self._heap = [(ordinal, pair) for pair, ordinal in self._ends.items() if ordinal > self._horizon]
+        heapq.heapify(self._heap)
+
+    def update(self, user_id: int, tw_username: str, subscription_end: str):
+        """Новое окончание подписки пары (после коммита платежа)."""
+        if self._ends is None:
+            return
+        pair = (user_id, tw_username)
+        ordinal = _ordinal(subscription_end)
+        previous = self._ends.get(pair)
+        if ordinal == previous:
+            return
+        if previous is not None:
+            self._ordinal_sum -= previous
+        if ordinal is None:
+            self._ends.pop(pair, None)
+            self._due.discard(pair)
+            return
+        self._ends[pair] = ordinal
+        self._ordinal_sum += ordinal
+        if ordinal <= self._horizon:
+            self._due.add(pair)
+        else:
+            # Прежняя запись кучи (если есть) станет устаревшей и будет пропущена
+            self._due.discard(pair)
+            heapq.heappush(self._heap, (ordinal, pair))
+            if len(self._heap) > 2 * len(self._ends) + 1000:
+                self._rebuild_heap()
+
+    def due(self, today: date):
+        """
+        Подписки в окне напоминаний на дату today: [(user_id, tw_username, subscription_end)]
+        по возрастанию пары, и счетчики (активных, истекших) по всем подпискам.
+        """
+        horizon = today.toordinal() + EXPIRY_WARNING_DAYS - 1
+        if horizon > self._horizon:
+            self._horizon = horizon
+            heap = self._heap
+            while heap and heap[0][0] <= horizon:
+                ordinal, pair = heapq.heappop(heap)
+                if self._ends.get(pair) == ordinal:
+                    self._due.add(pair)
+        today_ordinal = today.toordinal()
+        rows = []
+        expired = 0
+        for pair in sorted(self._due):
+            ordinal = self._ends[pair]
+            if ordinal < today_ordinal:
+                expired += 1
+            rows.append((pair[0], pair[1], date.fromordinal(ordinal).isoformat()))
+        return rows, (len(self._ends) - expired, expired)
+
+    async def refresh(self):
+        """Досчитывает платежи, записанные мимо update (импорт, другие экземпляры бота)."""
+        if self._ends is None:
+            return
+        for payment_id, user_id, tw_username, subscription_end in await get_subscription_ends_after(self._last_id):
+            # По возрастанию id: у пары остается окончание последнего платежа
+            self.update(user_id, tw_username, subscription_end)
+            self._last_id = payment_id
+
+    async def verify(self):
+        """Сверяет число подписок и сумму дат окончания с БД; при расхождении перестраивает индекс."""
+        count, ordinal_sum, last_id = await get_subscription_ends_checksum()
+        self._verified_at = time.monotonic()
+        if last_id != self._last_id:
+            return  # Между refresh и сверкой записан платеж - сверим в следующий раз
+        if (count, ordinal_sum) != (len(self._ends), self._ordinal_sum):
+            logging.warning("Индекс окончаний подписок разошелся с БД (%s против %s подписок), перестраиваем.",
+                            len(self._ends), count)
+            await self.load()
+
+    async def due_subscriptions(self, today: date):
+        """
+        Подписки к проверке на дату today в формате database.get_subscriptions_for_notification_check:
+        [(user_id, tw_username, subscription_end, language, tg_username, timezone, blocked)], и счетчики
+        (активных, истекших). None - индекс не загружен (проверка идет по БД).
+        """
+        if self._ends is None:
+            await self.load()
+            if self._ends is None:
+                return None
+        await self.refresh()
+        if time.monotonic() - self._verified_at >= EXPIRY_VERIFY_INTERVAL:
+            await self.verify()
+        rows, totals = self.due(today)
+        contacts = await get_notification_contacts({row[0] for row in rows})
+        # Как в полном запросе по БД: пары без записи в users не проверяются, а у заблокировавших
+        # бота - только подписка, истекшая вчера
+        expired_day = (today - timedelta(days=1)).isoformat()
+        return [row + contacts[row[0]] for row in rows
+                if row[0] in contacts and (not contacts[row[0]][3] or row[2] == expired_day)], totals
+
+
+expiry_index = ExpiryIndex()
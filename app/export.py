@@ -0,0 +1,58 @@
+import asyncio
+import codecs
+import csv
+import gzip
+import io
+import logging
+
+from database import iter_payments_for_export
+
+EXPORT_HEADER = [
+    "payment_id", "user_id", "tg_username", "tw_username", "tx_hash", "amount",
+    "purchase_date", "subscription_end", "verification_status", "plan_id"
+]
+# Сколько строк форматируем в памяти перед записью в файл
+EXPORT_CHUNK_ROWS = 1000
+
+
+def _safe_cell(value):
+    """Защита от формул в Excel/Sheets: значения от пользователей не должны начинаться с =, +, -, @."""
+    if isinstance(value, str) and value[:1] in ("=", "+", "-", "@"):
+        return f"'{value}"
+    return value
+
+
+async def export_payments_csv(path: str, date_from: str = None, date_to: str = None,
+                              active_only: bool = False, compress: bool = False) -> int:
+    """
+    Пишет выгрузку платежей в CSV (опционально gzip) по пути path.
+    Память постоянная: строки идут из курсора через генератор, файл пишется порциями в отдельном потоке.
+    Возвращает количество выгруженных строк.
+    """
+    opener = gzip.open if compress else open
+    fileobj = await asyncio.to_thread(opener, path, "wb")
+    rows_written = 0
+    try:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_HEADER)
+
+        async def flush(prefix: bytes = b""):
+            data = prefix + buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+            await asyncio.to_thread(fileobj.write, data)
+
+        # BOM нужен Excel, чтобы правильно открыть кириллицу в никах
+        await flush(codecs.BOM_UTF8)
+        async for row in iter_payments_for_export(date_from, date_to, active_only):
+            writer.writerow([_safe_cell(value) for value in row])
+            rows_written += 1
+            if rows_written % EXPORT_CHUNK_ROWS == 0:
+                await flush()
+        await flush()
+    finally:
+        await asyncio.to_thread(fileobj.close)
+
+    logging.info("Выгрузка платежей в '%s' завершена: %s строк.", path, rows_written)
+    return rows_written
@@ -0,0 +1,216 @@
+import asyncio
+import csv
+import gzip
+import itertools
+import logging
+import uuid
+from datetime import date, datetime
+
+from database import connect_db, import_payments_batch
+from tx_index import tx_hash_index
+
+# Колонки CSV (заголовок обязателен, порядок любой). Совпадают с выгрузкой /export, поэтому
+# выгрузку одного бота можно загрузить в другой. Окончание подписки - subscription_end
+# или days (продлить на столько дней от текущего окончания).
+IMPORT_REQUIRED = ("user_id", "tw_username")
+IMPORT_LANGUAGES = ("en", "ru", "es")
+IMPORT_CHUNK_ROWS = 1000     # Строк в одной транзакции
+IMPORT_PAUSE = 0.01          # Пауза между порциями
+IMPORT_BUSY_PAUSE = 0.05     # Шаг ожидания, пока обработчики бота заняты (их запись в БД важнее импорта)
+IMPORT_MAX_BUSY_WAIT = 1.0   # Дольше не уступаем: импорт не должен стоять под постоянной нагрузкой
+IMPORT_MAX_DAYS = 3650
+IMPORT_CACHE_KIB = 65536     # Кеш страниц соединения импорта: индексы payments не вытесняются между порциями
+TW_USERNAME_MAX_LEN = 64
+
+
+def _cell(record: dict, name: str) -> str:
+    value = (record.get(name) or "").strip()
+    # Снимаем защиту от формул, которую добавляет /export (export._safe_cell)
+    if value[:1] == "'" and value[1:2] in ("=", "+", "-", "@"):
+        value = value[1:]
+    return value
+
+
+def _parse_date(value: str, name: str) -> str:
+    # fromisoformat в разы быстрее strptime; длина и дефисы - чтобы принимать только YYYY-MM-DD
+    try:
+        if len(value) != 10 or value[4] != "-" or value[7] != "-":
+            raise ValueError
+        return date.fromisoformat(value).isoformat()
+    except ValueError:
+        raise ValueError(f"{name}: ожидается дата YYYY-MM-DD, получено '{value}'")
+
+
+def parse_import_row(line: int, record: dict, today: str):
+    """
+    Проверяет строку CSV и приводит ее к виду database.import_payments_batch.
+    Ошибка - ValueError с текстом для отчета.
+    """
+    try:
+        user_id = int(_cell(record, "user_id"))
+    except ValueError:
+        raise ValueError(f"user_id: ожидается число, получено '{_cell(record, 'user_id')}'")
+    if user_id <= 0:
+        raise ValueError("user_id: должен быть положительным")
+
+    tw_username = _cell(record, "tw_username")
+    if not tw_username or len(tw_username) > TW_USERNAME_MAX_LEN or any(ch.isspace() for ch in tw_username):
+        raise ValueError(f"tw_username: пустой, длиннее {TW_USERNAME_MAX_LEN} символов или с пробелами")
+
+    tg_username = _cell(record, "tg_username").lstrip("@") or None
+    language = _cell(record, "language").lower() or None
+    if language and language not in IMPORT_LANGUAGES:
+        raise ValueError(f"language: одно из {', '.join(IMPORT_LANGUAGES)}")
+
+    amount_str = _cell(record, "amount")
+    try:
+        amount = float(amount_str) if amount_str else 0.0
+    except ValueError:
+        raise ValueError(f"amount: ожидается число, получено '{amount_str}'")
+    if amount < 0:
+        raise ValueError("amount: не может быть отрицательной")
+
+    purchase_date = _cell(record, "purchase_date")
+    purchase_date = _parse_date(purchase_date, "purchase_date") if purchase_date else today
+
+    subscription_end = _cell(record, "subscription_end")
+    days = _cell(record, "days")
+    extend_days = None
+    if subscription_end and days:
+        raise ValueError("укажите subscription_end или days, не оба")
+    if subscription_end:
+        subscription_end = _parse_date(subscription_end, "subscription_end")
+    elif days:
+        try:
+            extend_days = int(days)
+        except ValueError:
+            raise ValueError(f"days: ожидается целое число, получено '{days}'")
+        if not 1 <= extend_days <= IMPORT_MAX_DAYS:
+            raise ValueError(f"days: от 1 до {IMPORT_MAX_DAYS}")
+        subscription_end = None
+    else:
+        raise ValueError("нужна колонка subscription_end или days")
+
+    # Начисление без транзакции в сети (подарок, перенос клиента) получает уникальный служебный хеш
+    tx_hash = _cell(record, "tx_hash") or f"import-{uuid.uuid4().hex}"
+    plan_id = _cell(record, "plan_id") or None
+    return (line, user_id, tg_username, language, tw_username, tx_hash, amount, purchase_date,
+            subscription_end, extend_days, plan_id)
+
+
+def _read_chunk(reader, size: int, today: str):
+    """
+    Читает и проверяет следующую порцию строк (выполняется в отдельном потоке).
+    Возвращает (прочитано строк, проверенные строки, ошибки [(номер строки, текст)]).
+    """
+    rows = []
+    errors = []
+    count = 0
+    try:
+        for record in itertools.islice(reader, size):
+            count += 1
+            # Номер строки файла берем у csv.reader: поле в кавычках может занимать несколько строк
+            try:
+                rows.append(parse_import_row(reader.line_num, record, today))
+            except ValueError as e:
+                errors.append((reader.line_num, str(e)))
+    except (csv.Error, UnicodeDecodeError, OSError, EOFError) as e: # OSError/EOFError - поврежденный gzip
+        errors.append((reader.line_num, f"файл не читается как CSV в UTF-8: {e}"))
+        count = 0  # Дальше файл не читаем
+    return count, rows, errors
+
+
+def _open_csv(path: str):
+    """
+    Открывает CSV на чтение. Сжатая выгрузка /export (.csv.gz) распознается по сигнатуре gzip,
+    а не по имени: присланный файл сохраняется под своим именем.
+    utf-8-sig: выгрузка /export и Excel пишут BOM.
+    """
+    with open(path, "rb") as f:
+        compressed = f.read(2) == b"\x1f\x8b"
+    opener = gzip.open if compressed else open
+    return opener(path, "rt", encoding="utf-8-sig", newline="")
+
+
+async def import_payments_csv(path: str, is_busy=None):
+    """
+    Потоковый импорт платежей из CSV: чтение и разбор файла - в отдельном потоке порциями,
+    запись - короткими транзакциями по IMPORT_CHUNK_ROWS строк с паузой между ними,
+    поэтому живые обработчики не ждут весь импорт.
+    is_busy: функция без аргументов; пока возвращает True, импорт между порциями уступает
+    блокировку записи обработчикам (ожидающий писатель SQLite опрашивает блокировку с паузами
+    и без этого может раз за разом не успевать).
+    Возвращает (импортировано строк, ошибки [(номер строки, текст)]).
+    """
+    today = datetime.now().strftime("%Y-%m-%d")
+    imported = 0
+    errors = []
+    fileobj = await asyncio.to_thread(_open_csv, path)
+    next_chunk = None
+    db = None
+    try:
+        reader = csv.DictReader(fileobj)
+        try:
+            header = await asyncio.to_thread(lambda: reader.fieldnames)
+        except (csv.Error, UnicodeDecodeError, OSError, EOFError) as e: # OSError/EOFError - поврежденный gzip
+            return 0, [(1, f"файл не читается как CSV в UTF-8: {e}")]
+        missing = [name for name in IMPORT_REQUIRED if name not in (header or [])]
+        if missing:
+            return 0, [(1, f"в заголовке нет колонок: {', '.join(missing)}")]
+
+        db = await connect_db()
+        await db.execute(f"PRAGMA cache_size = -{IMPORT_CACHE_KIB}")
+        seen_hashes = set()
+        # Следующая порция читается, пока пишется текущая
+        next_chunk = asyncio.create_task(asyncio.to_thread(_read_chunk, reader, IMPORT_CHUNK_ROWS, today))
+        while True:
+            count, parsed, chunk_errors = await next_chunk
+            errors.extend(chunk_errors)
+            if not count:
+                break
+            next_chunk = asyncio.create_task(asyncio.to_thread(_read_chunk, reader, IMPORT_CHUNK_ROWS, today))
+            rows = []
+            for row in parsed:
+                if row[5] in seen_hashes:
+                    errors.append((row[0], f"tx_hash '{row[5]}' повторяется в файле"))
+                    continue
+                seen_hashes.add(row[5])
+                rows.append(row)
+            if rows:
+                try:
+                    hashes, batch_errors = await import_payments_batch(db, rows)
+                except Exception as e:
+                    # Порция откатилась целиком - в отчет попадают все ее строки
+                    logging.exception("Импорт: ошибка записи порции (строки %s-%s): %s", rows[0][0], rows[-1][0], e)
+                    errors.extend((row[0], f"ошибка записи порции: {e}") for row in rows)
+                else:
+                    for tx_hash in hashes:
+                        tx_hash_index.add(tx_hash)
+                    imported += len(hashes)
+                    errors.extend(batch_errors)
+            await asyncio.sleep(IMPORT_PAUSE)
+            waited = 0.0
+            while is_busy is not None and is_busy() and waited < IMPORT_MAX_BUSY_WAIT:
+                await asyncio.sleep(IMPORT_BUSY_PAUSE)
+                waited += IMPORT_BUSY_PAUSE
+    finally:
+        if next_chunk is not None and not next_chunk.done():
+            # Ошибка или отмена посреди импорта: дожидаемся потока чтения, прежде чем закрыть файл
+            await asyncio.gather(next_chunk, return_exceptions=True)
+        if db is not None:
+            await db.close()
+        await asyncio.to_thread(fileobj.close)
+
+    errors.sort()
+    logging.info("Импорт платежей из '%s': импортировано %s, ошибок %s.", path, imported, len(errors))
+    return imported, errors
+
+
+async def write_import_report(path: str, errors):
+    """CSV-отчет об ошибках импорта: номер строки исходного файла и причина."""
+    def write():
+        with open(path, "w", encoding="utf-8-sig", newline="") as report:
+            writer = csv.writer(report)
+            writer.writerow(["line", "error"])
+            writer.writerows(errors)
+    await asyncio.to_thread(write)
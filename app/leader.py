@@ -0,0 +1,123 @@
+import asyncio
+import contextvars
+import logging
+import os
+import secrets
+import socket
+import time
+
+from dotenv import load_dotenv
+
+from database import try_acquire_lease, release_lease
+
+load_dotenv()
+
+# Аренда лидера: пока экземпляр ее продлевает, только он выполняет фоновые рассылки и обслуживание.
+# Резервный экземпляр перехватывает аренду не позже чем через TTL после падения лидера.
+LEADER_LEASE_NAME = "background_jobs"
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "10"))
+LEADER_RENEW_INTERVAL = LEADER_LEASE_TTL / 3
+
+# Токен фенсинга задач, запущенных лидером: (имя аренды, токен). Задачи передают его в записи БД.
+_current_fence = contextvars.ContextVar("leader_fence", default=None)
+
+
+def current_fence():
+    """Фенсинг текущей задачи для database.check_fence или None (задача запущена не лидером)."""
+    return _current_fence.get()
+
+
+def lease_valid() -> bool:
+    """
+    Можно ли начинать новую отправку. False - задача запущена лидером, но по локальным часам
+    его аренда уже истекла (например, БД недоступна для продления) или сменила токен.
+    """
+    fence = _current_fence.get()
+    return fence is None or (leader_lease.is_leader and leader_lease.token == fence[1])
+
+
+class LeaderLease:
+    """
+    Выборы лидера через аренду в общей SQLite-БД: продление каждые renew_interval секунд,
+    токен фенсинга растет при каждой смене владельца. Задачи лидера запускаются при захвате
+    аренды и останавливаются при ее потере или остановке бота.
+    """
+
+    def __init__(self, name: str = LEADER_LEASE_NAME, ttl: float = LEADER_LEASE_TTL,
+                 renew_interval: float = LEADER_RENEW_INTERVAL):
+        self.name = name
+        self.ttl = ttl
+        self.renew_interval = renew_interval
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(3)}"
+        self.token = None
+        self._valid_until = 0.0  # monotonic-время, до которого аренда точно наша
+
+    @property
+    def is_leader(self) -> bool:
+        return self.token is not None and time.monotonic() < self._valid_until
+
+    async def _renew(self) -> bool:
+        started = time.monotonic()
+        try:
+            token = await try_acquire_lease(self.name, self.holder, self.ttl)
+        except Exception as e:
+            # БД временно недоступна: остаемся лидером, пока не истечет уже полученная аренда
+            logging.warning("Аренда лидера: ошибка продления: %s", e)
+            return self.is_leader
+        if token is None:
+            self.token = None
+            return False
+        if token != self.token:
+            logging.info("Аренда лидера '%s' получена экземпляром %s (токен %s).", self.name, self.holder, token)
+        self.token = token
+        # Отсчет от начала запроса: срок в БД начался не раньше этого момента
+        self._valid_until = started + self.ttl
+        return True
+
+    @staticmethod
+    async def _stop(tasks: dict):
+        """Останавливает задачи лидера по очереди, в порядке запуска (как on_shutdown в app.py)."""
+        for name, task in tasks.items():
+            task.cancel()
+            result = (await asyncio.gather(task, return_exceptions=True))[0]
+            if isinstance(result, Exception):
+                logging.warning("Аренда лидера: задача '%s' завершилась с ошибкой: %s", name, result)
+
+    async def run(self, jobs: dict):
+        """
+        Цикл выборов. jobs: {имя: функция без аргументов, возвращающая корутину задачи}.
+        Отмена цикла (остановка бота) останавливает задачи и освобождает аренду.
+        """
+        logging.info("Выборы лидера запущены (экземпляр %s, TTL %s сек.).", self.holder, self.ttl)
+        tasks = {}
+        tasks_token = None
+        try:
+            while True:
+                leader = await self._renew()
+                if tasks and (not leader or self.token != tasks_token):
+                    logging.warning("Аренда лидера '%s' потеряна (токен %s), фоновые задачи остановлены.",
+                                    self.name, tasks_token)
+                    await self._stop(tasks)
+                    tasks = {}
+                if leader and not tasks:
+                    tasks_token = self.token
+                    # Контекст копируется в задачи при создании: каждая видит свой токен фенсинга
+                    fence = _current_fence.set((self.name, tasks_token))
+                    try:
+                        tasks = {name: asyncio.create_task(factory()) for name, factory in jobs.items()}
+                    finally:
+                        _current_fence.reset(fence)
+                await asyncio.sleep(self.renew_interval)
+        finally:
+            if tasks:
+                await self._stop(tasks)
+            if self.token is not None:
+                try:
+                    await release_lease(self.name, self.holder, self.token)
+                    logging.info("Аренда лидера '%s' освобождена.", self.name)
+                except Exception as e:
+                    logging.warning("Аренда лидера: не удалось освободить: %s", e)
+                self.token = None
+
+
+leader_lease = LeaderLease()
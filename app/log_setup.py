@@ -0,0 +1,122 @@
+import json
+import logging
+import os
+import queue
+import sys
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# json - одна JSON-строка на запись (для сборщиков логов), text - прежний человекочитаемый формат
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Сэмплирование повторяющихся сообщений горячего пути (записи с extra={"sample": "<ключ>"}):
+# не больше LOG_SAMPLE_LIMIT записей каждого ключа за LOG_SAMPLE_WINDOW секунд
+LOG_SAMPLE_LIMIT = int(os.getenv("LOG_SAMPLE_LIMIT", "20"))
+LOG_SAMPLE_WINDOW = float(os.getenv("LOG_SAMPLE_WINDOW", "60"))
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# Стандартные атрибуты LogRecord: все остальное в __dict__ пришло из extra и попадает в JSON как поля
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись лога одной JSON-строкой: время, уровень, логгер, текст и поля из extra."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Ограничивает частоту записей с одинаковым ключом extra["sample"] (например, строки
+    "отправлено напоминание" во время рассылки). Лишние записи отбрасываются еще в потоке
+    событийного цикла, до очереди; число отброшенных добавляется к следующей пропущенной
+    записи полем sampled_out. Записи без ключа и уровня WARNING и выше проходят всегда.
+    """
+
+    def __init__(self, limit: int = LOG_SAMPLE_LIMIT, window: float = LOG_SAMPLE_WINDOW):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self._windows = {}  # ключ -> [начало окна (monotonic), записано в окне, отброшено]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, "sample", None)
+        if key is None or record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        state = self._windows.get(key)
+        if state is None or now - state[0] >= self.window:
+            dropped = state[2] if state else 0
+            state = self._windows[key] = [now, 0, dropped]
+        if state[1] >= self.limit:
+            state[2] += 1
+            return False
+        state[1] += 1
+        if state[2]:
+            record.sampled_out = state[2]
+            state[2] = 0
+        return True
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler без форматирования в потоке вызывающего: стандартный prepare() подставляет
+    аргументы в сообщение до постановки в очередь. Запись уходит как есть, а текст собирает
+    поток QueueListener. Исключение превращаем в текст сразу, чтобы не держать кадры стека.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, stream=None) -> QueueListener:
+    """
+    Настраивает корневой логгер: записи уходят в очередь, а форматирование и вывод выполняет
+    фоновый поток QueueListener. Возвращает запущенный listener; его нужно остановить
+    (listener.stop()) при выходе, чтобы дописать оставшиеся записи.
+    """
+    # Поля, которые не выводит ни один из форматов: их сбор в каждой записи - заметная доля
+    # времени вызова (имя потока и процесса)
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    handler = _DeferredQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    listener = QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    return listener
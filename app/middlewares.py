@@ -0,0 +1,310 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Колбэки, меняющие состояние: повторное нажатие той же кнопки не должно выполнять действие второй раз
+IDEMPOTENT_CALLBACKS = {"paid", "confirm_yes", "confirm_no"}
+IDEMPOTENCY_TTL = 600          # Сколько помнить обработанные нажатия (сек)
+IDEMPOTENCY_CACHE_SIZE = 10_000
+
+# Контроль допуска: сколько обработчиков выполняется одновременно, сколько обычных апдейтов
+# может ждать слота и сколько секунд; сверх этого апдейт отклоняется ответом "бот перегружен"
+HANDLER_CONCURRENCY = int(os.getenv("HANDLER_CONCURRENCY", "32"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "200"))
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "10"))
+SHED_REPLY_INTERVAL = 60       # Ответ "бот перегружен" одному пользователю - не чаще (сек)
+OVERLOAD_LOG_INTERVAL = 60     # Предупреждение о глубокой очереди в лог - не чаще (сек)
+
+# Анти-флуд: лимиты апдейтов одного пользователя по видам обработчиков, "вид=число/секунды" через запятую
+THROTTLE_LIMITS = os.getenv("THROTTLE_LIMITS", "start=3/60,instruction=3/60,menu=10/60,message=20/60,callback=30/60")
+THROTTLE_MAX_ENTRIES = 100_000 # Счетчиков в памяти не больше (самые давние вытесняются)
+
+
+def parse_rate_limits(value: str) -> dict:
+    """'start=3/60,callback=30/60' -> {"start": (3, 60.0), "callback": (30, 60.0)}. Некорректные пары пропускаются."""
+    limits = {}
+    for item in value.split(","):
+        kind, _, rate = item.strip().partition("=")
+        count, _, window = rate.partition("/")
+        try:
+            if int(count) > 0 and float(window) > 0:
+                limits[kind.strip()] = (int(count), float(window))
+                continue
+        except ValueError:
+            pass
+        if item.strip():
+            logging.error("THROTTLE_LIMITS: некорректный лимит '%s' пропущен.", item.strip())
+    return limits
+
+
+class UserLockMiddleware(BaseMiddleware):
+    """
+    Последовательная обработка апдейтов одного пользователя (outer-middleware, до фильтров).
+    Двойное нажатие кнопки больше не запускает два обработчика параллельно: второй апдейт
+    проходит фильтры состояния FSM уже после того, как первый его изменил.
+    """
+
+    def __init__(self):
+        self._locks = {}  # user_id -> [asyncio.Lock, число ожидающих]
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        entry = self._locks.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await handler(event, data)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[user.id] # Замок больше никому не нужен - не копим их для всех пользователей
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Анти-флуд (outer-middleware сообщений и колбэков, регистрируется первым): апдейты сверх лимита
+    пользователя для своего вида обработчика отбрасываются до замков, обработчиков, БД и Bot API.
+    О превышении пользователь узнает один раз за окно (warn_text), остальные лишние апдейты
+    отбрасываются молча, на колбэки отвечается без текста.
+    Счетчик - скользящее окно из двух корзин [начало текущей корзины, прошлая, текущая, окно
+    последнего предупреждения, время последнего обращения] на пару (user_id, вид) в OrderedDict
+    по времени обращения: при каждом обращении с начала вытесняются счетчики, к которым не
+    обращались дольше двух окон (их корзины уже пусты), и лишние сверх THROTTLE_MAX_ENTRIES.
+    """
+
+    def __init__(self, classify, warn_text, exempt=None, limits: dict = None):
+        self.classify = classify    # апдейт -> вид обработчика ("start", "callback", ...)
+        self.warn_text = warn_text  # user_id -> текст предупреждения
+        self.exempt = exempt        # user_id -> True, если лимиты не применяются (админы)
+        self.limits = parse_rate_limits(THROTTLE_LIMITS) if limits is None else limits
+        self._max_window = max((window for _, window in self.limits.values()), default=0)
+        self._counters = OrderedDict()
+        self.dropped = 0
+
+    def stats(self) -> dict:
+        return {"dropped": self.dropped, "tracked": len(self._counters)}
+
+    def _expire(self, now: float):
+        counters = self._counters
+        while counters:
+            last_seen = next(iter(counters.values()))[4]
+            if now - last_seen < 2 * self._max_window and len(counters) <= THROTTLE_MAX_ENTRIES:
+                break
+            counters.popitem(last=False)
+
+    def hit(self, key, now: float):
+        """
+        Учитывает апдейт. Возвращает None - пропустить, иначе отбросить: True - с предупреждением
+        (первое превышение в окне), False - молча.
+        """
+        count, window = self.limits[key[1]]
+        self._expire(now)
+        entry = self._counters.pop(key, None)
+        if entry is None or now - entry[0] >= 2 * window:
+            entry = [now, 0, 0, None, now]
+        elif now - entry[0] >= window:
+            entry = [entry[0] + window, entry[2], 0, entry[3], now]
+        else:
+            entry[4] = now
+        self._counters[key] = entry
+        # Оценка числа апдейтов за последние window секунд: доля прошлой корзины плюс текущая
+        if entry[1] * (1 - (now - entry[0]) / window) + entry[2] < count:
+            entry[2] += 1
+            return None
+        warn = entry[3] != entry[0]
+        entry[3] = entry[0]
+        return warn
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None or (self.exempt and self.exempt(user.id)):
+            return await handler(event, data)
+        kind = self.classify(event)
+        if kind not in self.limits:
+            return await handler(event, data)
+        warn = self.hit((user.id, kind), time.monotonic())
+        if warn is None:
+            return await handler(event, data)
+        self.dropped += 1
+        if warn:
+            logging.info("Анти-флуд: user_id %s превысил лимит '%s' (%s за "
+                         "%.0f с), лишние апдейты отбрасываются.",
+                         user.id, kind, self.limits[kind][0], self.limits[kind][1],
+                         extra={"sample": "throttled"})
+        try:
+            if isinstance(event, CallbackQuery):
+                await event.answer(self.warn_text(user.id) if warn else None)
+            elif warn:
+                await event.answer(self.warn_text(user.id))
+        except Exception as e:
+            logging.warning("Не удалось ответить на отброшенный апдейт user_id %s: %s", user.id, e)
+        return None
+
+
+class IdempotentCallbackMiddleware(BaseMiddleware):
+    """
+    Ключ идемпотентности для колбэков из IDEMPOTENT_CALLBACKS: (пользователь, сообщение, данные кнопки).
+    Повторное нажатие уже обработанной кнопки отвечается из памяти - без транзакции в БД
+    и без повторного редактирования сообщения. Регистрируется после UserLockMiddleware.
+    """
+
+    def __init__(self):
+        self._handled = OrderedDict()  # ключ -> время обработки (monotonic)
+        self.duplicates = 0
+
+    def _key(self, callback: CallbackQuery):
+        if callback.data not in IDEMPOTENT_CALLBACKS or callback.message is None:
+            return None
+        return callback.from_user.id, callback.message.message_id, callback.data
+
+    def _seen(self, key, now: float) -> bool:
+        handled_at = self._handled.get(key)
+        return handled_at is not None and now - handled_at < IDEMPOTENCY_TTL
+
+    def _remember(self, key, now: float):
+        self._handled[key] = now
+        self._handled.move_to_end(key)
+        while len(self._handled) > IDEMPOTENCY_CACHE_SIZE:
+            self._handled.popitem(last=False)
+
+    async def __call__(self, handler, event: CallbackQuery, data):
+        key = self._key(event)
+        if key is None:
+            return await handler(event, data)
+        if self._seen(key, time.monotonic()):
+            self.duplicates += 1
+            logging.info("Повторное нажатие '%s' от user_id %s проигнорировано.", event.data, event.from_user.id)
+            try:
+                await event.answer()
+            except Exception as e:
+                logging.warning("Не удалось ответить на повторный колбэк: %s", e)
+            return None
+        result = await handler(event, data)
+        # Запоминаем только успешно завершенную обработку: после ошибки повторное нажатие разрешено
+        self._remember(key, time.monotonic())
+        return result
+
+
+class AdmissionControlMiddleware(BaseMiddleware):
+    """
+    Контроль допуска апдейтов к обработчикам (outer-middleware сообщений и колбэков, после
+    UserLockMiddleware: ожидание своей очереди у пользователя не занимает слот).
+    Одновременно выполняется не больше limit обработчиков, остальные ждут слота в двух очередях:
+    сначала приоритетные (is_priority - например, пользователь посреди оплаты), потом обычные.
+    Приоритетные ждут сколько нужно; обычный апдейт при переполнении очереди или ожидании дольше
+    max_wait отклоняется дешевым ответом shed_text(user_id) - без запросов к БД.
+    """
+
+    def __init__(self, is_priority, shed_text, limit: int = HANDLER_CONCURRENCY,
+                 max_queue: int = ADMISSION_MAX_QUEUE, max_wait: float = ADMISSION_MAX_WAIT):
+        self.is_priority = is_priority  # (user_id, состояние FSM) -> bool
+        self.shed_text = shed_text      # user_id -> текст отказа
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.running = 0
+        self._priority_waiters = deque()
+        self._waiters = deque()
+        self._shed_replied = {}  # user_id -> время последнего ответа об отказе (monotonic)
+        self._overload_logged_at = 0.0
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self.max_wait_seen = 0.0
+
+    def stats(self) -> dict:
+        return {"running": self.running, "limit": self.limit,
+                "waiting": len(self._priority_waiters) + len(self._waiters),
+                "waiting_priority": len(self._priority_waiters),
+                "admitted": self.admitted, "queued": self.queued, "shed": self.shed,
+                "max_wait": self.max_wait_seen}
+
+    def _release(self):
+        """Освобождает слот: он сразу переходит первому ожидающему (приоритетные - раньше)."""
+        for waiters in (self._priority_waiters, self._waiters):
+            while waiters:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+        self.running -= 1
+
+    async def _acquire(self, priority: bool) -> bool:
+        """Ждет слот. False - апдейт отклонен (очередь обычных переполнена или ожидание слишком долгое)."""
+        if self.running < self.limit and not self._priority_waiters and not self._waiters:
+            self.running += 1
+            return True
+        waiters = self._priority_waiters if priority else self._waiters
+        if not priority and len(waiters) >= self.max_queue:
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        waiters.append(waiter)
+        self.queued += 1
+        self._log_overload()
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), None if priority else self.max_wait)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                waiter.cancel()
+                waiters.remove(waiter)
+                return False
+            # Слот передан в момент таймаута - берем его
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release() # Слот уже передан этому апдейту - отдаем следующему
+            else:
+                waiter.cancel() # _release пропустит отмененное ожидание
+            raise
+        self.max_wait_seen = max(self.max_wait_seen, time.monotonic() - started)
+        return True
+
+    def _log_overload(self):
+        now = time.monotonic()
+        if now - self._overload_logged_at >= OVERLOAD_LOG_INTERVAL:
+            self._overload_logged_at = now
+            logging.warning("Перегрузка обработчиков: выполняется %s/%s, ожидают %s "
+                            "приоритетных и %s обычных, отклонено всего %s.",
+                            self.running, self.limit, len(self._priority_waiters), len(self._waiters), self.shed)
+
+    async def _reject(self, event, user_id: int):
+        self.shed += 1
+        try:
+            if isinstance(event, CallbackQuery):
+                await event.answer(self.shed_text(user_id)) # Без ответа кнопка "крутится" до таймаута
+                return
+            now = time.monotonic()
+            if now - self._shed_replied.get(user_id, 0.0) < SHED_REPLY_INTERVAL:
+                return
+            if len(self._shed_replied) > IDEMPOTENCY_CACHE_SIZE:
+                self._shed_replied = {uid: at for uid, at in self._shed_replied.items()
+                                      if now - at < SHED_REPLY_INTERVAL}
+            self._shed_replied[user_id] = now
+            await event.answer(self.shed_text(user_id))
+        except Exception as e:
+            logging.warning("Не удалось ответить на отклоненный апдейт user_id %s: %s", user_id, e)
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        state = data.get("state")
+        priority = self.is_priority(user.id, await state.get_state() if state else None)
+        if not await self._acquire(priority):
+            await self._reject(event, user.id)
+            return None
+        self.admitted += 1
+        try:
+            return await handler(event, data)
+        finally:
+            self._release()
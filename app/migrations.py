@@ -0,0 +1,546 @@
+import asyncio
+import logging
+from datetime import datetime
+
+import aiosqlite
+
+from database import connect_db, check_fence, LeaseLost
+from leader import current_fence
+
+# Порция и пауза фоновых миграций данных: одна короткая транзакция на порцию, бот в это время работает
+DATA_MIGRATION_BATCH_SIZE = 1000
+DATA_MIGRATION_PAUSE = 0.5
+
+
+async def _add_column(db: aiosqlite.Connection, table: str, column: str, definition: str) -> bool:
+    """Добавляет колонку, если ее еще нет (БД, созданные до введения версий схемы). True - колонка добавлена."""
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        columns = [col[1] for col in await cursor.fetchall()]
+    if column in columns:
+        return False
+    await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    logging.info("Добавлена колонка '%s' в таблицу '%s'.", column, table)
+    return True
+
+
+async def _table_exists(db: aiosqlite.Connection, name: str) -> bool:
+    async with db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)) as cursor:
+        return await cursor.fetchone() is not None
+
+
+async def _schedule_data_migration(db: aiosqlite.Connection, name: str, target_id: int):
+    """Ставит миграцию данных в очередь фонового исполнителя (run_data_migrations)."""
+    await db.execute('''
+        INSERT OR IGNORE INTO data_migrations (name, last_id, target_id) VALUES (?, 0, ?)
+    ''', (name, target_id))
+    logging.info("Запланирована фоновая миграция данных '%s' (до id=%s).", name, target_id)
+
+
+# --- Миграции схемы ---
+# Все миграции идемпотентны: БД, созданные до введения версий (user_version = 0),
+# уже содержат часть объектов, и к ним применяется вся цепочка.
+
+async def _m001_base_schema(db: aiosqlite.Connection):
+    # Таблица пользователей (хранит ID телеграм, ник и язык)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            language TEXT DEFAULT 'en'
+        )
+    ''')
+    await _add_column(db, "users", "language", "TEXT DEFAULT 'en'")
+
+    # Таблица платежей (связана с users, хранит данные о платеже и TW аккаунте)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,      -- ID пользователя Telegram
+            tw_username TEXT NOT NULL,   -- Имя пользователя TradingView
+            tx_hash TEXT UNIQUE NOT NULL,-- Хэш транзакции (уникальный)
+            amount REAL NOT NULL,        -- Сумма платежа
+            purchase_date TEXT NOT NULL, -- Дата покупки (YYYY-MM-DD)
+            subscription_end TEXT NOT NULL,-- Дата окончания подписки (YYYY-MM-DD)
+            FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE -- Удаление платежей при удалении пользователя
+        )
+    ''')
+    # Индекс по user_id и tw_username для поиска подписок конкретного пользователя для конкретного аккаунта
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_payments_user_tw ON payments(user_id, tw_username)')
+    # Индекс по tw_username для админ-панели и поиска
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_payments_tw_username ON payments(tw_username)')
+    # Индекс по дате окончания для планировщика
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_payments_sub_end ON payments(subscription_end)')
+
+    # Очередь фоновых миграций данных: last_id - до какого id обработано, target_id - до какого нужно
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS data_migrations (
+            name TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL DEFAULT 0,
+            target_id INTEGER NOT NULL,
+            completed_at TEXT
+        )
+    ''')
+
+
+async def _m002_verification(db: aiosqlite.Connection):
+    # Статус проверки транзакции в сети TRON
+    if await _add_column(db, "payments", "verification_status", "TEXT NOT NULL DEFAULT 'pending'"):
+        # Старые платежи уже проверялись админами вручную
+        await db.execute("UPDATE payments SET verification_status = 'manual'")
+    await _add_column(db, "payments", "verification_note", "TEXT")
+    await _add_column(db, "payments", "verify_attempts", "INTEGER NOT NULL DEFAULT 0")
+    # Частичный индекс: в нем только платежи, ожидающие проверки в сети
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_payments_pending ON payments(id) WHERE verification_status = 'pending'")
+
+
+async def _m003_admin_outbox(db: aiosqlite.Connection):
+    # Outbox уведомлений админам: пишется в одной транзакции с платежом,
+    # разбирается фоновым отправителем (доставка как минимум один раз)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS admin_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,            -- Кому отправить (ID админа)
+            text TEXT NOT NULL,                  -- Готовый текст сообщения
+            parse_mode TEXT,                     -- Режим разметки (Markdown/None)
+            attempts INTEGER NOT NULL DEFAULT 0, -- Неудачных попыток отправки
+            next_attempt_at REAL NOT NULL DEFAULT 0, -- Не раньше этого момента (unix time)
+            created_at TEXT NOT NULL
+        )
+    ''')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_admin_outbox_due ON admin_outbox(next_attempt_at)')
+
+
+async def _m004_account_search(db: aiosqlite.Connection):
+    # Поиск по аккаунтам для админ-панели: одна строка на TW аккаунт (ник TW + ник TG последнего плательщика)
+    # и полнотекстовый индекс FTS5 с триграммами поверх нее (поиск по подстроке без учета регистра)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS account_search_src (
+            id INTEGER PRIMARY KEY,
+            tw_username TEXT NOT NULL UNIQUE,
+            tg_username TEXT
+        )
+    ''')
+    # Индексы без учета регистра для префиксного поиска по коротким (< 3 символов) запросам
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_account_search_tw_nocase ON account_search_src(tw_username COLLATE NOCASE)')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_account_search_tg_nocase ON account_search_src(tg_username COLLATE NOCASE)')
+    await db.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS account_search USING fts5(
+            tw_username, tg_username,
+            content='account_search_src', content_rowid='id', tokenize='trigram'
+        )
+    ''')
+    # Синхронизация FTS с таблицей-источником
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_account_search_ai AFTER INSERT ON account_search_src BEGIN
+            INSERT INTO account_search(rowid, tw_username, tg_username)
+            VALUES (NEW.id, NEW.tw_username, NEW.tg_username);
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_account_search_ad AFTER DELETE ON account_search_src BEGIN
+            INSERT INTO account_search(account_search, rowid, tw_username, tg_username)
+            VALUES ('delete', OLD.id, OLD.tw_username, OLD.tg_username);
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_account_search_au AFTER UPDATE ON account_search_src BEGIN
+            INSERT INTO account_search(account_search, rowid, tw_username, tg_username)
+            VALUES ('delete', OLD.id, OLD.tw_username, OLD.tg_username);
+            INSERT INTO account_search(rowid, tw_username, tg_username)
+            VALUES (NEW.id, NEW.tw_username, NEW.tg_username);
+        END
+    ''')
+    # Новый платеж добавляет аккаунт в поиск (или обновляет ник TG последнего плательщика)
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_payments_search_ai AFTER INSERT ON payments BEGIN
+            INSERT INTO account_search_src (tw_username, tg_username)
+            VALUES (NEW.tw_username, (SELECT username FROM users WHERE user_id = NEW.user_id))
+            ON CONFLICT(tw_username) DO UPDATE SET tg_username = excluded.tg_username
+            WHERE tg_username IS NOT excluded.tg_username;
+        END
+    ''')
+    # Смена ника TG обновляет аккаунты, где пользователь - последний плательщик
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_search_au AFTER UPDATE OF username ON users
+        WHEN NEW.username IS NOT OLD.username BEGIN
+            UPDATE account_search_src SET tg_username = NEW.username
+            WHERE tw_username IN (
+                SELECT p.tw_username FROM payments p
+                WHERE p.user_id = NEW.user_id
+                  AND p.id = (SELECT MAX(id) FROM payments WHERE tw_username = p.tw_username)
+            );
+        END
+    ''')
+    # Первичное заполнение поиска для уже существующих платежей
+    await db.execute('''
+        INSERT INTO account_search_src (tw_username, tg_username)
+        SELECT p.tw_username, u.username
+        FROM payments p
+        LEFT JOIN users u ON p.user_id = u.user_id
+        WHERE p.id IN (SELECT MAX(id) FROM payments GROUP BY tw_username)
+          AND NOT EXISTS (SELECT 1 FROM account_search_src)
+    ''')
+
+
+async def _m005_rollups(db: aiosqlite.Connection):
+    # Тарифный план платежа (для сводок по планам; у старых платежей заполняется миграцией данных)
+    await _add_column(db, "payments", "plan_id", "TEXT")
+
+    # Сводки для /stats: выручка и число платежей по дням и планам (обновляются в транзакции платежа)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS daily_revenue (
+            day TEXT NOT NULL,       -- Дата платежа (YYYY-MM-DD)
+            plan_id TEXT NOT NULL,   -- Тарифный план ('other' - сумма не совпала ни с одним планом)
+            revenue REAL NOT NULL DEFAULT 0,
+            payments INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, plan_id)
+        ) WITHOUT ROWID
+    ''')
+    # Снимок числа активных/истекших подписок на день (пишет планировщик, платежи корректируют)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS daily_subscriptions (
+            day TEXT PRIMARY KEY,
+            active INTEGER NOT NULL DEFAULT 0,
+            expired INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+    # Сводки по уже существующим платежам считаются в фоне порциями по id.
+    # Платежи с id > target_id учтены инкрементально в save_payment.
+    async with db.execute('''
+        SELECT (SELECT MAX(id) FROM payments), NOT EXISTS (SELECT 1 FROM daily_revenue)
+    ''') as cursor:
+        max_id, rollups_empty = await cursor.fetchone()
+    if max_id and rollups_empty:
+        await _schedule_data_migration(db, "rollup_backfill", max_id)
+
+
+async def _m006_payments_archive(db: aiosqlite.Connection):
+    # Архив ("холодное" хранилище) платежей, вытесненных более новым платежом той же пары (user_id, tw_username)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS payments_archive (
+            id INTEGER PRIMARY KEY,       -- Тот же id, что был в payments
+            user_id INTEGER NOT NULL,
+            tw_username TEXT NOT NULL,
+            tx_hash TEXT UNIQUE NOT NULL,
+            amount REAL NOT NULL,
+            purchase_date TEXT NOT NULL,
+            subscription_end TEXT NOT NULL,
+            verification_status TEXT NOT NULL,
+            verification_note TEXT,
+            verify_attempts INTEGER NOT NULL DEFAULT 0,
+            plan_id TEXT,
+            archived_at TEXT NOT NULL     -- Когда платеж перенесен в архив
+        )
+    ''')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_payments_archive_tw_username ON payments_archive(tw_username)')
+    # Уникальность tx_hash должна соблюдаться по горячей и холодной таблицам вместе
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_payments_archive_unique BEFORE INSERT ON payments
+        WHEN EXISTS (SELECT 1 FROM payments_archive WHERE tx_hash = NEW.tx_hash) BEGIN
+            SELECT RAISE(ABORT, 'UNIQUE constraint failed: payments.tx_hash (archived)');
+        END
+    ''')
+
+
+async def _m007_drop_redundant_users_index(db: aiosqlite.Connection):
+    # users.user_id - INTEGER PRIMARY KEY (rowid), отдельный индекс по нему только замедлял запись
+    await db.execute('DROP INDEX IF EXISTS idx_users_user_id')
+
+
+async def _m008_scheduler_state(db: aiosqlite.Connection):
+    # Состояние фоновых задач (JSON): чекпойнт проверки подписок переживает перезапуск бота
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS scheduler_state (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    ''')
+
+
+async def _m009_reminders(db: aiosqlite.Connection):
+    # Часовой пояс пользователя (IANA, например Europe/Moscow); NULL - определяется по языку
+    await _add_column(db, "users", "timezone", "TEXT")
+    # Запланированные напоминания о подписках: доставляются в утреннее окно по местному времени,
+    # равномерно по слотам. Один тип напоминания на пару (user_id, tw_username) за день проверки.
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS reminder_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            tw_username TEXT NOT NULL,
+            kind TEXT NOT NULL,              -- warning (скоро истекает) / expired (истекла)
+            plan_day TEXT NOT NULL,          -- День проверки, которая запланировала напоминание
+            subscription_end TEXT NOT NULL,  -- Окончание подписки на момент планирования
+            language TEXT,
+            tg_username TEXT,
+            send_at REAL NOT NULL,           -- Когда отправить (unix time)
+            days INTEGER,                    -- warning: сколько дней останется по местной дате отправки
+            attempts INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (user_id, tw_username, kind, plan_day)
+        )
+    ''')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_reminder_queue_send_at ON reminder_queue(send_at)')
+
+
+async def _m010_tw_accounts(db: aiosqlite.Connection):
+    # Справочник аккаунтов TradingView с компактными целочисленными id: платежи ссылаются на него,
+    # а в callback_data админских кнопок передается id вместо ника (лимит Telegram - 64 байта).
+    # Таблица-источник поиска уже хранит по строке на аккаунт - она и становится справочником.
+    for trigger in ("trg_account_search_ai", "trg_account_search_ad", "trg_account_search_au",
+                    "trg_payments_search_ai", "trg_users_search_au"):
+        await db.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    await db.execute("DROP TABLE IF EXISTS account_search")
+    # При повторном применении (user_version меньше фактической схемы) таблица уже переименована;
+    # индекс поиска и триггеры пересоздаются заново - прежние удалены выше
+    if not await _table_exists(db, "tw_accounts"):
+        await db.execute("ALTER TABLE account_search_src RENAME TO tw_accounts")
+
+    await db.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS account_search USING fts5(
+            tw_username, tg_username,
+            content='tw_accounts', content_rowid='id', tokenize='trigram'
+        )
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_account_search_ai AFTER INSERT ON tw_accounts BEGIN
+            INSERT INTO account_search(rowid, tw_username, tg_username)
+            VALUES (NEW.id, NEW.tw_username, NEW.tg_username);
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_account_search_ad AFTER DELETE ON tw_accounts BEGIN
+            INSERT INTO account_search(account_search, rowid, tw_username, tg_username)
+            VALUES ('delete', OLD.id, OLD.tw_username, OLD.tg_username);
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_account_search_au AFTER UPDATE ON tw_accounts BEGIN
+            INSERT INTO account_search(account_search, rowid, tw_username, tg_username)
+            VALUES ('delete', OLD.id, OLD.tw_username, OLD.tg_username);
+            INSERT INTO account_search(rowid, tw_username, tg_username)
+            VALUES (NEW.id, NEW.tw_username, NEW.tg_username);
+        END
+    ''')
+
+    # Аккаунты, известные только по архиву (поиск их раньше не видел)
+    await db.execute('''
+        INSERT OR IGNORE INTO tw_accounts (tw_username)
+        SELECT DISTINCT tw_username FROM payments_archive
+    ''')
+    await db.execute("INSERT INTO account_search(account_search) VALUES ('rebuild')")
+
+    # Ссылка платежа на аккаунт. Заполняется здесь же, а не фоновой миграцией данных: запросы
+    # списка аккаунтов и истории сразу переходят на account_id. Каждая строка - поиск по
+    # уникальному индексу tw_username, это быстро даже для больших таблиц.
+    await _add_column(db, "payments", "account_id", "INTEGER REFERENCES tw_accounts(id)")
+    await _add_column(db, "payments_archive", "account_id", "INTEGER")
+    for table in ("payments", "payments_archive"):
+        await db.execute(f'''
+            UPDATE {table} SET account_id = (SELECT id FROM tw_accounts a WHERE a.tw_username = {table}.tw_username)
+            WHERE account_id IS NULL
+        ''')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_payments_account_id ON payments(account_id)')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_payments_archive_account_id ON payments_archive(account_id)')
+    # Поиск по нику TW теперь идет через tw_accounts (idx_payments_user_tw остается для пар user_id + ник)
+    await db.execute('DROP INDEX IF EXISTS idx_payments_tw_username')
+    await db.execute('DROP INDEX IF EXISTS idx_payments_archive_tw_username')
+
+    # Смена ника TG обновляет аккаунты, где пользователь - последний плательщик.
+    # Новые платежи пополняют tw_accounts в save_payment (там же нужен id для вставки платежа).
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_search_au AFTER UPDATE OF username ON users
+        WHEN NEW.username IS NOT OLD.username BEGIN
+            UPDATE tw_accounts SET tg_username = NEW.username
+            WHERE id IN (
+                SELECT p.account_id FROM payments p
+                WHERE p.user_id = NEW.user_id
+                  AND p.id = (SELECT MAX(id) FROM payments WHERE account_id = p.account_id)
+            );
+        END
+    ''')
+
+
+async def _m011_leases(db: aiosqlite.Connection):
+    # Аренды лидера: какой экземпляр бота сейчас выполняет фоновые рассылки (leader.py).
+    # token растет при каждой смене владельца - записи прежнего лидера отклоняются (фенсинг).
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,        -- Экземпляр: host:pid:случайный суффикс
+            token INTEGER NOT NULL,
+            expires_at REAL NOT NULL,    -- unix time; после него аренду может перехватить другой экземпляр
+            renewed_at REAL NOT NULL
+        )
+    ''')
+
+
+async def _m012_users_blocked(db: aiosqlite.Connection):
+    # Когда пользователь заблокировал бота (ответ Forbidden на отправку); NULL - доступен.
+    # Снимается при следующем апдейте от пользователя (blocked_users.py).
+    await _add_column(db, "users", "blocked_at", "TEXT")
+
+
+async def _m013_broadcasts(db: aiosqlite.Connection):
+    # Рассылки админа всем пользователям (broadcast.py). cursor - последний обработанный user_id:
+    # получатели идут по возрастанию user_id, поэтому прерванная рассылка продолжается с него.
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_by INTEGER NOT NULL,
+            created_at TEXT NOT NULL,
+            admin_language TEXT NOT NULL,    -- Язык отчетов о ходе рассылки
+            language TEXT,                   -- Фильтр получателей по языку (NULL - все)
+            active_on TEXT,                  -- Только с подпиской, действующей на эту дату (NULL - все)
+            content TEXT NOT NULL,           -- JSON: варианты сообщения по языкам
+            status TEXT NOT NULL DEFAULT 'draft', -- draft (ждет подтверждения), running, done, cancelled, failed
+            cursor INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            report_chat_id INTEGER,          -- Сообщение админу, в котором обновляется ход рассылки
+            report_message_id INTEGER,
+            finished_at TEXT
+        )
+    ''')
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_running ON broadcasts(id) WHERE status = 'running'")
+
+
+# Упорядоченный список миграций схемы: (версия, описание, функция). Новые - только в конец.
+MIGRATIONS = [
+    (1, "базовые таблицы users и payments", _m001_base_schema),
+    (2, "статус проверки транзакций в сети TRON", _m002_verification),
+    (3, "outbox уведомлений админам", _m003_admin_outbox),
+    (4, "поиск по аккаунтам (FTS5)", _m004_account_search),
+    (5, "сводки выручки и подписок", _m005_rollups),
+    (6, "архив платежей", _m006_payments_archive),
+    (7, "удален дублирующий индекс idx_users_user_id", _m007_drop_redundant_users_index),
+    (8, "состояние планировщика", _m008_scheduler_state),
+    (9, "часовые пояса и очередь напоминаний", _m009_reminders),
+    (10, "справочник аккаунтов tw_accounts", _m010_tw_accounts),
+    (11, "аренда лидера", _m011_leases),
+    (12, "отметка о блокировке бота пользователем", _m012_users_blocked),
+    (13, "рассылки админа", _m013_broadcasts),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+async def init_db():
+    """
+    Инициализация базы данных: применяет недостающие миграции схемы (по PRAGMA user_version).
+    Если схема актуальна, стоит одного чтения PRAGMA.
+    """
+    async with connect_db() as db:
+        async with db.execute("PRAGMA user_version") as cursor:
+            version = (await cursor.fetchone())[0]
+        if version >= SCHEMA_VERSION:
+            logging.info("Схема БД актуальна (версия %s).", version)
+            return
+
+        # Эти режимы нельзя менять внутри транзакции; оба сохраняются в файле БД.
+        # Инкрементальный VACUUM: место после архивации освобождается небольшими порциями (archive.py).
+        # На новой БД применяется сразу, существующую админ переводит командой /vacuum (разовый полный VACUUM).
+        await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        # WAL: долгие чтения (выгрузки, отчеты) не блокируют запись платежей, и наоборот
+        await db.execute("PRAGMA journal_mode=WAL")
+
+        # Все недостающие миграции - одной транзакцией: при ошибке схема остается в прежней версии
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            # Версию перечитываем под блокировкой записи: другой процесс мог успеть обновить схему
+            async with db.execute("PRAGMA user_version") as cursor:
+                version = (await cursor.fetchone())[0]
+            for migration_version, description, migrate in MIGRATIONS:
+                if migration_version <= version:
+                    continue
+                logging.info("Миграция схемы БД до версии %s: %s...", migration_version, description)
+                await migrate(db)
+            await db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        logging.info("Схема БД обновлена с версии %s до %s.", version, SCHEMA_VERSION)
+
+
+# --- Миграции данных (фоновые, порциями) ---
+
+async def _backfill_rollups_batch(db: aiosqlite.Connection, first_id: int, last_id: int, context: dict):
+    """
+    Досчитывает сводки выручки по платежам с id в [first_id, last_id] (горячие и архивные).
+    context["plan_prices"]: {цена: plan_id} - для заполнения plan_id у старых платежей по сумме.
+    """
+    for price, plan_id in context.get("plan_prices", {}).items():
+        for table in ("payments", "payments_archive"):
+            await db.execute(f'''
+                UPDATE {table} SET plan_id = ?
+                WHERE id BETWEEN ? AND ? AND plan_id IS NULL AND amount = ?
+            ''', (plan_id, first_id, last_id, price))
+    # Сложение, а не замена: за те же дни в сводке уже могут быть новые платежи
+    await db.execute('''
+        INSERT INTO daily_revenue (day, plan_id, revenue, payments)
+        SELECT purchase_date, COALESCE(plan_id, 'other'), SUM(amount), COUNT(*)
+        FROM (
+            SELECT purchase_date, plan_id, amount FROM payments WHERE id BETWEEN ? AND ?
+            UNION ALL
+            SELECT purchase_date, plan_id, amount FROM payments_archive WHERE id BETWEEN ? AND ?
+        )
+        GROUP BY purchase_date, COALESCE(plan_id, 'other')
+        ON CONFLICT(day, plan_id) DO UPDATE SET
+            revenue = revenue + excluded.revenue,
+            payments = payments + excluded.payments
+    ''', (first_id, last_id, first_id, last_id))
+
+
+# Обработчики миграций данных по имени (имя ставит в очередь миграция схемы)
+DATA_MIGRATIONS = {
+    "rollup_backfill": _backfill_rollups_batch,
+}
+
+
+async def run_data_migrations(context: dict = None):
+    """
+    Выполняет незавершенные миграции данных порциями по диапазонам id.
+    Каждая порция вместе с отметкой прогресса коммитится отдельно, поэтому бот между порциями
+    продолжает писать в БД, а после перезапуска работа продолжается с места остановки.
+    """
+    context = context or {}
+    async with connect_db() as db:
+        async with db.execute("SELECT name, last_id, target_id FROM data_migrations WHERE completed_at IS NULL") as cursor:
+            pending = await cursor.fetchall()
+
+    for name, last_id, target_id in pending:
+        handler = DATA_MIGRATIONS.get(name)
+        if handler is None:
+            logging.error("Неизвестная миграция данных '%s', пропускаем.", name)
+            continue
+        logging.info("Миграция данных '%s': обработка id %s..%s.", name, last_id + 1, target_id)
+        try:
+            while last_id < target_id:
+                batch_end = min(last_id + DATA_MIGRATION_BATCH_SIZE, target_id)
+                async with connect_db() as db:
+                    # Порция дописывает в сводки, поэтому применяется ровно один раз: запись - только
+                    # у действующего лидера, и отметка прогресса сдвигается, только если ее никто не сдвинул
+                    await check_fence(db, current_fence())
+                    await handler(db, last_id + 1, batch_end, context)
+                    completed_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S") if batch_end >= target_id else None
+                    cursor = await db.execute(
+                        "UPDATE data_migrations SET last_id = ?, completed_at = ? WHERE name = ? AND last_id = ?",
+                        (batch_end, completed_at, name, last_id)
+                    )
+                    if cursor.rowcount != 1:
+                        await db.rollback()
+                        logging.warning("Миграция данных '%s': порция %s..%s уже обработана другим экземпляром.",
+                                        name, last_id + 1, batch_end)
+                        break
+                    await db.commit()
+                last_id = batch_end
+                await asyncio.sleep(DATA_MIGRATION_PAUSE)
+            else:
+                logging.info("Миграция данных '%s' завершена.", name)
+        except LeaseLost as e:
+            logging.warning("Миграция данных '%s' остановлена: %s", name, e)
+            return
+        except Exception as e:
+            logging.exception("Ошибка миграции данных '%s' (продолжится при следующем запуске): %s", name, e)
@@ -0,0 +1,265 @@
+"""
+Воспроизведение записанного потока апдейтов (update_recorder.py, RECORD_UPDATES_FILE) для сравнения
+задержек обработчиков и нагрузки на БД между версиями бота.
+Запуск: python replay.py updates.jsonl.gz --db bot_database.db [--speed 10] [--api-latency 50] [--json result.json]
+
+Апдейты подаются в Dispatcher с исходными интервалами (--speed ускоряет, 0 - без пауз) через все
+middleware, как при опросе. Запросы к Bot API уходят на локальный фейковый сервер, который отвечает
+правдоподобными объектами с задержкой --api-latency. Работа идет на копии БД во временном каталоге,
+исходный файл не меняется. Фоновые задачи лидера (напоминания, рассылки, бэкапы) не запускаются.
+"""
+import argparse
+import asyncio
+import gzip
+import itertools
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import web
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+TOKEN = "123456:REPLAYREPLAYREPLAYREPLAYREPLAYREPLA"
+MEDIA_TYPES = ("document", "photo", "video", "animation")
+
+
+def read_log(path: str):
+    """Записи лога: (секунды от начала воспроизведения, апдейт) и число админов из заголовков."""
+    opener = gzip.open if path.endswith(".gz") else open
+    records, admins, offset, last = [], 0, 0.0, 0.0
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "v" in record:
+                # Следующий запуск бота в том же файле: время продолжается с последнего апдейта
+                admins = max(admins, record.get("admins", 0))
+                offset = last
+                continue
+            last = offset + record["t"]
+            records.append((last, record["u"]))
+    return records, admins
+
+
+class FakeBotAPI:
+    """Локальный сервер Bot API: считает вызовы методов и отвечает правдоподобными объектами."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._runner = None
+        self.url = None
+
+    def _message(self, fields: dict) -> dict:
+        chat_id = fields.get("chat_id", "0")
+        message = {"message_id": int(fields.get("message_id") or next(self._message_ids)),
+                   "date": int(time.time()),
+                   "chat": {"id": int(chat_id) if chat_id.lstrip("-").isdigit() else 0, "type": "private"}}
+        if "text" in fields:
+            message["text"] = fields["text"]
+        for media_type in MEDIA_TYPES:
+            if media_type in fields:
+                file = {"file_id": f"replay-file-{next(self._file_ids)}", "file_unique_id": "replay"}
+                message[media_type] = [dict(file, width=1, height=1)] if media_type == "photo" else file
+        if "caption" in fields:
+            message["caption"] = fields["caption"]
+        return message
+
+    async def _handle(self, request: web.Request):
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        fields = {}
+        if request.content_type.startswith("multipart/"):
+            reader = await request.multipart()
+            while (part := await reader.next()) is not None:
+                fields[part.name] = "file" if part.filename else (await part.text())
+        else:
+            fields = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Replay", "username": "replay_bot"}
+        elif method.startswith(("send", "edit", "copy", "forward")) and method != "sendChatAction":
+            result = self._message(fields)
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", 0).start()
+        self.url = f"http://127.0.0.1:{self._runner.addresses[0][1]}"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+def update_kind(app, update) -> str:
+    """Группа для статистики задержек: вид апдейта и обработчика (команда, кнопка, данные колбэка без id)."""
+    event = update.event
+    if update.event_type == "message":
+        if event.text and event.text.startswith("/"):
+            return "message " + event.text.split()[0].split("@")[0]
+        return "message " + app.throttle_kind(event)
+    if update.event_type == "callback_query":
+        return "callback " + (event.data or "").rstrip("0123456789_") # Без id в конце: client_15 -> client
+    return update.event_type
+
+
+def percentile(values, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+
+async def replay(args, records, workdir):
+    import app
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.types import Update
+    from db_profiler import get_query_stats, reset_query_stats
+    from send_queue import send_queue
+
+    api = FakeBotAPI(args.api_latency / 1000)
+    await api.start()
+    app.bot.session.api = TelegramAPIServer.from_base(api.url)
+    if args.no_throttle:
+        app.throttling.limits = {}
+    await app.load_bot_state()
+    send_queue_task = asyncio.create_task(send_queue.run())
+    reset_query_stats()
+    api.calls.clear()
+
+    latencies = defaultdict(list)
+    errors = Counter()
+
+    async def feed(data: dict):
+        update = Update.model_validate(data, context={"bot": app.bot})
+        kind = update_kind(app, update)
+        started = time.perf_counter()
+        try:
+            await app.dp.feed_update(app.bot, update)
+        except Exception:
+            errors[kind] += 1
+        latencies[kind].append((time.perf_counter() - started) * 1000)
+
+    print(f"Воспроизведение {len(records)} апдейтов, скорость x{args.speed or 'max'}, рабочий каталог {workdir}")
+    started = time.monotonic()
+    tasks = set()
+    for at, data in records:
+        if args.speed:
+            delay = at / args.speed - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        task = asyncio.create_task(feed(data))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.wait(tasks)
+    elapsed = time.monotonic() - started
+
+    send_queue_task.cancel()
+    await asyncio.gather(send_queue_task, return_exceptions=True)
+    await app.bot.session.close()
+    await api.stop()
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    result = {
+        "updates": len(records),
+        "elapsed_sec": round(elapsed, 3),
+        "rate_per_sec": round(len(records) / elapsed, 1) if elapsed else None,
+        "latency_ms": {
+            kind: {"count": len(values), "p50": round(percentile(values, 0.5), 2),
+                   "p95": round(percentile(values, 0.95), 2), "max": round(max(values), 2),
+                   "errors": errors[kind]}
+            for kind, values in sorted(latencies.items())
+        },
+        "latency_total_ms": {"p50": round(percentile(all_latencies, 0.5), 2),
+                             "p95": round(percentile(all_latencies, 0.95), 2),
+                             "max": round(max(all_latencies, default=0), 2)},
+        "bot_api_calls": dict(api.calls.most_common()),
+        "db_queries": [{"sql": stat.sql[:150], "count": stat.count, "total_ms": round(stat.total_ms, 1),
+                        "p95_ms": round(stat.p95_ms, 2), "max_ms": round(stat.max_ms, 2), "full_scan": stat.full_scan}
+                       for stat in get_query_stats(limit=args.top)],
+        "admission": app.admission_control.stats(),
+        "throttling": app.throttling.stats(),
+    }
+    return result
+
+
+def print_report(result: dict):
+    print(f"\nАпдейтов: {result['updates']} за {result['elapsed_sec']} с ({result['rate_per_sec']}/с)")
+    total = result["latency_total_ms"]
+    print(f"Задержка обработки, мс: p50 {total['p50']} | p95 {total['p95']} | макс. {total['max']}")
+    print(f"\n{'Вид апдейта':<34}{'шт.':>7}{'p50':>9}{'p95':>9}{'макс.':>9}{'ошибок':>8}")
+    for kind, stat in result["latency_ms"].items():
+        print(f"{kind[:33]:<34}{stat['count']:>7}{stat['p50']:>9}{stat['p95']:>9}{stat['max']:>9}{stat['errors']:>8}")
+    print("\nВызовы Bot API: " + ", ".join(f"{method} {count}" for method, count in result["bot_api_calls"].items()))
+    print(f"Контроль допуска: {result['admission']}")
+    print(f"Анти-флуд: {result['throttling']}")
+    print("\nСамые затратные запросы к БД:")
+    for stat in result["db_queries"]:
+        scan = " [FULL SCAN]" if stat["full_scan"] else ""
+        print(f"  всего {stat['total_ms']:.0f} мс | {stat['count']}x | p95 {stat['p95_ms']} | макс. {stat['max_ms']}{scan}\n"
+              f"    {stat['sql']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение записанных апдейтов на копии БД.")
+    parser.add_argument("log", help="Файл записи апдейтов (.jsonl или .jsonl.gz)")
+    parser.add_argument("--db", default=os.path.join(APP_DIR, "bot_database.db"),
+                        help="БД, копия которой используется при воспроизведении")
+    parser.add_argument("--speed", type=float, default=1.0, help="Ускорение относительно записи (0 - без пауз)")
+    parser.add_argument("--api-latency", type=float, default=50.0, help="Задержка ответа фейкового Bot API (мс)")
+    parser.add_argument("--no-throttle", action="store_true", help="Отключить анти-флуд (при сильном ускорении)")
+    parser.add_argument("--top", type=int, default=10, help="Сколько запросов к БД показать")
+    parser.add_argument("--json", help="Сохранить результат в JSON (для сравнения версий)")
+    parser.add_argument("--keep", action="store_true", help="Не удалять рабочий каталог с копией БД")
+    args = parser.parse_args()
+
+    records, admins = read_log(args.log)
+    log_path = os.path.abspath(args.log)
+    json_path = os.path.abspath(args.json) if args.json else None
+    workdir = tempfile.mkdtemp(prefix="replay_")
+    if os.path.exists(args.db):
+        # Копия через backup API: согласованный снимок, включая еще не перенесенный WAL
+        with sqlite3.connect(args.db) as source, sqlite3.connect(os.path.join(workdir, "bot_database.db")) as target:
+            source.backup(target)
+    else:
+        print(f"БД {args.db} не найдена, воспроизведение на пустой БД.")
+    if os.path.isdir(os.path.join(APP_DIR, "media")):
+        os.symlink(os.path.join(APP_DIR, "media"), os.path.join(workdir, "media"))
+
+    # Окружение до импорта app: фейковый токен, админы - псевдонимы 1..n из записи, без повторной записи
+    os.environ["BOT_TOKEN"] = TOKEN
+    os.environ["ADMIN_IDS"] = ",".join(str(i) for i in range(1, admins + 1)) or "1"
+    os.environ["RECORD_UPDATES_FILE"] = ""
+    os.environ["TRON_VERIFY_ENABLED"] = "0"
+    os.environ.setdefault("TRC20_WALLET", "TReplayWallet")
+    os.environ.setdefault("ADMIN_USERNAME", "replay_admin")
+    sys.path.insert(0, APP_DIR)
+    os.chdir(workdir)
+    print(f"Запись {log_path}: {len(records)} апдейтов, админов {admins}")
+    try:
+        result = asyncio.run(replay(args, records, workdir))
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print_report(result)
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"\nРезультат сохранен в {json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Полосы приоритета исходящих запросов (меньше - важнее) ---
+LANE_INTERACTIVE = 0   # Ответы пользователю в обработчиках
+LANE_ADMIN = 1         # Уведомления админам
+LANE_BULK = 2          # Массовые рассылки планировщика
+LANE_NAMES = {LANE_INTERACTIVE: "interactive", LANE_ADMIN: "admin", LANE_BULK: "bulk"}
+
+# Лимиты Telegram: ~30 сообщений/сек на бота, ~1/сек в личный чат, ~20/мин в группу
+GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "25"))
+GLOBAL_BURST = 30
+CHAT_RATE = 1.0
+CHAT_BURST = 3
+GROUP_RATE = 20 / 60
+GROUP_BURST = 3
+# Часть глобального лимита, которую фоновые полосы не трогают (запас для интерактивных ответов)
+INTERACTIVE_RESERVE = 5
+MAX_RETRY_AFTER_ATTEMPTS = 3
+CHAT_BUCKETS_LIMIT = 10_000
+
+# Полоса текущей задачи: по умолчанию интерактивная (обработчики), фоновые задачи переключают через send_lane()
+_current_lane = contextvars.ContextVar("send_lane", default=LANE_INTERACTIVE)
+
+
+@contextmanager
+def send_lane(lane: int):
+    """Все запросы к Bot API внутри блока идут в очередь с указанной полосой."""
+    token = _current_lane.set(lane)
+    try:
+        yield
+    finally:
+        _current_lane.reset(token)
+
+
+class TokenBucket:
+    """Классическое ведро токенов: rate токенов в секунду, не больше capacity."""
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self, now: float) -> float:
+        self._refill(now)
+        return self.tokens
+
+    def wait_time(self, now: float, reserve: float = 0) -> float:
+        """Через сколько секунд будет токен сверх reserve."""
+        missing = reserve + 1 - self.available(now)
+        return max(0.0, missing / self.rate)
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _Request:
+    __slots__ = ("lane", "chat_id", "make_request", "bot", "method", "future", "attempts")
+
+    def __init__(self, lane, chat_id, make_request, bot, method, future):
+        self.lane = lane
+        self.chat_id = chat_id
+        self.make_request = make_request
+        self.bot = bot
+        self.method = method
+        self.future = future
+        self.attempts = 0
+
+
+class SendQueue(BaseRequestMiddleware):
+    """
+    Единая очередь исходящих запросов к Bot API (middleware сессии бота).
+    Запросы с chat_id (отправка, редактирование сообщений) проходят через полосы приоритета
+    и ведра токенов (общее и на чат); остальные (getUpdates, answerCallbackQuery) идут напрямую.
+    Фоновые полосы не занимают последние INTERACTIVE_RESERVE токенов общего ведра,
+    поэтому рассылка не добавляет задержку ответам пользователям.
+    """
+
+    def __init__(self):
+        self._lanes = {lane: deque() for lane in LANE_NAMES}
+        self._global = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self._chats = {}           # chat_id -> TokenBucket
+        self._chat_blocked = {}    # chat_id -> monotonic-время, до которого чат на паузе (RetryAfter)
+        self._inflight_chats = set() # В каждый чат - не больше одного запроса одновременно (порядок сообщений)
+        self._paused_until = 0.0   # Общая пауза после RetryAfter
+        self._wakeup = asyncio.Event()
+        self._worker = None
+        self.stats = {name: 0 for name in LANE_NAMES.values()}
+        self.stats["retry_after"] = 0
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or self._worker is None or self._worker.done():
+            return await make_request(bot, method)
+        lane = _current_lane.get()
+        future = asyncio.get_running_loop().create_future()
+        self._lanes[lane].append(_Request(lane, chat_id, make_request, bot, method, future))
+        self._wakeup.set()
+        return await future
+
+    def queue_sizes(self) -> dict:
+        return {LANE_NAMES[lane]: len(items) for lane, items in self._lanes.items()}
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= CHAT_BUCKETS_LIMIT:
+                # Ведра давно молчавших чатов полные и ничего не ограничивают - проще начать заново
+                self._chats.clear()
+                now = time.monotonic()
+                self._chat_blocked = {chat: until for chat, until in self._chat_blocked.items() if until > now}
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(GROUP_RATE, GROUP_BURST) if is_group else TokenBucket(CHAT_RATE, CHAT_BURST)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _next_request(self, now: float):
+        """
+        Следующий запрос, который можно отправить сейчас, или (None, сколько ждать).
+        Внутри полосы чаты, упершиеся в свой лимит, не задерживают остальные.
+        """
+        wait = 1.0
+        if now < self._paused_until:
+            return None, self._paused_until - now
+        for lane, items in self._lanes.items():
+            if not items:
+                continue
+            reserve = 0 if lane == LANE_INTERACTIVE else INTERACTIVE_RESERVE
+            global_wait = self._global.wait_time(now, reserve)
+            if global_wait > 0:
+                wait = min(wait, global_wait)
+                continue
+            for request in items:
+                if request.future.done():
+                    # Вызывающий уже не ждет (отменен) - выбрасываем без траты токенов
+                    items.remove(request)
+                    return None, 0
+                if request.chat_id in self._inflight_chats:
+                    continue
+                blocked_until = self._chat_blocked.get(request.chat_id, 0)
+                if blocked_until > now:
+                    wait = min(wait, blocked_until - now)
+                    continue
+                chat_wait = self._chat_bucket(request.chat_id).wait_time(now)
+                if chat_wait > 0:
+                    wait = min(wait, chat_wait)
+                    continue
+                items.remove(request)
+                return request, 0
+        return None, wait
+
+    async def _send(self, request: _Request):
+        try:
+            result = await request.make_request(request.bot, request.method)
+        except TelegramRetryAfter as e:
+            # Лимит превышен: пауза для чата и короткая общая пауза, запрос повторяется первым в своей полосе
+            self.stats["retry_after"] += 1
+            request.attempts += 1
+            now = time.monotonic()
+            self._chat_blocked[request.chat_id] = now + e.retry_after
+            self._paused_until = max(self._paused_until, now + min(e.retry_after, 5))
+            logging.warning("Очередь отправки: RetryAfter %s сек. для чата %s (полоса %s).",
+                            e.retry_after, request.chat_id, LANE_NAMES[request.lane])
+            if request.attempts < MAX_RETRY_AFTER_ATTEMPTS and not request.future.done():
+                self._lanes[request.lane].appendleft(request)
+            elif not request.future.done():
+                request.future.set_exception(e)
+        except Exception as e:
+            if not request.future.done():
+                request.future.set_exception(e)
+        else:
+            self.stats[LANE_NAMES[request.lane]] += 1
+            if not request.future.done():
+                request.future.set_result(result)
+        finally:
+            self._inflight_chats.discard(request.chat_id)
+            self._wakeup.set()
+
+    async def run(self):
+        """Цикл диспетчера очереди. При остановке оставшиеся запросы отправляются напрямую."""
+        logging.info("Очередь отправки Bot API запущена (общий лимит %s/сек).", GLOBAL_RATE)
+        self._worker = asyncio.current_task()
+        tasks = set()
+        try:
+            while True:
+                self._wakeup.clear()
+                now = time.monotonic()
+                request, wait = self._next_request(now)
+                if request is None:
+                    if not wait:
+                        continue
+                    # Таймер вместо wait_for: тот может потерять отмену задачи, если событие пришло одновременно
+                    timer = asyncio.get_running_loop().call_later(wait, self._wakeup.set)
+                    try:
+                        await self._wakeup.wait()
+                    finally:
+                        timer.cancel()
+                    continue
+                self._global.take()
+                self._chat_bucket(request.chat_id).take()
+                self._inflight_chats.add(request.chat_id)
+                task = asyncio.create_task(self._send(request))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            self._worker = None
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            # Остановка бота: не бросаем ожидающих (ответы в обработчиках, outbox) - шлем без очереди
+            for items in self._lanes.values():
+                while items:
+                    request = items.popleft()
+                    if request.future.done():
+                        continue
+                    try:
+                        request.future.set_result(await request.make_request(request.bot, request.method))
+                    except Exception as e:
+                        request.future.set_exception(e)
+
+
+send_queue = SendQueue()
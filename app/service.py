@@ -1,18 +1,37 @@
 import asyncio
 import logging
 import os
+import time
+import zlib
 from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from dotenv import load_dotenv
 
 from aiogram import Bot
 from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
 
+from send_queue import send_lane, LANE_ADMIN, LANE_BULK, GLOBAL_RATE, CHAT_RATE
+from leader import current_fence, lease_valid
+from expiry_index import expiry_index, EXPIRY_WARNING_DAYS
+
 # Импортируем новую функцию из database.py
 try:
-    from database import get_subscriptions_for_notification_check, DATABASE_FILE
-    import aiosqlite # Нужен для получения TG username в notify_admins...
+    from database import (
+        get_subscriptions_for_notification_check,
+        get_notification_forecast,
+        save_subscription_snapshot,
+        get_scheduler_state,
+        save_scheduler_state,
+        enqueue_reminders,
+        get_due_reminders,
+        get_next_reminder_time,
+        complete_reminders,
+        enqueue_outbox_messages,
+        get_due_outbox_messages,
+        complete_outbox_batch
+    )
 except ImportError as e:
-     logging.error(f"Ошибка импорта из database.py в service.py: {e}")
+     logging.error("Ошибка импорта из database.py в service.py: %s", e)
      exit()
 
 load_dotenv()
@@ -29,148 +48,389 @@ else:
 
 
 # --- Уведомление админов о НОВОМ платеже ---
-async def notify_admins_about_new_payment(bot: Bot, user_id: int, tw_username: str, tx_hash: str, amount: float, purchase_date: str, subscription_end: str):
-    """Уведомление админов о новом платеже с деталями"""
-    try:
-        # Получаем telegram username из базы
-        tg_username = "не указан"
+def format_new_payment_message(user_id: int, tg_username: str, tw_username: str, tx_hash: str, amount: float,
+                               purchase_date: str, subscription_end: str) -> str:
+    """Текст уведомления админам о новом платеже."""
+    return (
+        "💰 *Новый платеж!*\n\n"
+        f"👤 Telegram ID: `{user_id}`\n"
+        f"👤 Telegram: @{tg_username or 'не указан'}\n"
+        f"👤 TradingView: **{tw_username}**\n" # Выделяем TW username
+        f"🔗 Hash: `{tx_hash}`\n"
+        f"💵 Сумма: *{amount} USDT*\n"
+        f"📅 Дата платежа: {purchase_date}\n"
+        f"⏳ Окончание подписки: *{subscription_end}*"
+    )
+
+async def enqueue_new_payment_notification(db, user_id: int, tg_username: str, tw_username: str, tx_hash: str,
+                                           amount: float, purchase_date: str, subscription_end: str):
+    """
+    Кладет уведомление о новом платеже в outbox в рамках транзакции платежа.
+    Отправку выполняет фоновый start_outbox_sender, пользователь ее не ждет.
+    """
+    message = format_new_payment_message(user_id, tg_username, tw_username, tx_hash, amount,
+                                         purchase_date, subscription_end)
+    await enqueue_outbox_messages(db, ADMIN_IDS, message)
+
+
+# --- Фоновая отправка сообщений из outbox ---
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_POLL_INTERVAL = 30    # Проверка отложенных повторов (сек), новые сообщения будят отправителя сразу
+OUTBOX_MAX_ATTEMPTS = 20
+OUTBOX_MAX_BACKOFF = 3600
+
+_outbox_wakeup = asyncio.Event()
+
+def wake_outbox_sender():
+    """Сигнал отправителю: в outbox появились новые сообщения (вызывать после коммита)."""
+    _outbox_wakeup.set()
+
+async def send_outbox_batch(bot: Bot) -> int:
+    """Отправляет одну пачку готовых сообщений. Возвращает размер пачки."""
+    now = time.time()
+    messages = await get_due_outbox_messages(now, OUTBOX_BATCH_SIZE)
+    done_ids = []
+    retries = []
+    for i, (msg_id, chat_id, text, parse_mode, attempts) in enumerate(messages):
+        if not lease_valid():
+            break # Аренда лидера истекла: остаток пачки отправит новый лидер
         try:
-            async with aiosqlite.connect(DATABASE_FILE) as db:
-               async with db.execute("SELECT username FROM users WHERE user_id = ?", (user_id,)) as cursor:
-                   user_info = await cursor.fetchone()
-                   if user_info and user_info[0]:
-                       tg_username = user_info[0]
-        except Exception as db_err:
-            logging.error(f"Ошибка получения tg_username для user_id {user_id} при уведомлении админов: {db_err}")
-
-        message = (
-            "💰 *Новый платеж!*\n\n"
-            f"👤 Telegram ID: `{user_id}`\n"
-            f"👤 Telegram: @{tg_username}\n"
-            f"👤 TradingView: **{tw_username}**\n" # Выделяем TW username
-            f"🔗 Hash: `{tx_hash}`\n"
-            f"💵 Сумма: *{amount} USDT*\n"
-            f"📅 Дата платежа: {purchase_date}\n"
-            f"⏳ Окончание подписки: *{subscription_end}*"
-        )
-
-        for admin_id in ADMIN_IDS:
+            await bot.send_message(chat_id, text, parse_mode=parse_mode)
+            done_ids.append(msg_id)
+        except TelegramRetryAfter as e:
+            # Лимит Telegram: откладываем эту и все оставшиеся сообщения пачки
+            logging.warning("Outbox: превышен лимит Telegram API, пауза %s сек.", e.retry_after)
+            retry_at = time.time() + e.retry_after
+            retries.extend((retry_at, m[0]) for m in messages[i:])
+            break
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Повтор не поможет (админ заблокировал бота, битая разметка) - отбрасываем
+            logging.error("Outbox: сообщение %s для %s отброшено: %s", msg_id, chat_id, e)
+            done_ids.append(msg_id)
+        except Exception as e:
+            if attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+                logging.error("Outbox: сообщение %s для %s отброшено после %s попыток: %s", msg_id, chat_id, attempts + 1, e)
+                done_ids.append(msg_id)
+            else:
+                delay = min(OUTBOX_MAX_BACKOFF, 5 * 2 ** attempts)
+                logging.warning("Outbox: ошибка отправки %s для %s: %s. Повтор через %s сек.", msg_id, chat_id, e, delay)
+                retries.append((time.time() + delay, msg_id))
+
+    if done_ids or retries:
+        await complete_outbox_batch(done_ids, retries, fence=current_fence())
+    return len(messages)
+
+async def start_outbox_sender(bot: Bot):
+    """
+    Фоновый отправитель уведомлений админам из outbox.
+    Сообщения удаляются только после успешной отправки, поэтому переживают перезапуск бота.
+    """
+    logging.info("Отправитель outbox уведомлений запущен.")
+    with send_lane(LANE_ADMIN):
+        while True:
+            _outbox_wakeup.clear()
             try:
-                await bot.send_message(admin_id, message, parse_mode="Markdown")
+                while await send_outbox_batch(bot) == OUTBOX_BATCH_SIZE:
+                    await asyncio.sleep(0)
             except Exception as e:
-                logging.error(f"Ошибка отправки уведомления админу {admin_id} о платеже user_id {user_id}: {e}")
+                logging.exception("Ошибка в цикле отправки outbox: %s", e)
+            try:
+                await asyncio.wait_for(_outbox_wakeup.wait(), timeout=OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
 
-    except Exception as e:
-        logging.exception(f"Критическая ошибка в notify_admins_about_new_payment для user_id {user_id}: {e}")
 
+# --- Проверка подписок и планирование напоминаний ---
+SUBSCRIPTION_CHECK_STATE = "subscription_check"
+SCHEDULER_CHECKPOINT_EVERY = 50   # Как часто сохранять чекпойнт проверки (пар)
+SUBSCRIPTION_CHECK_INTERVAL = 86400
+
+# Окно доставки напоминаний по местному времени пользователя (часы) и ширина слота (сек)
+REMINDER_WINDOW_START = int(os.getenv("REMINDER_WINDOW_START", "10"))
+REMINDER_WINDOW_END = int(os.getenv("REMINDER_WINDOW_END", "13"))
+REMINDER_SLOT_SECONDS = 60
+# Часовой пояс по языку, если пользователь его не указал
+LANGUAGE_TIMEZONES = {"ru": "Europe/Moscow", "es": "America/Mexico_City", "en": "UTC"}
+DEFAULT_TIMEZONE = "UTC"
 
-# --- Проверка подписок и отправка уведомлений ---
-async def check_subscriptions(bot: Bot, texts: dict):
+def resolve_timezone(timezone: str, lang: str) -> ZoneInfo:
+    """Часовой пояс пользователя: указанный им, иначе по языку, иначе UTC."""
+    for name in (timezone, LANGUAGE_TIMEZONES.get(lang), DEFAULT_TIMEZONE):
+        if not name:
+            continue
+        try:
+            return ZoneInfo(name)
+        except (ZoneInfoNotFoundError, ValueError):
+            continue
+    return ZoneInfo(DEFAULT_TIMEZONE)
+
+def plan_delivery_time(user_id: int, tw_username: str, tz: ZoneInfo, now: datetime = None) -> float:
     """
-    Проверяет все последние подписки для пар (user_id, tw_username)
-    и отправляет уведомления пользователям и админам.
+    Время доставки напоминания (unix time): ближайшее окно REMINDER_WINDOW_START..END по местному времени,
+    слот внутри окна - по хешу пары (user_id, tw_username). Напоминания распределяются по окну равномерно,
+    а повторное планирование той же пары дает тот же слот.
     """
-    logging.info("Запуск периодической проверки подписок...")
+    local_now = (now or datetime.now(tz)).astimezone(tz)
+    window_start = local_now.replace(hour=REMINDER_WINDOW_START, minute=0, second=0, microsecond=0)
+    window_end = local_now.replace(hour=REMINDER_WINDOW_END, minute=0, second=0, microsecond=0)
+    if local_now >= window_end:
+        # Сегодняшнее окно прошло - завтра (через date, чтобы не ошибиться при переходе на летнее время)
+        tomorrow = local_now.date() + timedelta(days=1)
+        window_start = datetime.combine(tomorrow, window_start.timetz())
+        window_end = datetime.combine(tomorrow, window_end.timetz())
+    slots = max(1, int((window_end - window_start).total_seconds()) // REMINDER_SLOT_SECONDS)
+    slot = zlib.crc32(f"{user_id}:{tw_username}".encode()) % slots
+    send_at = window_start.timestamp() + slot * REMINDER_SLOT_SECONDS
+    # Окно уже идет: прошедшие слоты переносим на оставшуюся часть окна
+    if send_at < local_now.timestamp():
+        remaining = window_end.timestamp() - local_now.timestamp()
+        send_at = local_now.timestamp() + (slot * REMINDER_SLOT_SECONDS) % max(1, remaining)
+    return send_at
+
+async def check_subscriptions(bot: Bot, texts: dict, dry_run: bool = False):
+    """
+    Проверяет все последние подписки для пар (user_id, tw_username) и планирует напоминания
+    (отправляет start_reminder_sender в утреннее окно по местному времени пользователя).
+    dry_run: только посчитать, что было бы запланировано сегодня - без записи напоминаний,
+    чекпойнта и снимка подписок. Возвращает счетчики проверки.
+    """
+    logging.info("Запуск периодической проверки подписок%s...", ' (пробный прогон)' if dry_run else '')
     current_date = datetime.now().date() # Используем только дату для сравнения
-    expiring_count = 0
-    expired_count = 0
+    today = current_date.strftime("%Y-%m-%d")
+    # Чекпойнт: на какой паре (user_id, tw_username) остановилась проверка и счетчики на тот момент.
+    # Прерванная сегодня проверка (перезапуск бота) продолжается с этого места.
+    checkpoint = None if dry_run else await get_scheduler_state(SUBSCRIPTION_CHECK_STATE)
+    if not checkpoint or checkpoint.get("day") != today or checkpoint.get("done"):
+        checkpoint = {"day": today, "after": None, "expiring": 0, "expired": 0, "active_total": 0, "expired_total": 0}
+    elif checkpoint["after"]:
+        logging.info("Продолжение прерванной проверки подписок после user_id=%s, TW='%s'.", checkpoint['after'][0], checkpoint['after'][1])
+    resume_after = tuple(checkpoint["after"]) if checkpoint["after"] else None
+    expiring_count = checkpoint["expiring"]
+    expired_count = checkpoint["expired"]
+    active_total = checkpoint["active_total"] # Для снимка daily_subscriptions
+    expired_total = checkpoint["expired_total"]
+    processed = 0
+    planned = [] # Напоминания, еще не записанные в reminder_queue
+
+    async def save_checkpoint(after, done: bool = False):
+        if dry_run:
+            planned.clear()
+            return
+        # Сначала напоминания, потом отметка прогресса: повторное планирование безопасно (INSERT OR IGNORE)
+        if planned:
+            await enqueue_reminders(planned, fence=current_fence())
+            planned.clear()
+        checkpoint.update(after=after, done=done, finished_at=time.time() if done else None,
+                          expiring=expiring_count, expired=expired_count,
+                          active_total=active_total, expired_total=expired_total)
+        await save_scheduler_state(SUBSCRIPTION_CHECK_STATE, checkpoint, fence=current_fence())
 
+    last_pair = resume_after
     try:
-        subscriptions_to_check = await get_subscriptions_for_notification_check()
-        logging.info(f"Получено {len(subscriptions_to_check)} уникальных последних подписок для проверки.")
+        # Индекс окончаний в памяти отдает только подписки в окне напоминаний и готовые счетчики
+        due = await expiry_index.due_subscriptions(current_date)
+        if due is None:
+            expired_day = (current_date - timedelta(days=1)).strftime("%Y-%m-%d")
+            subscriptions_to_check = await get_subscriptions_for_notification_check(expired_day)
+            logging.info("Получено %s уникальных последних подписок для проверки.", len(subscriptions_to_check))
+        else:
+            subscriptions_to_check, (active_total, expired_total) = due
+            logging.info("Подписок в окне напоминаний: %s (всего активных %s, истекших %s).",
+                         len(subscriptions_to_check), active_total, expired_total)
 
-        for user_id, tw_username, sub_end_str, lang, tg_username in subscriptions_to_check:
+        # У заблокировавших бота сюда попадает только подписка, истекшая вчера: напоминание о ней
+        # не уходит пользователю, а превращается в одно уведомление админам (send_due_reminders)
+        for user_id, tw_username, sub_end_str, lang, tg_username, timezone, blocked in subscriptions_to_check:
+            if resume_after and (user_id, tw_username) <= resume_after:
+                continue # Уже обработано до перезапуска
+            if processed and processed % SCHEDULER_CHECKPOINT_EVERY == 0:
+                await save_checkpoint(last_pair)
+            processed += 1
+            last_pair = (user_id, tw_username)
             try:
                 sub_end_date = datetime.strptime(sub_end_str, "%Y-%m-%d").date()
             except ValueError:
-                logging.error(f"Неверный формат даты '{sub_end_str}' для user_id={user_id}, tw_username='{tw_username}'. Пропуск.")
+                logging.error("Неверный формат даты '%s' для user_id=%s, tw_username='%s'. Пропуск.", sub_end_str, user_id, tw_username)
                 continue
 
             lang = lang or 'en' # Фоллбэк на английский, если язык не указан
             days_until_expiry = (sub_end_date - current_date).days
+            if due is None:
+                if days_until_expiry >= 0:
+                    active_total += 1
+                else:
+                    expired_total += 1
 
-            # 1. Проверка на скорое окончание (1-3 дня включительно)
-            if 0 <= days_until_expiry < 3:
-                days_left = days_until_expiry + 1 # Дней осталось (1, 2 или 3)
-                try:
-                    warning_msg = texts.get(lang, texts['en'])["subscription_warning_for"].format(
-                        tw_username=tw_username,
-                        days=days_left,
-                        date=sub_end_str
-                    )
-                    await bot.send_message(user_id, warning_msg, parse_mode="Markdown")
-                    logging.info(f"Отправлено ПРЕДУПРЕЖДЕНИЕ user_id={user_id} для TW='{tw_username}' (осталось {days_left} дн.)")
-                    expiring_count += 1
-                except TelegramForbiddenError:
-                     logging.warning(f"ПРЕДУПРЕЖДЕНИЕ: Пользователь {user_id} заблокировал бота.")
-                except TelegramBadRequest as e:
-                     logging.warning(f"ПРЕДУПРЕЖДЕНИЕ: Не удалось отправить сообщение user_id={user_id}. Ошибка: {e}")
-                except Exception as e:
-                    logging.error(f"ПРЕДУПРЕЖДЕНИЕ: Ошибка отправки user_id={user_id}, TW='{tw_username}': {e}")
-                await asyncio.sleep(0.1) # Небольшая пауза
-
-            # 2. Проверка на истечение (дата окончания < сегодня)
+            # 1. Скорое окончание (1-3 дня включительно) или 2. истечение (дата окончания < сегодня)
+            if 0 <= days_until_expiry < EXPIRY_WARNING_DAYS:
+                kind = "warning"
             elif days_until_expiry < 0:
-                try:
-                    # Уведомление пользователю
-                    expired_msg = texts.get(lang, texts['en'])["subscription_expired_for"].format(
-                        tw_username=tw_username,
-                        date=sub_end_str
-                    )
-                    await bot.send_message(user_id, expired_msg, parse_mode="Markdown")
-                    logging.info(f"Отправлено уведомление об ИСТЕЧЕНИИ user_id={user_id} для TW='{tw_username}' (истекла {sub_end_str})")
-                    expired_count += 1
-
-                    # Уведомление админам
-                    tg_username_display = tg_username if tg_username else "не указан"
-                    admin_message = (
-                        f"❌ *Подписка истекла!*\n\n"
-                        f"👤 Telegram ID: `{user_id}`\n"
-                        f"👤 Telegram: @{tg_username_display}\n"
-                        f"👤 TradingView: **{tw_username}**\n"
-                        f"📅 Истекла: {sub_end_str}"
-                        # Можно добавить хеш последнего платежа, если нужно, но это усложнит запрос
-                    )
-                    for admin_id in ADMIN_IDS:
-                        try:
-                             await bot.send_message(admin_id, admin_message, parse_mode="Markdown")
-                        except Exception as e_admin:
-                             logging.error(f"ИСТЕЧЕНИЕ: Ошибка отправки уведомления админу {admin_id} для user {user_id}, TW {tw_username}: {e_admin}")
-
-                except TelegramForbiddenError:
-                    logging.warning(f"ИСТЕЧЕНИЕ: Пользователь {user_id} заблокировал бота.")
-                    # Уведомить админов, что бот заблокирован
-                    tg_username_display = tg_username if tg_username else "не указан"
-                    admin_message = (
-                        f"❌ *Подписка истекла (БОТ ЗАБЛОКИРОВАН ПОЛЬЗОВАТЕЛЕМ)*\n\n"
-                        f"👤 Telegram ID: `{user_id}`\n"
-                        f"👤 Telegram: @{tg_username_display}\n"
-                        f"👤 TradingView: **{tw_username}**\n"
-                        f"📅 Истекла: {sub_end_str}"
-                    )
-                    for admin_id in ADMIN_IDS:
-                        try:
-                            await bot.send_message(admin_id, admin_message, parse_mode="Markdown")
-                        except Exception as e_admin:
-                            logging.error(f"ИСТЕЧЕНИЕ (Бот заблок.): Ошибка отправки админу {admin_id} для user {user_id}, TW {tw_username}: {e_admin}")
-
-                except TelegramBadRequest as e:
-                     logging.warning(f"ИСТЕЧЕНИЕ: Не удалось отправить сообщение user_id={user_id}. Ошибка: {e}")
-                except Exception as e:
-                    logging.error(f"ИСТЕЧЕНИЕ: Ошибка обработки user_id={user_id}, TW='{tw_username}': {e}")
-                await asyncio.sleep(0.1) # Пауза
+                kind = "expired"
+            else:
+                continue
+            tz = resolve_timezone(timezone, lang)
+            send_at = plan_delivery_time(user_id, tw_username, tz)
+            days_left = None
+            if kind == "warning":
+                # Дни считаем по местной дате доставки: окно могло уже пройти, и напоминание уйдет завтра.
+                # Если к доставке подписка уже истечет - не планируем: последнее предупреждение
+                # пользователь получил по вчерашней проверке
+                local_day = datetime.fromtimestamp(send_at, tz).date()
+                days_left = (sub_end_date - local_day).days + 1
+                if days_left < 1:
+                    continue
+                expiring_count += 1
+            else:
+                expired_count += 1
+            planned.append((user_id, tw_username, kind, today, sub_end_str, lang, tg_username, send_at, days_left))
+
+        # Снимок активных/истекших подписок для /stats
+        if not dry_run:
+            await save_subscription_snapshot(today, active_total, expired_total)
+        await save_checkpoint(None, done=True)
+        last_pair = None
 
     except Exception as e:
-        logging.exception(f"Глобальная ошибка в check_subscriptions при получении или обработке данных: {e}")
+        logging.exception("Глобальная ошибка в check_subscriptions при получении или обработке данных: %s", e)
+    finally:
+        # Остановка бота (отмена задачи) или ошибка посреди проверки: запоминаем, где остановились
+        if last_pair is not None and last_pair != resume_after:
+            await save_checkpoint(last_pair)
+            logging.info("Чекпойнт проверки подписок сохранен: user_id=%s, TW='%s'.", last_pair[0], last_pair[1])
+
+    logging.info("Проверка подписок завершена. Запланировано напоминаний: истекающих %s, истекших %s.", expiring_count, expired_count)
+    return {"warning": expiring_count, "expired": expired_count, "active": active_total, "expired_total": expired_total}
+
+
+# --- Прогноз нагрузки рассылки ---
+async def forecast_notifications(days: int):
+    """
+    Прогноз по дням: сколько напоминаний запланирует проверка подписок (если никто не продлит подписку)
+    и сколько займет их отправка при текущих лимитах очереди отправки. Ничего не отправляет.
+    Возвращает: [(day, warnings, expired, admin_messages, seconds)].
+    Оценка времени: общее ведро GLOBAL_RATE на все сообщения, а уведомления админам об истекших
+    подписках упираются еще и в лимит CHAT_RATE на чат (каждый админ получает все).
+    """
+    start_day = datetime.now().strftime("%Y-%m-%d")
+    forecast = []
+    for day, warnings, expired in await get_notification_forecast(start_day, days):
+        admin_messages = expired * len(ADMIN_IDS)
+        seconds = max((warnings + expired + admin_messages) / GLOBAL_RATE,
+                      expired / CHAT_RATE if ADMIN_IDS else 0)
+        forecast.append((day, warnings, expired, admin_messages, seconds))
+    return forecast
+
 
-    logging.info(f"Проверка подписок завершена. Истекающих: {expiring_count}, Истекших: {expired_count}.")
+# --- Фоновая отправка напоминаний ---
+REMINDER_BATCH_SIZE = 50
+REMINDER_MAX_SLEEP = 60       # Как часто перепроверять очередь, если ближайших напоминаний нет (сек)
+REMINDER_MAX_ATTEMPTS = 3
+REMINDER_RETRY_DELAY = 300
+
+def format_expired_admin_message(user_id: int, tg_username: str, tw_username: str, sub_end_str: str,
+                                 blocked: bool = False) -> str:
+    """Текст уведомления админам об истекшей подписке."""
+    title = "❌ *Подписка истекла (БОТ ЗАБЛОКИРОВАН ПОЛЬЗОВАТЕЛЕМ)*" if blocked else "❌ *Подписка истекла!*"
+    return (
+        f"{title}\n\n"
+        f"👤 Telegram ID: `{user_id}`\n"
+        f"👤 Telegram: @{tg_username or 'не указан'}\n"
+        f"👤 TradingView: **{tw_username}**\n"
+        f"📅 Истекла: {sub_end_str}"
+    )
+
+async def send_due_reminders(bot: Bot, texts: dict) -> int:
+    """Отправляет одну пачку наступивших напоминаний. Возвращает размер пачки."""
+    reminders = await get_due_reminders(time.time(), REMINDER_BATCH_SIZE)
+    done_ids = []
+    retries = []
+    admin_messages = []
+    for (reminder_id, user_id, tw_username, kind, sub_end_str, lang, tg_username, attempts,
+         current_end, days_left, blocked) in reminders:
+        if not lease_valid():
+            break # Аренда лидера истекла: остаток пачки отправит новый лидер
+        texts_lang = texts.get(lang, texts['en'])
+        if current_end != sub_end_str:
+            # Подписку продлили после планирования - напоминание больше не актуально
+            done_ids.append(reminder_id)
+            continue
+        if blocked:
+            # Пользователь заблокировал бота: запрос к Telegram бесполезен, админам - только об истечении
+            done_ids.append(reminder_id)
+            if kind == "expired":
+                admin_messages.append(format_expired_admin_message(user_id, tg_username, tw_username, sub_end_str, blocked=True))
+            continue
+        if kind == "warning":
+            # Дни посчитаны при планировании по местной дате доставки
+            text = texts_lang["subscription_warning_for"].format(tw_username=tw_username, days=days_left, date=sub_end_str)
+        else:
+            text = texts_lang["subscription_expired_for"].format(tw_username=tw_username, date=sub_end_str)
+        try:
+            await bot.send_message(user_id, text, parse_mode="Markdown")
+            done_ids.append(reminder_id)
+            if kind == "expired":
+                # Горячий путь рассылки: ленивое форматирование и сэмплирование (log_setup.SamplingFilter)
+                logging.info("Отправлено уведомление об ИСТЕЧЕНИИ user_id=%s для TW='%s' (истекла %s)",
+                             user_id, tw_username, sub_end_str,
+                             extra={"sample": "reminder_sent", "user_id": user_id, "kind": kind})
+                admin_messages.append(format_expired_admin_message(user_id, tg_username, tw_username, sub_end_str))
+            else:
+                logging.info("Отправлено ПРЕДУПРЕЖДЕНИЕ user_id=%s для TW='%s' (осталось %s дн.)",
+                             user_id, tw_username, days_left,
+                             extra={"sample": "reminder_sent", "user_id": user_id, "kind": kind})
+        except TelegramForbiddenError:
+            logging.warning("Напоминание: Пользователь %s заблокировал бота.", user_id)
+            done_ids.append(reminder_id)
+            if kind == "expired":
+                # Уведомить админов, что бот заблокирован
+                admin_messages.append(format_expired_admin_message(user_id, tg_username, tw_username, sub_end_str, blocked=True))
+        except TelegramBadRequest as e:
+            logging.warning("Напоминание: Не удалось отправить сообщение user_id=%s. Ошибка: %s", user_id, e)
+            done_ids.append(reminder_id)
+        except Exception as e:
+            if attempts + 1 >= REMINDER_MAX_ATTEMPTS:
+                logging.error("Напоминание: отброшено для user_id=%s, TW='%s' после %s попыток: %s", user_id, tw_username, attempts + 1, e)
+                done_ids.append(reminder_id)
+            else:
+                logging.warning("Напоминание: ошибка отправки user_id=%s, TW='%s': %s. Повтор позже.", user_id, tw_username, e)
+                retries.append((time.time() + REMINDER_RETRY_DELAY, reminder_id))
+
+    if done_ids or retries:
+        await complete_reminders(done_ids, retries, ADMIN_IDS, admin_messages, fence=current_fence())
+        if admin_messages:
+            wake_outbox_sender()
+    return len(reminders)
+
+async def start_reminder_sender(bot: Bot, texts: dict):
+    """
+    Фоновая отправка запланированных напоминаний ровным потоком в фоновой полосе очереди отправки.
+    Очередь в БД, поэтому напоминания переживают перезапуск бота.
+    """
+    logging.info("Отправка напоминаний о подписках запущена.")
+    with send_lane(LANE_BULK):
+        while True:
+            try:
+                while await send_due_reminders(bot, texts) == REMINDER_BATCH_SIZE:
+                    await asyncio.sleep(0)
+                next_at = await get_next_reminder_time()
+                delay = REMINDER_MAX_SLEEP if next_at is None else min(REMINDER_MAX_SLEEP, max(0.0, next_at - time.time()))
+            except Exception as e:
+                logging.exception("Ошибка в цикле отправки напоминаний: %s", e)
+                delay = REMINDER_MAX_SLEEP
+            await asyncio.sleep(delay)
 
 
 # --- Запуск планировщика ---
 async def start_scheduler(bot: Bot, texts: dict):
     """Запуск периодической проверки подписок (раз в сутки)"""
     logging.info("Планировщик уведомлений о подписках запущен.")
-    await asyncio.sleep(20) # Небольшая задержка перед первым запуском после старта бота
+    # После перезапуска не повторяем проверку, если последняя завершилась меньше суток назад
+    first_delay = 20 # Небольшая задержка перед первым запуском после старта бота
+    checkpoint = await get_scheduler_state(SUBSCRIPTION_CHECK_STATE)
+    if checkpoint and checkpoint.get("done") and checkpoint.get("finished_at"):
+        first_delay = max(first_delay, checkpoint["finished_at"] + SUBSCRIPTION_CHECK_INTERVAL - time.time())
+        logging.info("Последняя проверка подписок завершена %s, следующая через ~%.1f часов.", checkpoint['day'], first_delay / 3600)
+    await asyncio.sleep(first_delay)
     while True:
         start_time = datetime.now()
         try:
@@ -178,11 +438,11 @@ async def start_scheduler(bot: Bot, texts: dict):
             await check_subscriptions(bot, texts)
             end_time = datetime.now()
             duration = (end_time - start_time).total_seconds()
-            logging.info(f"Проверка подписок выполнена за {duration:.2f} секунд.")
+            logging.info("Проверка подписок выполнена за %.2f секунд.", duration)
 
             # Ожидание до начала следующих суток (например, 3 часа ночи)
             # Или просто ожидание 24 часа
-            wait_interval_seconds = 86400 # 24 часа
+            wait_interval_seconds = SUBSCRIPTION_CHECK_INTERVAL # 24 часа
             # wait_interval_seconds = 3600 # 1 час для теста
             # wait_interval_seconds = 60 # 1 минута для теста
 
@@ -194,15 +454,15 @@ async def start_scheduler(bot: Bot, texts: dict):
             #     next_run = (now + timedelta(days=2)).replace(hour=3, minute=0, second=0, microsecond=0)
             #     wait_interval_seconds = (next_run - now).total_seconds()
 
-            logging.info(f"Следующая проверка подписок через ~{wait_interval_seconds / 3600:.1f} часов.")
+            logging.info("Следующая проверка подписок через ~%.1f часов.", wait_interval_seconds / 3600)
             await asyncio.sleep(wait_interval_seconds)
 
         except TelegramRetryAfter as e:
              retry_seconds = e.retry_after
-             logging.warning(f"Планировщик: Превышен лимит запросов Telegram API. Повтор через {retry_seconds} секунд.")
+             logging.warning("Планировщик: Превышен лимит запросов Telegram API. Повтор через %s секунд.", retry_seconds)
              await asyncio.sleep(retry_seconds)
         except Exception as e:
-            logging.exception(f"Критическая ошибка в цикле планировщика: {e}")
+            logging.exception("Критическая ошибка в цикле планировщика: %s", e)
             # При серьезной ошибке ждем 1 час перед повторной попыткой
             logging.info("Ожидание 1 час перед следующей попыткой запуска проверки подписок.")
             await asyncio.sleep(3600)
\ No newline at end of file
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import os
+import random
+from collections import OrderedDict
+
+import aiohttp
+from dotenv import load_dotenv
+
+from database import get_pending_verifications, save_verification_results
+from service import ADMIN_IDS, wake_outbox_sender
+
+load_dotenv()
+
+# --- Конфигурация проверки транзакций ---
+# API, совместимый с Tronscan (GET /api/transaction-info?hash=...)
+TRON_API_URL = os.getenv("TRON_API_URL", "https://apilist.tronscanapi.com").rstrip("/")
+TRON_API_KEY = os.getenv("TRON_API_KEY")
+TRON_VERIFY_ENABLED = os.getenv("TRON_VERIFY_ENABLED", "1") == "1"
+# Контракт USDT в сети TRON
+USDT_CONTRACT = os.getenv("TRC20_USDT_CONTRACT", "TR7NHqjeKQxGTCi8q8ZEpKxCSVqdZFkn6t")
+VERIFY_INTERVAL = int(os.getenv("TRON_VERIFY_INTERVAL", "60"))       # Период опроса очереди (сек)
+VERIFY_CONCURRENCY = int(os.getenv("TRON_VERIFY_CONCURRENCY", "4"))  # Одновременных запросов к API
+VERIFY_BATCH_SIZE = 50
+# Задержка после "пробуждения", чтобы собрать пачку из нескольких новых платежей
+BATCH_COLLECT_DELAY = 5
+# Сколько раундов ждем появления транзакции в сети, прежде чем признать ее ненайденной
+MAX_VERIFY_ATTEMPTS = 30
+REQUEST_RETRIES = 3
+BACKOFF_BASE = 1.0
+REQUEST_TIMEOUT = 15
+CACHE_SIZE = 10_000
+
+# Итоговые статусы (не меняются при повторной проверке)
+FINAL_STATUSES = ("verified", "mismatch", "failed")
+
+
+class TronApiError(Exception):
+    """API недоступно после всех повторов - решение по транзакции откладывается."""
+
+
+class TronVerifier:
+    """
+    Проверка платежей USDT TRC-20 через HTTP API TRON.
+    Держит один пул соединений aiohttp, ограничивает параллельность семафором
+    и кеширует итоговые результаты по tx_hash.
+    """
+
+    def __init__(self, wallet: str, api_url: str = TRON_API_URL, api_key: str = TRON_API_KEY,
+                 concurrency: int = VERIFY_CONCURRENCY):
+        self.wallet = wallet
+        self.api_url = api_url
+        self.api_key = api_key
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._concurrency = concurrency
+        self._session = None
+        self._cache = OrderedDict()  # tx_hash -> (status, note), только итоговые результаты
+        self._wakeup = asyncio.Event()
+
+    async def start(self):
+        headers = {"TRON-PRO-API-KEY": self.api_key} if self.api_key else None
+        self._session = aiohttp.ClientSession(
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=self._concurrency)
+        )
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    def wakeup(self):
+        """Сигнал о новом платеже: проверить очередь раньше планового интервала."""
+        self._wakeup.set()
+
+    async def fetch_transaction(self, tx_hash: str):
+        """Данные транзакции из API или None, если сеть ее (пока) не знает."""
+        url = f"{self.api_url}/api/transaction-info"
+        for attempt in range(REQUEST_RETRIES):
+            try:
+                async with self._semaphore:
+                    async with self._session.get(url, params={"hash": tx_hash}) as resp:
+                        if resp.status == 404:
+                            return None
+                        if resp.status == 429 or resp.status >= 500:
+                            raise aiohttp.ClientResponseError(resp.request_info, resp.history, status=resp.status)
+                        resp.raise_for_status()
+                        data = await resp.json(content_type=None)
+                        return data or None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == REQUEST_RETRIES - 1:
+                    raise TronApiError(str(e)) from e
+                delay = BACKOFF_BASE * (2 ** attempt) + random.uniform(0, BACKOFF_BASE)
+                logging.warning("TRON API: ошибка запроса для '%s' (%s), повтор через %.1f сек.", tx_hash, e, delay)
+                await asyncio.sleep(delay)
+
+    def check_transaction(self, info, expected_amount: float):
+        """
+        Сверяет транзакцию с ожидаемым платежом.
+        Возвращает (status, note); status 'pending' - транзакция еще не найдена или не подтверждена.
+        """
+        if not info or not info.get("hash"):
+            return "pending", "транзакция не найдена в сети"
+        if info.get("contractRet") not in (None, "SUCCESS"):
+            return "failed", f"транзакция неуспешна: {info.get('contractRet')}"
+        if not info.get("confirmed", False):
+            return "pending", "транзакция еще не подтверждена"
+
+        received = 0.0
+        for transfer in info.get("trc20TransferInfo") or []:
+            if transfer.get("contract_address") != USDT_CONTRACT or transfer.get("to_address") != self.wallet:
+                continue
+            try:
+                received += int(transfer.get("amount_str", "0")) / (10 ** int(transfer.get("decimals", 6)))
+            except (TypeError, ValueError):
+                continue
+
+        if received <= 0:
+            return "mismatch", "нет перевода USDT на кошелек TRC20_WALLET"
+        if received + 1e-6 < float(expected_amount):
+            return "mismatch", f"получено {received} USDT вместо {expected_amount}"
+        return "verified", f"получено {received} USDT"
+
+    async def verify(self, tx_hash: str, expected_amount: float):
+        """Результат проверки одной транзакции (с учетом кеша) или None при недоступности API."""
+        cached = self._cache.get(tx_hash)
+        if cached:
+            return cached
+        try:
+            info = await self.fetch_transaction(tx_hash)
+        except TronApiError as e:
+            logging.error("TRON API недоступно для '%s': %s", tx_hash, e)
+            return None
+        result = self.check_transaction(info, expected_amount)
+        if result[0] in FINAL_STATUSES:
+            self._cache[tx_hash] = result
+            if len(self._cache) > CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return result
+
+    async def process_batch(self, after_id: int = 0) -> int:
+        """
+        Проверяет одну пачку ожидающих платежей с id > after_id.
+        Возвращает id последнего платежа пачки или None, если пачка пуста.
+        """
+        pending = await get_pending_verifications(after_id, VERIFY_BATCH_SIZE)
+        if not pending:
+            return None
+
+        results = await asyncio.gather(*(self.verify(row[3], row[4]) for row in pending))
+
+        updates = []
+        admin_messages = []
+        for (payment_id, user_id, tw_username, tx_hash, amount, attempts), result in zip(pending, results):
+            if result is None:
+                continue # API недоступно - не тратим попытку, проверим в следующий раз
+            status, note = result
+            if status == "pending" and attempts + 1 >= MAX_VERIFY_ATTEMPTS:
+                status = "failed"
+            updates.append((status, note, payment_id))
+            if status != "pending":
+                logging.info("Проверка транзакции '%s' (user_id=%s, TW='%s'): %s - %s",
+                             tx_hash, user_id, tw_username, status, note)
+                admin_messages.append(format_verification_message(user_id, tw_username, tx_hash, amount, status, note))
+
+        if updates:
+            # Результаты и уведомления админам сохраняются атомарно, отправка - через outbox
+            await save_verification_results(updates, ADMIN_IDS, admin_messages)
+            if admin_messages:
+                wake_outbox_sender()
+        return pending[-1][0]
+
+    async def run(self):
+        """Фоновый цикл проверки; пользовательское подтверждение его никогда не ждет."""
+        logging.info("Фоновая проверка транзакций TRON запущена.")
+        await self.start()
+        try:
+            while True:
+                try:
+                    # Один раунд проходит всю очередь по возрастанию id, затем ждем интервала или нового платежа
+                    last_id = await self.process_batch()
+                    while last_id is not None:
+                        last_id = await self.process_batch(last_id)
+                except Exception as e:
+                    logging.exception("Ошибка в цикле проверки транзакций: %s", e)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=VERIFY_INTERVAL)
+                    await asyncio.sleep(BATCH_COLLECT_DELAY)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+        finally:
+            await self.close()
+
+
+def format_verification_message(user_id: int, tw_username: str, tx_hash: str,
+                                amount: float, status: str, note: str) -> str:
+    """Текст уведомления админам о результате проверки транзакции в сети."""
+    title = "✅ *Платеж подтвержден в сети*" if status == "verified" else "⚠️ *Платеж НЕ подтвержден в сети*"
+    return (
+        f"{title}\n\n"
+        f"👤 Telegram ID: `{user_id}`\n"
+        f"👤 TradingView: **{tw_username}**\n"
+        f"🔗 Hash: `{tx_hash}`\n"
+        f"💵 Сумма: *{amount} USDT*\n"
+        f"ℹ️ {note}"
+    )
@@ -0,0 +1,103 @@
+import asyncio
+import hashlib
+import logging
+import math
+
+from database import connect_db
+
+# Минимальная емкость фильтра; при загрузке берется с запасом x2 от текущего числа хешей
+MIN_CAPACITY = 100_000
+# Допустимая доля ложноположительных срабатываний (они перепроверяются точным запросом к БД)
+ERROR_RATE = 0.001
+
+
+class BloomFilter:
+    """Простой Bloom-фильтр на bytearray с двойным хешированием (blake2b)."""
+    __slots__ = ("capacity", "size", "hash_count", "bits", "count")
+
+    def __init__(self, capacity: int, error_rate: float = ERROR_RATE):
+        self.capacity = capacity
+        self.size = int(-capacity * math.log(error_rate) / (math.log(2) ** 2)) + 1
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, item: str):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class TxHashIndex:
+    """
+    Индекс известных tx_hash в памяти.
+    Отрицательный ответ фильтра окончательный (без обращения к диску),
+    положительный перепроверяется точным запросом к БД.
+    """
+
+    def __init__(self):
+        # Учитываются и горячая таблица payments, и архив payments_archive
+        self._bloom = None      # None - индекс не загружен или перестраивается
+        self._pending = None    # Хеши, добавленные во время перестройки
+        self._rebuilding = False
+        self._rebuild_task = None
+
+    async def load(self):
+        """Строит фильтр по всем tx_hash из БД (вызывается при старте и при переполнении)."""
+        self._rebuilding = True
+        self._pending = set()
+        try:
+            async with connect_db() as db:
+                async with db.execute("SELECT (SELECT COUNT(*) FROM payments) + (SELECT COUNT(*) FROM payments_archive)") as cursor:
+                    total = (await cursor.fetchone())[0]
+                bloom = BloomFilter(max(MIN_CAPACITY, total * 2))
+                async with db.execute("SELECT tx_hash FROM payments UNION ALL SELECT tx_hash FROM payments_archive") as cursor:
+                    async for row in cursor:
+                        bloom.add(row[0])
+            for tx_hash in self._pending:
+                bloom.add(tx_hash)
+            self._bloom = bloom
+            logging.info("Индекс tx_hash загружен: %s хешей, емкость %s.", bloom.count, bloom.capacity)
+        except Exception as e:
+            logging.error("Не удалось загрузить индекс tx_hash, проверки пойдут напрямую в БД: %s", e)
+            self._bloom = None
+        finally:
+            self._pending = None
+            self._rebuilding = False
+
+    def add(self, tx_hash: str):
+        """Добавляет хеш после успешной записи платежа."""
+        if self._pending is not None:
+            self._pending.add(tx_hash)
+        if self._bloom is None:
+            return
+        self._bloom.add(tx_hash)
+        if self._bloom.count > self._bloom.capacity and not self._rebuilding:
+            # Фильтр переполнен - точность падает, перестраиваем в фоне с большей емкостью
+            logging.info("Индекс tx_hash переполнен, перестраиваем...")
+            self._rebuilding = True
+            self._rebuild_task = asyncio.create_task(self.load())
+
+    async def contains(self, tx_hash: str) -> bool:
+        """True, если хеш уже использован в каком-либо платеже."""
+        if self._bloom is not None and tx_hash not in self._bloom:
+            return False
+        async with connect_db() as db:
+            query = '''
+                SELECT EXISTS (SELECT 1 FROM payments WHERE tx_hash = ?)
+                    OR EXISTS (SELECT 1 FROM payments_archive WHERE tx_hash = ?)
+            '''
+            async with db.execute(query, (tx_hash, tx_hash)) as cursor:
+                return bool((await cursor.fetchone())[0])
+
+
+tx_hash_index = TxHashIndex()
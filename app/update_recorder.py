@@ -0,0 +1,159 @@
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import secrets
+import time
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Запись входящих апдейтов для replay.py: путь к файлу (.gz - со сжатием); пусто - запись выключена
+RECORD_UPDATES_FILE = os.getenv("RECORD_UPDATES_FILE", "")
+RECORD_MAX_MB = float(os.getenv("RECORD_MAX_MB", "200"))   # После стольких мегабайт запись останавливается
+# Ключ псевдонимов: с одним ключом записи разных запусков согласованы (один пользователь - один псевдоним).
+# По умолчанию случайный на каждый запуск
+RECORD_SALT = os.getenv("RECORD_SALT", "")
+RECORD_FLUSH_INTERVAL = 5.0  # Как часто сбрасывать буфер на диск (сек)
+RECORD_FORMAT_VERSION = 1
+
+# Поля с личными данными: значение заменяется псевдонимом того же вида и длины
+_TEXT_FIELDS = {"first_name", "last_name", "username", "title", "phone_number", "bio",
+                "file_id", "file_unique_id", "chat_instance", "vcard"}
+# Объекты, у которых поле id - идентификатор пользователя или чата
+_ID_OWNERS = {"from", "chat", "user", "sender_chat", "forward_from", "forward_from_chat",
+              "sender_user", "old_chat_member", "new_chat_member"}
+_WORD = re.compile(r"\w+")
+
+
+class UpdateRecorder:
+    """
+    Запись входящих апдейтов (outer-middleware апдейтов) для воспроизведения replay.py: строка JSONL
+    на апдейт - {"t": секунды от начала записи, "u": апдейт}; каждый запуск бота начинается строкой-
+    заголовком {"v", "started", "admins"}.
+    Личные данные заменяются псевдонимами по ключу (HMAC): id пользователей и чатов - числами
+    (админы - 1..n, чтобы при воспроизведении работали админские обработчики), имена, тексты и
+    file_id - строками той же длины и того же вида (цифры остаются цифрами, hex - hex), поэтому
+    хеши транзакций и TW-юзернеймы проходят те же проверки. Команды и тексты кнопок (keep_text)
+    сохраняются как есть - по ним выбирается обработчик.
+    """
+
+    def __init__(self, path: str, admin_ids, keep_text=None, salt: str = RECORD_SALT,
+                 max_bytes: float = RECORD_MAX_MB * 1024 * 1024):
+        self.path = path
+        self.keep_text = keep_text  # текст -> True, если сохранять как есть (кнопки меню)
+        self.max_bytes = max_bytes
+        self._key = salt.encode() if salt else secrets.token_bytes(32)
+        self._admins = {admin_id: index for index, admin_id in enumerate(admin_ids, 1)}
+        self._file = None
+        self._started = time.monotonic()
+        self._flushed_at = self._started
+        self.written = 0   # Записано в этом запуске (символов JSON, до сжатия)
+        self.recorded = 0
+
+    def _open(self):
+        opener = gzip.open if self.path.endswith(".gz") else open
+        # Дописываем: записи прошлых запусков сохраняются, каждая со своим заголовком
+        self._file = opener(self.path, "at", encoding="utf-8")
+        self._write({"v": RECORD_FORMAT_VERSION, "started": datetime.now().isoformat(timespec="seconds"),
+                     "admins": len(self._admins)})
+        logging.info("Запись апдейтов для воспроизведения включена: %s", self.path)
+
+    def _write(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+        self._file.write(line)
+        self.written += len(line)
+
+    def _digest(self, value: str) -> bytes:
+        return hmac.new(self._key, value.encode(), hashlib.sha256).digest()
+
+    def pseudo_id(self, value: int) -> int:
+        """Псевдоним id пользователя или чата: админы - 1..n, остальные - из диапазона 10^9..2*10^9 со знаком исходного."""
+        if value in self._admins:
+            return self._admins[value]
+        pseudo = 10**9 + int.from_bytes(self._digest(str(abs(value)))[:8], "big") % 10**9
+        return -pseudo if value < 0 else pseudo
+
+    def _scramble_word(self, match) -> str:
+        word = match.group()
+        digest = self._digest(word)
+        while len(digest) < len(word):
+            digest += self._digest(word + str(len(digest)))
+        chars = []
+        for char, byte in zip(word, digest):
+            if char.isdigit():
+                chars.append("0123456789"[byte % 10])
+            elif char in "abcdef":
+                chars.append("abcdef"[byte % 6])
+            elif char in "ABCDEF":
+                chars.append("ABCDEF"[byte % 6])
+            elif char.isupper():
+                chars.append(chr(ord("A") + byte % 26))
+            elif char.isalpha():
+                chars.append(chr(ord("a") + byte % 26))
+            else:
+                chars.append(char)
+        return "".join(chars)
+
+    def scramble(self, text: str) -> str:
+        """Псевдоним текста: каждое слово заменяется словом той же длины и вида, остальное сохраняется."""
+        return _WORD.sub(self._scramble_word, text)
+
+    def _message_text(self, text: str) -> str:
+        if self.keep_text and self.keep_text(text):
+            return text
+        if text.startswith("/"):
+            command, space, args = text.partition(" ")
+            return command + space + self.scramble(args) # Команда нужна для выбора обработчика
+        return self.scramble(text)
+
+    def anonymize(self, value, key: str = None, owner: str = None):
+        """Копия данных апдейта (после model_dump) с псевдонимами вместо личных данных."""
+        if isinstance(value, dict):
+            return {k: self.anonymize(v, k, key) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.anonymize(item, key, owner) for item in value]
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, int) and (key in ("user_id", "chat_id") or (key == "id" and owner in _ID_OWNERS)):
+            return self.pseudo_id(value)
+        if isinstance(value, str):
+            if key in ("text", "caption"):
+                return self._message_text(value)
+            if key in _TEXT_FIELDS or key == "url":
+                return self.scramble(value)
+        return value
+
+    def record(self, update):
+        if self.written >= self.max_bytes:
+            return
+        try:
+            if self._file is None:
+                self._open()
+            data = update.model_dump(mode="json", by_alias=True, exclude_none=True, exclude_defaults=True)
+            self._write({"t": round(time.monotonic() - self._started, 3), "u": self.anonymize(data)})
+            self.recorded += 1
+            now = time.monotonic()
+            if self.written >= self.max_bytes:
+                logging.warning("Запись апдейтов остановлена: достигнут предел %.0f МБ.", self.max_bytes / 1024 / 1024)
+                self.close()
+            elif now - self._flushed_at >= RECORD_FLUSH_INTERVAL:
+                self._flushed_at = now
+                self._file.flush()
+        except Exception as e:
+            logging.error("Ошибка записи апдейта %s для воспроизведения: %s", update.update_id, e)
+
+    def close(self):
+        """Сбрасывает буфер и закрывает файл (при остановке бота)."""
+        if self._file is not None and not self._file.closed:
+            self._file.close()
+            logging.info("Запись апдейтов закрыта: %s апдейтов, %.0f КБ.", self.recorded, self.written / 1024)
+
+    async def __call__(self, handler, event, data):
+        self.record(event)
+        return await handler(event, data)
@@ -0,0 +1,211 @@
+"""
+Проверка транзакций TRON (tron_verifier.TronVerifier) против локальной подмены Tronscan API.
+Запуск из корня репозитория: python -m unittest discover -s tests
+
+Подмена поднимается на 127.0.0.1:0 (aiohttp), БД - временная (миграции migrations.init_db),
+пачки разбираются через process_batch, как в фоновом цикле.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "app")
+sys.path.insert(0, os.path.abspath(APP_DIR))
+os.environ.setdefault("ADMIN_IDS", "1,2")
+
+import aiosqlite  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+import database  # noqa: E402
+import tron_verifier  # noqa: E402
+from migrations import init_db  # noqa: E402
+from tron_verifier import TronVerifier, USDT_CONTRACT, MAX_VERIFY_ATTEMPTS, REQUEST_RETRIES  # noqa: E402
+
+WALLET = "TTestWalletAddress000000000000000000"
+OTHER_WALLET = "TOtherWalletAddress00000000000000000"
+
+
+def transaction(tx_hash: str, amount: float, to_address: str = WALLET, confirmed: bool = True) -> dict:
+    """Ответ transaction-info с одним переводом USDT (6 знаков после запятой)."""
+    return {
+        "hash": tx_hash,
+        "contractRet": "SUCCESS",
+        "confirmed": confirmed,
+        "trc20TransferInfo": [{
+            "contract_address": USDT_CONTRACT,
+            "to_address": to_address,
+            "amount_str": str(int(amount * 10**6)),
+            "decimals": 6,
+        }],
+    }
+
+
+class TronscanStandIn:
+    """
+    Локальная подмена Tronscan API: GET /api/transaction-info?hash=...
+    responses[hash] - список ответов по очереди (последний повторяется): dict - JSON 200,
+    int - пустой ответ с этим статусом. Неизвестный hash - 404.
+    """
+
+    def __init__(self):
+        self.responses = {}
+        self.hits = {}
+        self._runner = None
+        self.url = None
+
+    async def _handle(self, request: web.Request):
+        tx_hash = request.query.get("hash")
+        self.hits[tx_hash] = self.hits.get(tx_hash, 0) + 1
+        queue = self.responses.get(tx_hash)
+        if not queue:
+            return web.Response(status=404)
+        response = queue.pop(0) if len(queue) > 1 else queue[0]
+        if isinstance(response, int):
+            return web.Response(status=response)
+        return web.json_response(response)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/api/transaction-info", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", 0).start()
+        self.url = f"http://127.0.0.1:{self._runner.addresses[0][1]}"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+class TronVerifierTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self._cwd = os.getcwd()
+        self._tmp = tempfile.mkdtemp(prefix="tron_test_")
+        os.chdir(self._tmp)  # database.DATABASE_FILE - относительный путь
+        await init_db()
+        self._backoff = tron_verifier.BACKOFF_BASE
+        tron_verifier.BACKOFF_BASE = 0.0  # Повторы без пауз
+        self.api = TronscanStandIn()
+        await self.api.start()
+        self.verifier = TronVerifier(WALLET, api_url=self.api.url, api_key=None)
+        await self.verifier.start()
+
+    async def asyncTearDown(self):
+        await self.verifier.close()
+        await self.api.stop()
+        tron_verifier.BACKOFF_BASE = self._backoff
+        os.chdir(self._cwd)
+        shutil.rmtree(self._tmp, ignore_errors=True)
+
+    async def add_payment(self, tx_hash: str, amount: float, attempts: int = 0) -> int:
+        async with aiosqlite.connect(database.DATABASE_FILE) as db:
+            await db.execute("INSERT OR IGNORE INTO users (user_id, username) VALUES (10, 'user10')")
+            cursor = await db.execute(
+                "INSERT INTO payments (user_id, tw_username, tx_hash, amount, purchase_date, subscription_end, "
+                "verify_attempts) VALUES (10, 'TwUser', ?, ?, '2026-01-01', '2026-02-01', ?)",
+                (tx_hash, amount, attempts))
+            await db.commit()
+            return cursor.lastrowid
+
+    async def payment(self, payment_id: int):
+        async with aiosqlite.connect(database.DATABASE_FILE) as db:
+            async with db.execute("SELECT verification_status, verification_note, verify_attempts FROM payments "
+                                  "WHERE id = ?", (payment_id,)) as cursor:
+                return await cursor.fetchone()
+
+    async def outbox_count(self) -> int:
+        async with aiosqlite.connect(database.DATABASE_FILE) as db:
+            async with db.execute("SELECT COUNT(*) FROM admin_outbox") as cursor:
+                return (await cursor.fetchone())[0]
+
+    async def test_final_results(self):
+        self.api.responses = {
+            "ok": [transaction("ok", 58)],
+            "short": [transaction("short", 20)],
+            "elsewhere": [transaction("elsewhere", 58, to_address=OTHER_WALLET)],
+        }
+        verified = await self.add_payment("ok", 58)
+        short = await self.add_payment("short", 58)
+        elsewhere = await self.add_payment("elsewhere", 58)
+
+        self.assertEqual(await self.verifier.process_batch(), elsewhere)
+
+        self.assertEqual((await self.payment(verified))[0], "verified")
+        status, note, attempts = await self.payment(short)
+        self.assertEqual(status, "mismatch")
+        self.assertIn("20.0", note)
+        self.assertEqual(attempts, 1)
+        status, note, _ = await self.payment(elsewhere)
+        self.assertEqual(status, "mismatch")
+        self.assertIn("TRC20_WALLET", note)
+        # Уведомление о каждом итоговом результате каждому админу - в outbox, в одной транзакции с результатом
+        self.assertEqual(await self.outbox_count(), 3 * 2)
+        # Итоговых платежей в очереди больше нет
+        self.assertIsNone(await self.verifier.process_batch())
+
+    async def test_not_found_stays_pending_until_attempts_run_out(self):
+        fresh = await self.add_payment("missing", 58)
+        last_try = await self.add_payment("missing-long", 58, attempts=MAX_VERIFY_ATTEMPTS - 1)
+
+        await self.verifier.process_batch()
+
+        status, note, attempts = await self.payment(fresh)
+        self.assertEqual((status, attempts), ("pending", 1))
+        self.assertIn("не найдена", note)
+        self.assertEqual((await self.payment(last_try))[0], "failed")
+        self.assertEqual(await self.outbox_count(), 2)  # Только о failed
+
+    async def test_unconfirmed_is_pending(self):
+        self.api.responses = {"fresh": [transaction("fresh", 58, confirmed=False)]}
+        payment_id = await self.add_payment("fresh", 58)
+        await self.verifier.process_batch()
+        self.assertEqual((await self.payment(payment_id))[0], "pending")
+
+    async def test_retries_on_5xx_and_429(self):
+        self.api.responses = {"flaky": [503, 429, transaction("flaky", 58)]}
+        payment_id = await self.add_payment("flaky", 58)
+
+        await self.verifier.process_batch()
+
+        self.assertEqual(self.api.hits["flaky"], 3)
+        self.assertEqual((await self.payment(payment_id))[0], "verified")
+
+    async def test_api_down_does_not_spend_attempt(self):
+        self.api.responses = {"down": [502]}
+        payment_id = await self.add_payment("down", 58)
+
+        await self.verifier.process_batch()
+
+        self.assertEqual(self.api.hits["down"], REQUEST_RETRIES)
+        self.assertEqual(await self.payment(payment_id), ("pending", None, 0))
+        self.assertEqual(await self.outbox_count(), 0)
+
+    async def test_final_results_are_cached(self):
+        self.api.responses = {"ok": [transaction("ok", 58)], "late": [404]}
+        await self.add_payment("ok", 58)
+        await self.add_payment("late", 58)
+        await self.verifier.process_batch()
+
+        self.assertEqual(await self.verifier.verify("ok", 58), ("verified", "получено 58.0 USDT"))
+        self.assertEqual(self.api.hits["ok"], 1)  # Итоговый результат - из кеша
+        await self.verifier.verify("late", 58)
+        self.assertEqual(self.api.hits["late"], 2)  # "Не найдена" не кешируется: сеть может ее еще увидеть
+
+    async def test_batches_walk_queue_by_id(self):
+        first = await self.add_payment("a", 58)
+        second = await self.add_payment("b", 58)
+        tron_verifier.VERIFY_BATCH_SIZE, batch_size = 1, tron_verifier.VERIFY_BATCH_SIZE
+        try:
+            self.assertEqual(await self.verifier.process_batch(), first)
+            # Платеж остался pending, но следующая пачка начинается после него, а не с начала очереди
+            self.assertEqual(await self.verifier.process_batch(first), second)
+            self.assertIsNone(await self.verifier.process_batch(second))
+        finally:
+            tron_verifier.VERIFY_BATCH_SIZE = batch_size
+        self.assertEqual(self.api.hits, {"a": 1, "b": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()